@@ -0,0 +1,262 @@
+"""What the JSON API under /api/v1 is built from.
+
+Its views live in app.py with the rest (the "JSON API" section), on the
+`api` blueprint defined here. This module has what they share:
+
+- `Fields`: the fields one kind of resource can be serialized with, each
+  mapped to a column. `?fields=id,text,user.username` picks some of them
+  (a dotted name nests; `user` alone means every `user.` field), and only
+  those columns are selected: rows never become ORM objects.
+- `page`: one page of a list, as `{"data": [...], "next_cursor": ...}`.
+  Pass `next_cursor` back as `?cursor=` for the next page, and `?limit=` to
+  change the page size.
+- `respond`: the response body, as JSON or, for clients that ask for it
+  with `Accept: application/msgpack` (or `?format=msgpack`), MessagePack.
+  That needs the `msgpack` package; without it such requests get a 406.
+  Bodies of a kilobyte or more are gzipped for clients that accept it.
+"""
+
+import gzip
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, request, abort, jsonify
+from werkzeug.exceptions import HTTPException
+
+from models import User, Message, DirectMessage, Conversation, ConversationMember
+from pagination import decode_cursor, paginate
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+# smaller bodies aren't worth compressing
+GZIP_MIN_BYTES = 1024
+
+MAX_LIMIT = 100
+
+
+@api.errorhandler(HTTPException)
+def http_error(e):
+    """Errors as `{"error": ...}` JSON (always JSON, so they can't fail too)."""
+
+    return jsonify(error=e.description), e.code
+
+
+class Fields:
+    """The fields of one kind of resource and the columns they come from.
+
+    `joins` maps a model to how to join it to the base query, for when a
+    selected field's column is on that model.
+    """
+
+    def __init__(self, columns, default=None, joins=None):
+        self.columns = columns
+        self.default = default or list(columns)
+        self.joins = joins or {}
+
+    def requested(self):
+        """The fields named by `?fields=` (or the default ones); 400 if unknown."""
+
+        param = request.args.get('fields')
+        if not param:
+            return self.default
+
+        names = []
+        for name in filter(None, (name.strip() for name in param.split(','))):
+            matches = [field for field in self.columns
+                       if field == name or field.startswith(name + '.')]
+            if not matches:
+                abort(400, f"Unknown field {name!r}; choose from {', '.join(self.columns)}")
+            names.extend(field for field in matches if field not in names)
+
+        return names or self.default
+
+    def select(self, query, names, *extra):
+        """`query` selecting just the columns for `names`, then `extra` ones."""
+
+        for model, join in self.joins.items():
+            if any(self.columns[name].class_ is model for name in names):
+                query = join(query)
+
+        return query.with_entities(*(self.columns[name] for name in names), *extra)
+
+    def one(self, query):
+        """The first row of `query`, serialized; 404 if there is none."""
+
+        names = self.requested()
+        row = self.select(query, names).first()
+
+        if row is None:
+            abort(404)
+
+        return serialize(names, row)
+
+
+def serialize(names, values):
+    """A dict of `names` to `values`, nesting dotted names."""
+
+    item = {}
+
+    for name, value in zip(names, values):
+        if isinstance(value, datetime):
+            value = value.isoformat()
+
+        *parents, key = name.split('.')
+        target = item
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[key] = value
+
+    return item
+
+
+def page(fields, query, per_page, id_col, timestamp_col=None):
+    """One page of `query`, newest first, ready for `respond`.
+
+    Rows are ordered by (timestamp_col, id_col), or by id_col alone for
+    lists with no timestamp, both descending.
+    """
+
+    names = fields.requested()
+    per_page = min(max(request.args.get('limit', per_page, type=int), 1), MAX_LIMIT)
+    cursor = request.args.get('cursor')
+
+    try:
+        if timestamp_col is not None:
+            before = decode_cursor(cursor) if cursor else None
+        else:
+            before = int(cursor) if cursor else None
+    except ValueError:
+        abort(400, "Invalid cursor")
+
+    if timestamp_col is not None:
+        rows, next_cursor = paginate(fields.select(query, names, timestamp_col, id_col),
+                                     before, per_page, timestamp_col, id_col,
+                                     key=lambda row: row[-2:])
+
+    else:
+        if before is not None:
+            query = query.filter(id_col < before)
+
+        rows = (fields.select(query, names, id_col)
+                .order_by(id_col.desc())
+                .limit(per_page + 1)
+                .all())
+
+        next_cursor = str(rows[per_page - 1][-1]) if len(rows) > per_page else None
+        rows = rows[:per_page]
+
+    return {
+        'data': [serialize(names, row) for row in rows],
+        'next_cursor': next_cursor,
+    }
+
+
+def submitted(form_class):
+    """A `form_class` form filled in from the request's JSON body, validated.
+
+    Only JSON bodies are taken: browsers won't send those cross-site without
+    asking first, which is what stands in for CSRF tokens here. 415 for
+    anything else, 400 with each field's errors if it doesn't validate.
+    """
+
+    if not request.is_json:
+        abort(415, "Send a JSON body")
+
+    form = form_class(meta={'csrf': False})
+
+    if not form.validate():
+        abort(400, form.errors)
+
+    return form
+
+
+def wants_msgpack():
+    if request.args.get('format') == 'msgpack':
+        return True
+
+    best = request.accept_mimetypes.best_match(['application/json', *MSGPACK_MIMETYPES])
+    return best in MSGPACK_MIMETYPES
+
+
+def respond(data, status=200):
+    """`data` encoded the way the client asked for, gzipped if it's big."""
+
+    if wants_msgpack():
+        try:
+            import msgpack
+        except ImportError:
+            abort(406, "MessagePack isn't available; ask for application/json")
+
+        body, mimetype = msgpack.packb(data, use_bin_type=True), MSGPACK_MIMETYPES[0]
+
+    else:
+        body, mimetype = json.dumps(data, separators=(',', ':')).encode('UTF-8'), 'application/json'
+
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.update(('Accept', 'Accept-Encoding'))
+
+    if len(body) >= GZIP_MIN_BYTES and request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+# What each kind of resource can be serialized with. Email addresses and
+# password hashes are never among them.
+
+USER_FIELDS = Fields({
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'private': User.private,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}, default=['id', 'username', 'image_url'])
+
+PROFILE_FIELDS = Fields(USER_FIELDS.columns)
+
+MESSAGE_FIELDS = Fields({
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'likes_count': Message.likes_count,
+    'user.id': Message.user_id,
+    'user.username': User.username,
+    'user.image_url': User.image_url,
+}, joins={
+    User: lambda query: query.join(User, User.id == Message.user_id),
+})
+
+DIRECT_MESSAGE_FIELDS = Fields({
+    'id': DirectMessage.id,
+    'text': DirectMessage.text,
+    'timestamp': DirectMessage.timestamp,
+    'user_from_id': DirectMessage.user_from_id,
+    'user_to_id': DirectMessage.user_to_id,
+})
+
+CONVERSATION_FIELDS = Fields({
+    'id': ConversationMember.conversation_id,
+    'unread_count': ConversationMember.unread_count,
+    'last_message_at': ConversationMember.last_message_at,
+    'other_user.id': ConversationMember.other_user_id,
+    'other_user.username': User.username,
+    'other_user.image_url': User.image_url,
+    'last_message.text': DirectMessage.text,
+    'last_message.user_from_id': DirectMessage.user_from_id,
+}, joins={
+    User: lambda query: query.join(User, User.id == ConversationMember.other_user_id),
+    DirectMessage: lambda query: (query
+                                  .join(Conversation,
+                                        Conversation.id == ConversationMember.conversation_id)
+                                  .outerjoin(DirectMessage,
+                                             DirectMessage.id == Conversation.last_message_id)),
+})
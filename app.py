@@ -1,12 +1,34 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, Response
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, Response, jsonify, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_
+from datetime import datetime, timedelta
+from collections import defaultdict
 import json
+import click
+import time
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm, DirectMessageForm
-from models import db, connect_db, User, Message, LikedMessage, DirectMessage, Follows, FollowRequest
+from models import db, connect_db, passwords, User, Message, LikedMessage, DirectMessage, Follows, FollowRequest, TimelineEntry, Conversation, ConversationMember, Recommendation, Job
+from pagination import paginate, cursor_from_request
+from autocomplete import UsernameIndex
+from search import search_users
+import migrations
+import jobs
+import recommendations
+from viewer import Viewer
+from instrumentation import Instrumentation
+from user_cache import UserCache, UserGone
+from passwords import PasswordHasherBusy
+import caching
+from fragments import FragmentCacheExtension
+from streaming import stream_template, preloaded
+from like_buffer import LikeBuffer
+from loading import eager
+from live import Broker, ConnectionLimit, MemoryBackend, RedisBackend, format_sse
+from trending import Trending
+from api import api, respond, page, submitted, USER_FIELDS, PROFILE_FIELDS, MESSAGE_FIELDS, DIRECT_MESSAGE_FIELDS, CONVERSATION_FIELDS
 
 CURR_USER_KEY = "curr_user"
 
@@ -21,20 +43,140 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Serve the home feed from precomputed per-follower timelines (fan-out on
+# write) instead of querying every followee on each page load.
+app.config['TIMELINE_FANOUT'] = bool(os.environ.get('TIMELINE_FANOUT', ''))
+
+# How many messages to show per page on the home feed and profile lists
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 20))
+
+# How many usernames /autocomplete suggests, and how long browsers may cache them
+app.config['AUTOCOMPLETE_LIMIT'] = 10
+app.config['AUTOCOMPLETE_MAX_AGE'] = 60
+
+# How many user cards to show per page on /users
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 24))
+
+# How long (seconds) to reuse the logged-in user's navbar/sidebar details
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+
+# bcrypt cost, and the worker processes that hash passwords off the request
+# threads (0: hash inline); past PASSWORD_MAX_PENDING queued we answer 503
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_MAX_PENDING'] = int(os.environ.get('PASSWORD_MAX_PENDING', 4 * app.config['PASSWORD_WORKERS'] or 64))
+
 toolbar = DebugToolbarExtension(app)
 
+# Query counts and timings per request: Server-Timing headers, a JSON-lines
+# log of slow requests and latency histograms at /metrics (for requests
+# from this machine, or anywhere with "Authorization: Bearer METRICS_TOKEN")
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_REQUEST_LOG'] = os.environ.get('SLOW_REQUEST_LOG')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+instrumentation = Instrumentation(app)
+
+# Static files are linked with content-hashed URLs and cached for good;
+# unversioned ones are revalidated on every use
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+app.add_template_global(caching.static_url)
+app.after_request(caching.apply_policy)
+
+# Rendered message cards are kept in an LRU ({% cache %} in the templates);
+# its hit ratio shows up on /metrics
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+instrumentation.register_gauge('fragment_cache_hit_ratio', app.jinja_env.fragment_cache.hit_ratio)
+
+# Slow side effects (deleting accounts, timeline backfills, counter repair)
+# run in `flask worker`; jobs whose worker goes quiet this long are retried
+app.config['JOB_VISIBILITY_TIMEOUT'] = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+
+# "Who to follow": how many suggestions to keep per user and show, and how
+# often `flask worker` recomputes them all from the follow graph
+app.config['RECOMMENDATIONS_PER_USER'] = int(os.environ.get('RECOMMENDATIONS_PER_USER', 20))
+app.config['RECOMMENDATIONS_INTERVAL'] = int(os.environ.get('RECOMMENDATIONS_INTERVAL', 24 * 60 * 60))
+app.config['SUGGESTIONS_SHOWN'] = 5
+
+# How pages load message authors and follow lists (see loading.py), e.g.
+# LOADER_STRATEGIES='{"Message.user": "selectin"}'. With RAISE_ON_LAZY_LOAD
+# set, touching a relationship a view didn't load raises instead.
+app.config['LOADER_STRATEGIES'] = json.loads(os.environ.get('LOADER_STRATEGIES', '{}'))
+app.config['RAISE_ON_LAZY_LOAD'] = bool(os.environ.get('RAISE_ON_LAZY_LOAD', ''))
+
+# Set LIKE_BUFFER_SECONDS to have likes buffered in memory and written in
+# batches that often, instead of on every click (from the first request on,
+# like trending below)
+app.config['LIKE_BUFFER_SECONDS'] = float(os.environ.get('LIKE_BUFFER_SECONDS', 0))
+like_buffer = LikeBuffer(app, interval=app.config['LIKE_BUFFER_SECONDS'])
+
+# /trending ranks messages by their likes over the last TRENDING_WINDOW
+# minutes, newer likes counting more (halving every TRENDING_HALF_LIFE
+# minutes). Each process writes its counts and re-ranks every
+# TRENDING_REFRESH_SECONDS (0: never, e.g. in tests), from its first
+# request on, so the CLI and job workers never start the thread.
+app.config['TRENDING_WINDOW'] = int(os.environ.get('TRENDING_WINDOW', 6 * 60))
+app.config['TRENDING_HALF_LIFE'] = int(os.environ.get('TRENDING_HALF_LIFE', 60))
+app.config['TRENDING_REFRESH_SECONDS'] = int(os.environ.get('TRENDING_REFRESH_SECONDS', 60))
+app.config['TRENDING_SHOWN'] = 50
+trending = Trending(app, window=app.config['TRENDING_WINDOW'],
+                    half_life=app.config['TRENDING_HALF_LIFE'],
+                    size=app.config['TRENDING_SHOWN'],
+                    interval=app.config['TRENDING_REFRESH_SECONDS'])
+
+
+@app.before_first_request
+def start_trending():
+    if app.config['TRENDING_REFRESH_SECONDS']:
+        trending.start()
+
+
+@app.before_first_request
+def start_like_buffer():
+    if app.config['LIKE_BUFFER_SECONDS']:
+        like_buffer.start()
+
+
+# New warbles are pushed to open home pages over /live (Server-Sent Events).
+# Set LIVE_REDIS_URL when running more than one process so they all share
+# the stream; otherwise each process only sees its own posts. A process
+# holds at most LIVE_MAX_CONNECTIONS streams (more get a 503) and closes each
+# after LIVE_MAX_SECONDS, when the browser reconnects.
+app.config['LIVE_REDIS_URL'] = os.environ.get('LIVE_REDIS_URL')
+app.config['LIVE_HEARTBEAT'] = int(os.environ.get('LIVE_HEARTBEAT', 15))
+app.config['LIVE_MAX_CONNECTIONS'] = int(os.environ.get('LIVE_MAX_CONNECTIONS', 50))
+app.config['LIVE_MAX_SECONDS'] = int(os.environ.get('LIVE_MAX_SECONDS', 5 * 60))
+live_events = Broker(RedisBackend.from_url(app.config['LIVE_REDIS_URL'])
+                     if app.config['LIVE_REDIS_URL'] else MemoryBackend())
+live_connections = ConnectionLimit(app.config['LIVE_MAX_CONNECTIONS'])
+
 connect_db(app)
+passwords.init_app(app)
 
 
 ##############################################################################
 # User signup/login/logout
 
-users = User.query.all()
-usernames = [user.username for user in users]
+usernames = UsernameIndex()
+current_users = UserCache(ttl=app.config['USER_CACHE_TTL'])
 
 @app.route('/autocomplete', methods=['GET'])
 def autocomplete():
-    return Response(json.dumps(usernames), mimetype='application/json')
+    """Usernames starting with the `term` param, as a JSON list."""
+
+    term = request.args.get('term', '').strip()
+    matches = usernames.search(term, app.config['AUTOCOMPLETE_LIMIT']) if term else []
+
+    not_modified = caching.not_modified('autocomplete', matches)
+    if not_modified:
+        not_modified.headers['Cache-Control'] = f"public, max-age={app.config['AUTOCOMPLETE_MAX_AGE']}"
+        return not_modified
+
+    response = Response(json.dumps(matches), mimetype='application/json')
+    response.headers['Cache-Control'] = f"public, max-age={app.config['AUTOCOMPLETE_MAX_AGE']}"
+    return response
 
 
 @app.before_request
@@ -42,11 +184,13 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = current_users.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
+    g.viewer = Viewer(g.user)
+
 
 def do_login(user):
     """Log in user."""
@@ -58,9 +202,38 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        current_users.invalidate(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
+@app.errorhandler(UserGone)
+def user_gone(e):
+    """The account went away mid-session (its snapshot was still cached):
+    log out and go on as a logged-out visitor."""
+
+    do_logout()
+    g.user = None
+
+    if request.blueprint == 'api':
+        return jsonify(error="Log in first."), 401
+
+    if request.method == 'GET':
+        return redirect(request.url)
+
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+@app.after_request
+def forget_changed_user(response):
+    """Anything but a GET may have changed the logged-in user's details."""
+
+    if request.method != 'GET' and g.get('user'):
+        current_users.invalidate(g.user.id)
+
+    return response
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -89,6 +262,8 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        usernames.add(user.username)
+
         do_login(user)
 
         return redirect("/")
@@ -108,6 +283,7 @@ def login():
                                  form.password.data)
 
         if user:
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}! success")
             return redirect("/")
@@ -136,32 +312,82 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results are ranked and paged with 'page'. Without 'q', users
+    are listed in signup order and paged with the 'after' user id.
     """
 
     search = request.args.get('q')
+    per_page = app.config['USERS_PER_PAGE']
+    next_url = None
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', 0, type=int)
+        users = (User
+                 .query
+                 .filter(User.id > after, User.deleted == db.false())
+                 .order_by(User.id)
+                 .limit(per_page + 1)
+                 .all())
+
+        if len(users) > per_page:
+            users = users[:per_page]
+            next_url = url_for('list_users', after=users[-1].id)
+
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, has_next = search_users(search, page, per_page)
+
+        if has_next:
+            next_url = url_for('list_users', q=search, page=page + 1)
+
+    g.viewer.preload(users=users)
+
+    return render_template('users/index.html', users=users, next_url=next_url)
+
+
+@app.route('/users/suggestions')
+def who_to_follow():
+    """The "who to follow" sidebar, as an HTML fragment the home page loads."""
+
+    if not g.user:
+        return Response(status=401)
+
+    suggestions = [recommendation.recommended_user for recommendation in
+                   eager(Recommendation.for_user(g.user.id, app.config['SUGGESTIONS_SHOWN']),
+                         Recommendation.recommended_user)]
 
-    return render_template('users/index.html', users=users)
+    response = app.make_response(render_template('users/suggestions.html',
+                                                 suggestions=suggestions))
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_or_404(user_id)
+    before = cursor_from_request()
+
+    not_modified = caching.not_modified('users_show', user.id, user.version, before,
+                                        app.config['MESSAGES_PER_PAGE'],
+                                        g.user and g.user.id, g.user and g.user.version)
+    if not_modified:
+        return not_modified
 
     if user.private and g.user:
-        messages = user.show_private_account_messages(g.user)
+        query = user.show_private_account_messages(g.user)
 
     else:
-        messages = user.show_messages()
+        query = user.show_messages()
+
+    messages, next_cursor = paginate(eager(query, Message.user), before,
+                                     app.config['MESSAGES_PER_PAGE'])
+    g.viewer.preload(users=[user], messages=messages)
 
-    return render_template('users/show.html', user=user, messages=messages, user_id=user_id)
+    return render_template('users/show.html', user=user, messages=messages, user_id=user_id,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -172,8 +398,10 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_or_404(user_id)
+    g.viewer.preload(users=[user])
+    following = preloaded(User.query.with_parent(user, User.following))
+    return stream_template('users/following.html', user=user, following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -184,8 +412,83 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_or_404(user_id)
+    g.viewer.preload(users=[user])
+    followers = preloaded(User.query.with_parent(user, User.followers))
+    return stream_template('users/followers.html', user=user, followers=followers)
+
+
+def add_follows(follower_id, followee_id):
+    """Add the Follows row and everything that goes with it (counters,
+    timeline backfill, suggestions). The caller commits."""
+
+    # `User.following` is the user_being_followed_id side of Follows
+    db.session.add(Follows(user_being_followed_id=follower_id, user_following_id=followee_id))
+    User.bump_counts(follower_id, following_count=1)
+    User.bump_counts(followee_id, followers_count=1)
+
+    if app.config['TIMELINE_FANOUT']:
+        jobs.enqueue('backfill_timeline', follower_id=follower_id, followee_id=followee_id)
+
+    jobs.enqueue('update_recommendations', follower_id=follower_id, followee_id=followee_id,
+                 followed=True)
+
+
+def follow(followee):
+    """Have the current user follow `followee`, or ask to if their account is
+    private. Returns the status: "Accepted" or "Pending".
+
+    Doing it again changes nothing. The caller commits.
+    """
+
+    if g.user.is_following(followee):
+        return "Accepted"
+
+    follow_request = FollowRequest.query.get((g.user.id, followee.id))
+
+    if follow_request is not None:
+        if follow_request.status == "Pending":
+            return "Pending"
+
+        # declined before; this is a new request
+        db.session.delete(follow_request)
+        db.session.flush()
+
+    if followee.private:
+        FollowRequest.send_request(g.user.id, followee.id, "Pending")
+        User.touch(followee.id)
+        return "Pending"
+
+    FollowRequest.send_request(g.user.id, followee.id, "Accepted")
+    add_follows(g.user.id, followee.id)
+    return "Accepted"
+
+
+def unfollow(followee):
+    """Undo `follow`, including a request still pending; returns whether
+    there was anything to undo. The caller commits."""
+
+    withdrawn = (FollowRequest.query
+                 .filter_by(user_requesting_id=g.user.id, user_requested_id=followee.id)
+                 .delete())
+    unfollowed = (Follows.query
+                  .filter_by(user_being_followed_id=g.user.id, user_following_id=followee.id)
+                  .delete())
+
+    if unfollowed:
+        User.bump_counts(g.user.id, following_count=-1)
+        User.bump_counts(followee.id, followers_count=-1)
+
+        if app.config['TIMELINE_FANOUT']:
+            TimelineEntry.prune(g.user.id, followee.id)
+
+        jobs.enqueue('update_recommendations', follower_id=g.user.id, followee_id=followee.id,
+                     followed=False)
+
+    elif withdrawn:
+        User.touch(followee.id)
+
+    return bool(withdrawn or unfollowed)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -196,16 +499,12 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get_or_404(follow_id)
+    followee = User.get_or_404(follow_id)
+    status = follow(followee)
+    db.session.commit()
 
-    if followee.private:
-        FollowRequest.send_request(g.user.id, follow_id, "Pending")
-        db.session.commit()
+    if status == "Pending":
         return redirect("/")
-    else:
-        FollowRequest.send_request(g.user.id, follow_id, "Accepted")
-        g.user.following.append(followee)
-        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -218,8 +517,8 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
+    followee = User.get_or_404(follow_id)
+    unfollow(followee)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -241,6 +540,8 @@ def profile():
         if authenticated:
 
             # form.populate_obj(user)
+            old_username = user.username
+            shown = (user.username, user.image_url, user.bio)
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
@@ -248,7 +549,11 @@ def profile():
             user.location = form.location.data
             user.bio = form.bio.data
             user.private = form.private.data
+            if (user.username, user.image_url, user.bio) != shown:
+                user.profile_version = User.profile_version + 1
+            User.touch(user.id)
             db.session.commit()
+            usernames.rename(old_username, user.username)
 
             return redirect(f"/users/{g.user.id}")
         
@@ -262,28 +567,82 @@ def profile():
 
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    Disables the account and logs them out straight away; the rows
+    themselves are removed by the `delete_user` background job.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    do_logout()
-    db.session.delete(g.user)
+    username = g.user.username
+    g.user.load().disable()
+    jobs.enqueue('delete_user', user_id=g.user.id)
     db.session.commit()
+
+    do_logout()
+    usernames.remove(username)
     return redirect("/signup")
 
 @app.route('/users/<int:user_id>/likes')
 def like_count(user_id):
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = User.get_or_404(user_id)
+    messages, next_cursor = paginate(eager(user.show_liked_messages(), Message.user),
+                                     cursor_from_request(),
+                                     app.config['MESSAGES_PER_PAGE'])
+    return render_template('users/likes.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 @app.route('/messages/direct-messages')
 def show_direct_messages():
+    """Show the current user's conversations, most recently active first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    conversations, next_cursor = paginate(
+        ConversationMember.inbox(g.user.id), cursor_from_request(),
+        app.config['MESSAGES_PER_PAGE'],
+        timestamp_col=ConversationMember.last_message_at,
+        id_col=ConversationMember.conversation_id,
+        key=lambda member: (member.last_message_at, member.conversation_id))
+
+    return render_template("users/direct-messages.html", conversations=conversations,
+                           next_cursor=next_cursor)
+
+
+@app.route('/messages/direct-messages/<int:user_id>')
+def show_conversation(user_id):
+    """Show the direct messages between the current user and another, and
+    mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    inbox = g.user.inbox
-    outbox = g.user.outbox
-    return render_template("users/direct-messages.html", inbox=inbox, outbox=outbox)
+    other_user = User.get_or_404(user_id)
+    conversation = Conversation.between(g.user.id, user_id, create=False)
+
+    if conversation is None:
+        return redirect(f"/messages/direct-message/new/{user_id}")
+
+    messages, next_cursor = paginate(eager(conversation.messages(), DirectMessage.sent_from_user),
+                                     cursor_from_request(),
+                                     app.config['MESSAGES_PER_PAGE'],
+                                     timestamp_col=DirectMessage.timestamp,
+                                     id_col=DirectMessage.id)
+
+    if ConversationMember.mark_read(g.user.id, conversation.id):
+        User.touch(g.user.id)
+        db.session.commit()
+        current_users.invalidate(g.user.id)
+
+    return render_template("messages/conversation.html", other_user=other_user,
+                           messages=messages, next_cursor=next_cursor,
+                           form=DirectMessageForm())
 
 @app.route('/requests')
 def show_friend_requests():
@@ -296,34 +655,201 @@ def show_friend_requests():
     return render_template("users/requests.html", requests=pending_requests, sent_requests=sent_requests)
 
 
+def answer_follow_request(follower_id, accept):
+    """Accept or decline `follower_id`'s pending request to follow the current
+    user; returns False if there is no such request. The caller commits."""
+
+    follow_request = (FollowRequest.query
+                      .filter_by(user_requested_id=g.user.id, user_requesting_id=follower_id,
+                                 status="Pending")
+                      .first())
+
+    if follow_request is None:
+        return False
+
+    if accept:
+        follow_request.status = "Accepted"
+        add_follows(follower_id, g.user.id)
+    else:
+        follow_request.status = "Declined"
+        User.touch(g.user.id)
+
+    return True
+
+
 @app.route('/requests/accept/<int:id>', methods=["POST"])
 def accept_friend_request(id):
 
-    follower = User.query.get(id)
-    request = FollowRequest.query.filter_by(user_requested_id=g.user.id, user_requesting_id=id).first()
-    request.status = "Accepted"
+    if not answer_follow_request(id, accept=True):
+        abort(404)
 
-    new_following = g.user.followers.append(follower)
     db.session.commit()
     return redirect(f'/users/{g.user.id}/followers')
 
 
 @app.route('/requests/decline/<int:id>', methods=["POST"])
 def decline_friend_request(id):
-    request = FollowRequest.query.filter_by(user_requested_id=g.user.id, user_requesting_id=id).first()
-    request.status = "Declined"
+
+    if not answer_follow_request(id, accept=False):
+        abort(404)
+
     db.session.commit()
     return redirect(f'/users/{g.user.id}/followers')
 
 @app.route('/requests/cancel/<int:id>', methods=["POST"])
 def cancel_friend_request(id):
     request = FollowRequest.query.filter_by(user_requested_id=id, user_requesting_id=g.user.id).delete()
+    User.touch(id)
     db.session.commit()
     return redirect(f'/users/{g.user.id}/followers')
 
 ##############################################################################
 # Messages routes:
 
+def without_hidden_authors(query):
+    """`query` of messages, less those by private accounts the viewer can't see."""
+
+    hidden = db.session.query(User.id).filter(User.private == db.true())
+
+    if g.user:
+        followed = (db.session
+                    .query(Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == g.user.id))
+        hidden = hidden.filter(User.id != g.user.id, ~User.id.in_(followed))
+
+    return query.filter(~Message.user_id.in_(hidden))
+
+
+def visible(user):
+    """Whether the viewer may see the messages of `user` (anything with .id
+    and .private).
+
+    Only a private account's followers (and the account itself) may.
+    """
+
+    return not user.private or bool(g.user and (g.user.id == user.id or
+                                                Follows.query.get((g.user.id, user.id))))
+
+
+def require_visible(user):
+    """403 unless the viewer may see `user`'s messages."""
+
+    if not visible(user):
+        abort(403, "This account is private.")
+
+
+def message_author(msg_id):
+    """(id, private) of a message's author, or None if there's no such message."""
+
+    return (db.session
+            .query(User.id, User.private)
+            .join(Message, Message.user_id == User.id)
+            .filter(Message.id == msg_id)
+            .first())
+
+
+def publish_message(msg):
+    """Push a newly committed message to /live subscribers.
+
+    Sends its card both with a like button (for followers) and without (for
+    the author's other tabs). A failure here mustn't fail the post itself.
+    """
+
+    try:
+        live_events.publish({
+            'message_id': msg.id,
+            'user_id': msg.user_id,
+            'html': render_template('messages/_card.html', message=msg,
+                                    show_like=True, liked=False),
+            'own_html': render_template('messages/_card.html', message=msg,
+                                        show_like=False),
+        })
+    except Exception:
+        app.logger.exception("Couldn't publish message %s", msg.id)
+
+
+@app.route('/live')
+def live():
+    """New messages from followed users, as Server-Sent Events.
+
+    Browsers reconnect with a Last-Event-ID header and get what they missed.
+    Streams end after LIVE_MAX_SECONDS so that happens regularly; past
+    LIVE_MAX_CONNECTIONS open ones, 503 until one frees up.
+    """
+
+    if not g.user:
+        return Response(status=401)
+
+    user_id = g.user.id
+    authors = {user_id}
+    authors.update(followee_id for (followee_id,) in
+                   db.session.query(Follows.user_following_id)
+                   .filter(Follows.user_being_followed_id == user_id))
+
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    heartbeat = app.config['LIVE_HEARTBEAT']
+
+    if not live_connections.acquire():
+        return Response(format_sse(retry=heartbeat * 2000), status=503,
+                        mimetype='text/event-stream',
+                        headers={'Retry-After': str(heartbeat * 2)})
+
+    closes_at = time.monotonic() + app.config['LIVE_MAX_SECONDS']
+
+    def events():
+        # Runs after the request (and its database session) has ended, so it
+        # only touches what was read above
+        yield format_sse(retry=3000)
+        last_sent = time.monotonic()
+        seen_id = None
+        subscription = live_events.subscribe(last_id, heartbeat)
+
+        while time.monotonic() < closes_at:
+            item = next(subscription)
+
+            if item is not None:
+                seen_id = item[0]
+
+            if item is not None and item[1]['user_id'] in authors:
+                event_id, event = item
+                html = event['own_html'] if event['user_id'] == user_id else event['html']
+                yield format_sse(json.dumps({'id': event['message_id'], 'html': html}),
+                                 event='message', id=event_id)
+                last_sent = time.monotonic()
+
+            elif time.monotonic() - last_sent >= heartbeat:
+                yield format_sse(comment='heartbeat')
+                last_sent = time.monotonic()
+
+        # so the reconnect doesn't go over events this stream skipped
+        if seen_id is not None:
+            yield format_sse(id=seen_id)
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(live_connections.release)
+    return response
+
+
+def post_message(text):
+    """Post a message as the current user and commit it."""
+
+    msg = Message(text=text, user_id=g.user.id)
+    db.session.add(msg)
+    User.bump_counts(g.user.id, messages_count=1)
+
+    if app.config['TIMELINE_FANOUT']:
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        jobs.enqueue('trim_timelines', author_id=g.user.id)
+
+    db.session.commit()
+    trending.record_post(msg.id)
+    publish_message(msg)
+
+    return msg
+
+
 @app.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
@@ -338,10 +864,7 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
+        post_message(form.text.data)
         return redirect(f"/")
 
     return render_template('messages/new.html', form=form)
@@ -351,10 +874,40 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = eager(Message.query, Message.user).filter(Message.id == message_id).first_or_404()
+
+    not_modified = caching.not_modified('messages_show', msg.id, msg.user.version,
+                                        g.user and g.user.id, g.user and g.user.version)
+    if not_modified:
+        return not_modified
+
+    g.viewer.preload(users=[msg.user], messages=[msg])
     return render_template('messages/show.html', message=msg)
 
 
+@app.route('/trending')
+def trending_messages():
+    """The messages being liked fastest right now (see trending.py)."""
+
+    # normally the background thread ranks them before anyone asks
+    if trending.top is None:
+        trending.refresh()
+
+    not_modified = caching.not_modified('trending', trending.refreshed_at,
+                                        g.user and g.user.id, g.user and g.user.version)
+    if not_modified:
+        return not_modified
+
+    ranks = {message_id: rank for rank, (message_id, _) in enumerate(trending.top)}
+    query = without_hidden_authors(eager(Message.query, Message.user).filter(Message.id.in_(ranks)))
+    messages = sorted(query, key=lambda message: ranks[message.id])
+
+    g.viewer.preload(messages=messages)
+    return render_template('messages/trending.html', messages=messages,
+                           likes=trending.likes, posts=trending.posts,
+                           hours=app.config['TRENDING_WINDOW'] // 60)
+
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
@@ -364,6 +917,11 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+
+    # the database cascades the likes away with the message
+    User.bump_counts(msg.user_id, messages_count=-1)
+    User.bump_counts([user.id for user in msg.liked_users], likes_count=-1)
+
     db.session.delete(msg)
     db.session.commit()
 
@@ -372,89 +930,603 @@ def messages_destroy(message_id):
 
 @app.route('/messages/<int:msg_id>/like/add', methods=["POST"])
 def add_like(msg_id):
-    """ If user clicks button check if message exists in liked message table. if a exists, remove from db. Else add to db"""
+    """Toggle the current user's like of a message (for browsers without JS)."""
+
+    author = message_author(msg_id)
+
+    if author is None:
+        abort(404)
+
+    require_visible(author)
+    set_like(msg_id, not liked_now(msg_id))
 
-    message_exists = LikedMessage.query.filter_by(message_id=msg_id, user_id=g.user.id).first()
-    
-    if message_exists:
-        db.session.delete(message_exists)
-    
-    else:
-        new_messsage = LikedMessage(message_id=msg_id, user_id=g.user.id)
-        db.session.add(new_messsage)
-    
-    db.session.commit()
     return redirect('/')
 
+
+def liked_now(msg_id):
+    """Whether the current user likes the message, counting a buffered change."""
+
+    pending = like_buffer.get(g.user.id, msg_id)
+    if pending is not None:
+        return pending
+
+    return LikedMessage.query.get((msg_id, g.user.id)) is not None
+
+
+def set_like(msg_id, liked):
+    """Make the current user like the message (or not) and commit; returns
+    its like count, or None if there is no such message.
+
+    With LIKE_BUFFER_SECONDS set the write is buffered, and the count only
+    reflects this user's change.
+    """
+
+    def likes_count():
+        return db.session.query(Message.likes_count).filter(Message.id == msg_id).scalar()
+
+    if likes_count() is None:
+        return None
+
+    if app.config['LIKE_BUFFER_SECONDS']:
+        stored = LikedMessage.query.get((msg_id, g.user.id)) is not None
+        pending = like_buffer.get(g.user.id, msg_id)
+        before = stored if pending is None else pending
+        like_buffer.set(g.user.id, msg_id, liked)
+        likes = likes_count() + liked - stored
+
+    else:
+        if liked:
+            changed = LikedMessage.like(g.user.id, msg_id)
+        else:
+            changed = LikedMessage.unlike(g.user.id, msg_id)
+
+        db.session.commit()
+        before = liked != changed
+        likes = likes_count()
+
+    if liked != before:
+        trending.record_like(msg_id, 1 if liked else -1)
+
+    return likes
+
+
+@app.route('/messages/<int:msg_id>/like', methods=["PUT", "DELETE"])
+def like_api(msg_id):
+    """Like (PUT) or unlike (DELETE) a message, as JSON.
+
+    Idempotent: repeating a request changes nothing. Responds with the new
+    state and the message's like count.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    author = message_author(msg_id)
+
+    if author is None:
+        return jsonify(error="No such message."), 404
+
+    if not visible(author):
+        return jsonify(error="This account is private."), 403
+
+    liked = request.method == 'PUT'
+    likes = set_like(msg_id, liked)
+
+    if likes is None:
+        return jsonify(error="No such message."), 404
+
+    return jsonify(message_id=msg_id, liked=liked, likes=likes)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
+def timeline(user_id):
+    """Query of the messages on `user_id`'s home feed, and the timestamp and
+    id columns to page it by."""
+
+    if app.config['TIMELINE_FANOUT']:
+        return TimelineEntry.messages_for(user_id), TimelineEntry.timestamp, TimelineEntry.message_id
+
+    # ids of everyone the user is following (`User.following` is the
+    # user_being_followed_id side of Follows)
+    user_following = (db.session
+                      .query(Follows.user_following_id)
+                      .filter(Follows.user_being_followed_id == user_id))
+
+    # grabs all messages for user and user following
+    query = (Message
+             .query
+             .filter(or_(Message.user_id.in_(user_following.subquery()),
+                         Message.user_id == user_id)))
+    return query, Message.timestamp, Message.id
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees, a page at a time
+      (pass the `before` cursor from the previous page to go further back)
     """
  
 
     if g.user:
-        print(f'USER#########: {g.user.pending_friend_requests}')
         form = MessageForm()
 
-        # grabs all users' ids the user is following
-        user_following = [user.id for user in g.user.following]
-
-        # grabs all messages for user and user following
-        messages = (Message
-                    .query
-                    .filter(or_(Message.user_id.in_(user_following), Message.user_id==g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        query, timestamp_col, id_col = timeline(g.user.id)
+        messages, next_cursor = paginate(eager(query, Message.user), cursor_from_request(),
+                                         app.config['MESSAGES_PER_PAGE'], timestamp_col, id_col)
+        g.viewer.preload(messages=messages)
 
-        return render_template('home.html', messages=messages, form=form)
+        return render_template('home.html', messages=messages, form=form, next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
-
 @app.route('/messages/direct-message/new/<int:message_to_user_id>', methods=["GET", "POST"])
 def direct_messsage(message_to_user_id):
     form = DirectMessageForm()
     if form.validate_on_submit():
-        msg_text = request.form.get("message")
-        new_direct_msg = DirectMessage(
-            text=form.text.data,
-            user_from_id=g.user.id,
-            user_to_id=message_to_user_id
-        )
-        db.session.add(new_direct_msg)
+        DirectMessage.send(g.user.id, message_to_user_id, form.text.data)
+        User.touch(message_to_user_id)
         db.session.commit()
-        return redirect(f"/users/{g.user.id}")
+        return redirect(f"/messages/direct-messages/{message_to_user_id}")
     else:
         return render_template('/messages/new_direct_message.html', form=form)
 
+##############################################################################
+# JSON API (/api/v1, see api.py)
+#
+# The site's timelines, profiles, follows, likes, requests and direct
+# messages for apps and scripts. Log in with POST /api/v1/session; the
+# session cookie it sets authenticates the rest, as on the site.
+
+def require_user():
+    if not g.user:
+        abort(401, "Log in first.")
+
+
+def user_or_404(user_id):
+    """(id, private) of a user, without loading the rest of the row."""
+
+    user = (db.session
+            .query(User.id, User.private)
+            .filter(User.id == user_id, User.deleted == db.false())
+            .first())
+
+    if user is None:
+        abort(404)
+
+    return user
+
+
+@api.route('/session', methods=['POST'])
+def api_login():
+    """Log in with {"username": ..., "password": ...}; responds with the profile."""
+
+    form = submitted(LoginForm)
+    user = User.authenticate(form.username.data, form.password.data)
+
+    if not user:
+        abort(401, "Invalid credentials.")
+
+    db.session.commit()
+    do_login(user)
+    return respond(PROFILE_FIELDS.one(User.query.filter(User.id == user.id)))
+
+
+@api.route('/session', methods=['DELETE'])
+def api_logout():
+    do_logout()
+    return Response(status=204)
+
+
+@api.route('/timeline')
+def api_timeline():
+    """The current user's home feed."""
+
+    require_user()
+    query, timestamp_col, id_col = timeline(g.user.id)
+    return respond(page(MESSAGE_FIELDS, query, app.config['MESSAGES_PER_PAGE'],
+                        id_col, timestamp_col))
+
+
+@api.route('/messages', methods=['POST'])
+def api_post_message():
+    """Post {"text": ...} as the current user."""
+
+    require_user()
+    msg = post_message(submitted(MessageForm).text.data)
+    return respond(MESSAGE_FIELDS.one(Message.query.filter(Message.id == msg.id)), 201)
+
+
+@api.route('/messages/<int:message_id>')
+def api_message(message_id):
+    """One message; only their followers may see a private account's."""
+
+    author = message_author(message_id)
+
+    if author is None:
+        abort(404)
+
+    require_visible(author)
+    return respond(MESSAGE_FIELDS.one(Message.query.filter(Message.id == message_id)))
+
+
+@api.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def api_like(message_id):
+    """Like (PUT) or unlike (DELETE) a message; responds with its like count."""
+
+    require_user()
+    author = message_author(message_id)
+
+    if author is None:
+        abort(404)
+
+    require_visible(author)
+    liked = request.method == 'PUT'
+    likes = set_like(message_id, liked)
+
+    if likes is None:
+        abort(404)
+
+    return respond({'message_id': message_id, 'liked': liked, 'likes': likes})
+
+
+@api.route('/users/<int:user_id>')
+def api_user(user_id):
+    return respond(PROFILE_FIELDS.one(User.query.filter(User.id == user_id,
+                                                        User.deleted == db.false())))
+
+
+@api.route('/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages; only their followers may see a private account's."""
+
+    user = user_or_404(user_id)
+    require_visible(user)
+
+    query = Message.query.filter(Message.user_id == user.id)
+    return respond(page(MESSAGE_FIELDS, query, app.config['MESSAGES_PER_PAGE'],
+                        Message.id, Message.timestamp))
+
+
+@api.route('/users/<int:user_id>/likes')
+def api_user_likes(user_id):
+    """The messages a user has liked, that the viewer may see."""
+
+    user = user_or_404(user_id)
+    query = without_hidden_authors(Message
+                                   .query
+                                   .join(LikedMessage, LikedMessage.message_id == Message.id)
+                                   .filter(LikedMessage.user_id == user.id))
+    return respond(page(MESSAGE_FIELDS, query, app.config['MESSAGES_PER_PAGE'],
+                        Message.id, Message.timestamp))
+
+
+@api.route('/users/<int:user_id>/following')
+def api_following(user_id):
+    """The users this user follows."""
+
+    require_user()
+    user = user_or_404(user_id)
+
+    # `User.following` is the user_being_followed_id side of Follows
+    query = (User
+             .query
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user.id))
+    return respond(page(USER_FIELDS, query, app.config['USERS_PER_PAGE'], User.id))
+
+
+@api.route('/users/<int:user_id>/followers')
+def api_followers(user_id):
+    """The users following this user."""
+
+    require_user()
+    user = user_or_404(user_id)
+
+    query = (User
+             .query
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user.id))
+    return respond(page(USER_FIELDS, query, app.config['USERS_PER_PAGE'], User.id))
+
+
+@api.route('/users/<int:user_id>/follow', methods=['PUT', 'DELETE'])
+def api_follow(user_id):
+    """Follow (PUT) or unfollow (DELETE) a user, or withdraw a request to.
+
+    Responds with the status: "following", "requested" (private accounts
+    have to accept first) or "not_following".
+    """
+
+    require_user()
+    followee = User.get_or_404(user_id)
+
+    if followee.id == g.user.id:
+        abort(400, "You can't follow yourself.")
+
+    if request.method == 'PUT':
+        status = {"Accepted": "following", "Pending": "requested"}[follow(followee)]
+    else:
+        unfollow(followee)
+        status = "not_following"
+
+    db.session.commit()
+    return respond({'user_id': user_id, 'status': status})
+
+
+@api.route('/requests')
+def api_requests():
+    """The users asking to follow the current user."""
+
+    require_user()
+    query = (User
+             .query
+             .join(FollowRequest, FollowRequest.user_requesting_id == User.id)
+             .filter(FollowRequest.user_requested_id == g.user.id,
+                     FollowRequest.status == "Pending"))
+    return respond(page(USER_FIELDS, query, app.config['USERS_PER_PAGE'], User.id))
+
+
+@api.route('/requests/sent')
+def api_sent_requests():
+    """The users the current user is waiting on; withdraw with DELETE
+    /users/<id>/follow."""
+
+    require_user()
+    query = (User
+             .query
+             .join(FollowRequest, FollowRequest.user_requested_id == User.id)
+             .filter(FollowRequest.user_requesting_id == g.user.id,
+                     FollowRequest.status == "Pending"))
+    return respond(page(USER_FIELDS, query, app.config['USERS_PER_PAGE'], User.id))
+
+
+@api.route('/requests/<int:user_id>', methods=['PUT', 'DELETE'])
+def api_answer_request(user_id):
+    """Accept (PUT) or decline (DELETE) a user's request to follow the current user."""
+
+    require_user()
+    accept = request.method == 'PUT'
+
+    if not answer_follow_request(user_id, accept):
+        abort(404)
+
+    db.session.commit()
+    return respond({'user_id': user_id, 'status': "Accepted" if accept else "Declined"})
+
+
+@api.route('/conversations')
+def api_conversations():
+    """The current user's conversations, most recently active first."""
+
+    require_user()
+    query = ConversationMember.query.filter(ConversationMember.user_id == g.user.id)
+    return respond(page(CONVERSATION_FIELDS, query, app.config['MESSAGES_PER_PAGE'],
+                        ConversationMember.conversation_id, ConversationMember.last_message_at))
+
+
+@api.route('/conversations/<int:user_id>')
+def api_conversation(user_id):
+    """The direct messages with a user, newest first; marks them read."""
+
+    require_user()
+    conversation = Conversation.between(g.user.id, user_id, create=False)
+
+    if conversation is None:
+        abort(404)
+
+    data = page(DIRECT_MESSAGE_FIELDS, conversation.messages(), app.config['MESSAGES_PER_PAGE'],
+                DirectMessage.id, DirectMessage.timestamp)
+
+    if ConversationMember.mark_read(g.user.id, conversation.id):
+        User.touch(g.user.id)
+        db.session.commit()
+        current_users.invalidate(g.user.id)
+
+    return respond(data)
+
+
+@api.route('/conversations/<int:user_id>', methods=['POST'])
+def api_send_direct_message(user_id):
+    """Send {"text": ...} to a user."""
+
+    require_user()
+    form = submitted(DirectMessageForm)
+    user = user_or_404(user_id)
+
+    message = DirectMessage.send(g.user.id, user.id, form.text.data)
+    User.touch(user.id)
+    db.session.commit()
+
+    return respond(DIRECT_MESSAGE_FIELDS.one(DirectMessage.query.filter(DirectMessage.id == message.id)),
+                   201)
+
+
+app.register_blueprint(api)
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """Add any tables, columns and indexes the database is missing."""
+
+    migrations.upgrade()
+
+
+# users whose timelines `flask rebuild-timelines` commits together
+TIMELINE_REBUILD_BATCH = 500
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's precomputed home timeline.
+
+    Commits a batch of users at a time, so a big rebuild neither holds one
+    huge transaction nor loses everything done so far if it stops.
+    """
+
+    last_id = 0
+
+    while True:
+        users = (eager(User.query, User.following)
+                 .filter(User.id > last_id)
+                 .order_by(User.id)
+                 .limit(TIMELINE_REBUILD_BATCH)
+                 .all())
+
+        if not users:
+            break
+
+        for user in users:
+            TimelineEntry.rebuild(user)
+
+        last_id = users[-1].id
+        db.session.commit()
+
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations():
+    """Group direct messages from before conversations into conversations."""
+
+    Conversation.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Queue a recount of every user's and message's counters."""
+
+    jobs.enqueue('repair_counters')
+    db.session.commit()
+    print("Queued; `flask worker` will run it.")
+
+
+@app.cli.command('recompute-recommendations')
+def recompute_recommendations():
+    """Queue a recomputation of everyone's "who to follow" suggestions.
+
+    It then repeats every RECOMMENDATIONS_INTERVAL seconds.
+    """
+
+    jobs.enqueue('recompute_recommendations')
+    db.session.commit()
+    print("Queued; `flask worker` will run it.")
+
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True, help="Exit once no jobs are due.")
+@click.option('--poll-interval', default=1.0, help="Seconds to wait when idle.")
+def worker(once, poll_interval):
+    """Run queued background jobs."""
+
+    jobs.work(poll_interval=poll_interval,
+              visibility_timeout=app.config['JOB_VISIBILITY_TIMEOUT'],
+              once=once)
+
+
+##############################################################################
+# Background jobs (see jobs.py)
+
+@jobs.task('delete_user')
+def delete_user_job(user_id):
+    """Delete a user and fix up the counters of everyone they touched."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        return
+
+    # the database cascades away this user's follows and the likes on their
+    # messages, so fix up the counters of everyone on the other end
+    User.bump_counts([followee.id for followee in user.following], followers_count=-1)
+    User.bump_counts([follower.id for follower in user.followers], following_count=-1)
+    likers = (db.session
+              .query(LikedMessage.user_id, db.func.count())
+              .join(Message, Message.id == LikedMessage.message_id)
+              .filter(Message.user_id == user.id)
+              .group_by(LikedMessage.user_id))
+
+    # one UPDATE per distinct count, not per liker
+    likers_by_count = defaultdict(list)
+    for liker_id, likes in likers:
+        likers_by_count[likes].append(liker_id)
+    for likes, liker_ids in likers_by_count.items():
+        User.bump_counts(liker_ids, likes_count=-likes)
+
+    liked_ids = [message_id for (message_id,) in
+                 db.session.query(LikedMessage.message_id).filter(LikedMessage.user_id == user.id)]
+
+    db.session.delete(user)
+    db.session.flush()
+
+    if liked_ids:
+        Message.recount(liked_ids)
+
+
+@jobs.task('backfill_timeline')
+def backfill_timeline_job(follower_id, followee_id):
+    """Copy a newly followed user's messages into the follower's timeline."""
+
+    # they may have unfollowed again before this ran
+    if Follows.query.get((follower_id, followee_id)) is not None:
+        TimelineEntry.backfill(follower_id, followee_id)
+
+
+@jobs.task('trim_timelines')
+def trim_timelines_job(author_id):
+    """Trim the timelines a new message by `author_id` was pushed onto."""
+
+    TimelineEntry.trim(TimelineEntry.audience(author_id))
+
+
+@jobs.task('update_recommendations')
+def update_recommendations_job(follower_id, followee_id, followed):
+    """Adjust the follower's suggestions after a follow or unfollow."""
+
+    # they may have changed their mind before this ran
+    follows = Follows.query.get((follower_id, followee_id)) is not None
+
+    if followed and follows:
+        Recommendation.followed(follower_id, followee_id,
+                                keep=app.config['RECOMMENDATIONS_PER_USER'])
+    elif not followed and not follows:
+        Recommendation.unfollowed(follower_id, followee_id)
+
+
+@jobs.task('recompute_recommendations')
+def recompute_recommendations_job():
+    """Recompute all suggestions, then queue the next run."""
+
+    recommendations.recompute(k=app.config['RECOMMENDATIONS_PER_USER'])
+
+    interval = app.config['RECOMMENDATIONS_INTERVAL']
+    queued = Job.query.filter_by(name='recompute_recommendations', status='queued').count()
+
+    if interval and not queued:
+        jobs.enqueue('recompute_recommendations',
+                     run_at=datetime.utcnow() + timedelta(seconds=interval))
+
+
+@jobs.task('repair_counters')
+def repair_counters_job():
+    User.recount()
+    Message.recount()
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
     return render_template('404.html'), 404
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Shed load when too many logins/signups are already queued."""
+
+    return "Too many people are logging in right now. Please try again in a moment.", 503, {'Retry-After': '1'}
@@ -0,0 +1,81 @@
+"""Prefix index over usernames for the search box autocomplete."""
+
+from bisect import bisect_left, insort
+from threading import Lock
+import time
+
+from models import db, User
+
+
+class UsernameIndex:
+    """Sorted array of usernames searched by prefix with bisect.
+
+    The index is loaded lazily on first use and kept current in this process
+    by `add`/`rename`/`remove`. Other worker processes can't tell us about
+    their signups and renames, so the whole index is also reloaded once it is
+    older than `max_age` seconds.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._entries = None
+        self._loaded_at = 0
+        self._lock = Lock()
+
+    def _load(self):
+        """(Re)build the index if it hasn't been built or has gone stale."""
+
+        if self._entries is not None and time.monotonic() - self._loaded_at < self.max_age:
+            return
+
+        usernames = [username for (username,) in
+                     db.session.query(User.username).filter(User.deleted == db.false())]
+        self._entries = sorted((username.lower(), username) for username in usernames)
+        self._loaded_at = time.monotonic()
+
+    def search(self, prefix, limit=10):
+        """Return up to `limit` usernames starting with `prefix` (any case)."""
+
+        prefix = prefix.lower()
+
+        with self._lock:
+            self._load()
+            start = bisect_left(self._entries, (prefix,))
+            matches = []
+
+            for key, username in self._entries[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                matches.append(username)
+
+        return matches
+
+    def clear(self):
+        """Forget the index so the next search reloads it."""
+
+        with self._lock:
+            self._entries = None
+
+    def add(self, username):
+        """Add a new username to the index."""
+
+        with self._lock:
+            if self._entries is not None:
+                insort(self._entries, (username.lower(), username))
+
+    def remove(self, username):
+        """Take a username out of the index."""
+
+        with self._lock:
+            if self._entries is not None:
+                entry = (username.lower(), username)
+                i = bisect_left(self._entries, entry)
+                if i < len(self._entries) and self._entries[i] == entry:
+                    del self._entries[i]
+
+    def rename(self, old_username, new_username):
+        """Swap a user's old username for their new one."""
+
+        if old_username != new_username:
+            self.remove(old_username)
+            self.add(new_username)
@@ -0,0 +1,359 @@
+"""Load-test and benchmark the Flask routes.
+
+Seeds a scaled dataset, then drives the real routes either in-process
+through the Flask test client or over HTTP through a local WSGI server,
+and reports p50/p95/p99 latency, SQL queries per request and requests/s
+for each route.
+
+    python benchmark.py --seed-data --scale 1          # generate + load data
+    python benchmark.py --save baseline.json           # record a baseline
+    python benchmark.py --compare baseline.json        # exit 1 on regression
+    python benchmark.py --server --concurrency 8       # over HTTP, 8 clients
+
+Runs against BENCH_DATABASE_URL (default postgresql:///warbler-bench), never
+the development database.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.cookiejar
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# BEFORE we import our app, point it at the benchmark database
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, FollowRequest
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Everyone the generator makes has this password
+PASSWORD = 'password'
+
+SERVER_TIMING_QUERIES = re.compile(r'"(\d+) queries"')
+
+
+##############################################################################
+# Scenarios: each picks its next request from the dataset
+
+class Dataset:
+    """Ids to aim requests at, sampled once from the seeded database."""
+
+    def __init__(self, rng, sample_size=1000):
+        with app.app_context():
+            user_count = User.query.count()
+            message_count = Message.query.count()
+
+            self.user_ids = [id for (id,) in db.session.query(User.id)
+                             .order_by(db.func.random()).limit(sample_size)]
+            self.message_ids = [id for (id,) in db.session.query(Message.id)
+                                .order_by(db.func.random()).limit(sample_size)]
+            self.usernames = [username for (username,) in db.session.query(User.username)
+                              .filter(User.id.in_(self.user_ids))]
+            self.public_user_ids = [id for (id,) in db.session.query(User.id)
+                                    .filter(User.id.in_(self.user_ids), User.private == db.false())]
+
+        if not self.user_ids or not self.message_ids:
+            sys.exit("The benchmark database is empty; run with --seed-data first.")
+
+        self.rng = rng
+        self.user_count = user_count
+        self.message_count = message_count
+        self._followed = {}
+
+    def user_id(self):
+        return self.rng.choice(self.user_ids)
+
+    def message_id(self):
+        return self.rng.choice(self.message_ids)
+
+    def prefix(self, length):
+        return self.rng.choice(self.usernames)[:length]
+
+    def followee(self, user_id):
+        """A public user `user_id` doesn't follow or ask to follow, or None.
+
+        Following them and then unfollowing really does both, and leaves
+        things as they were.
+        """
+
+        if user_id not in self._followed:
+            with app.app_context():
+                followed = {id for (id,) in db.session.query(Follows.user_following_id)
+                            .filter(Follows.user_being_followed_id == user_id)}
+                followed.update(id for (id,) in db.session.query(FollowRequest.user_requested_id)
+                                .filter(FollowRequest.user_requesting_id == user_id))
+            self._followed[user_id] = followed | {user_id}
+
+        candidates = [id for id in self.public_user_ids if id not in self._followed[user_id]]
+        return self.rng.choice(candidates) if candidates else None
+
+
+def scenarios(data):
+    """(name, method, path, form data) generators for every route we time.
+
+    Each is called with the id of the user sending the requests and returns
+    a list of them; follow returns the follow and the unfollow together so
+    the dataset ends the run as it started.
+    """
+
+    def follow(user_id):
+        followee = data.followee(user_id)
+        if followee is None:
+            return []
+
+        return [('POST', f'/users/follow/{followee}', None),
+                ('POST', f'/users/stop-following/{followee}', None)]
+
+    return {
+        'home': lambda user_id: [('GET', '/', None)],
+        'profile': lambda user_id: [('GET', f'/users/{data.user_id()}', None)],
+        'search': lambda user_id: [('GET', f'/users?q={urllib.parse.quote(data.prefix(4))}', None)],
+        'autocomplete': lambda user_id: [('GET', f'/autocomplete?term={urllib.parse.quote(data.prefix(2))}', None)],
+        'post': lambda user_id: [('POST', '/messages/new', {'text': 'Benchmarking, please ignore.'})],
+        'like': lambda user_id: [('POST', f'/messages/{data.message_id()}/like/add', None)] * 2,
+        'follow': follow,
+        'requests': lambda user_id: [('GET', '/requests', None)],
+    }
+
+
+##############################################################################
+# Clients: the Flask test client, or HTTP against a local WSGI server
+
+class TestClient:
+    """Sends requests in-process through Flask's test client."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def send(self, method, path, data):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+
+class HTTPClient:
+    """Sends requests over HTTP with its own logged-in cookie jar."""
+
+    def __init__(self, base_url, user_id, username):
+        self.user_id = user_id
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirects)
+        self.send('POST', '/login', {'username': username, 'password': PASSWORD})
+
+    def send(self, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing', '')
+
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('Server-Timing', '')
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Time the POST itself, not the page it redirects to."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def start_server():
+    """Serve the app from a background thread; returns its base URL."""
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+##############################################################################
+# Running and reporting
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return 0.0
+
+    rank = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(timings, wall_seconds):
+    """Stats for one scenario from its (ms, queries, status) timings."""
+
+    latencies = sorted(ms for ms, queries, status in timings)
+    count = len(timings) or 1
+
+    return dict(
+        requests=len(timings),
+        errors=sum(1 for ms, queries, status in timings if status >= 500),
+        p50_ms=round(percentile(latencies, 0.50), 2),
+        p95_ms=round(percentile(latencies, 0.95), 2),
+        p99_ms=round(percentile(latencies, 0.99), 2),
+        mean_ms=round(sum(latencies) / count, 2),
+        queries_per_request=round(sum(q for ms, q, status in timings) / count, 2),
+        requests_per_second=round(len(timings) / wall_seconds, 1),
+    )
+
+
+def run_scenario(clients, make_requests, count):
+    """Send `count` rounds of requests spread over the clients."""
+
+    timings = []
+    lock = threading.Lock()
+
+    def worker(client, rounds):
+        for _ in range(rounds):
+            for method, path, data in make_requests(client.user_id):
+                started = time.perf_counter()
+                status, server_timing = client.send(method, path, data)
+                ms = (time.perf_counter() - started) * 1000
+
+                queries = SERVER_TIMING_QUERIES.search(server_timing)
+                with lock:
+                    timings.append((ms, int(queries.group(1)) if queries else 0, status))
+
+    rounds = [count // len(clients) + (i < count % len(clients)) for i in range(len(clients))]
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(len(clients)) as pool:
+        list(pool.map(worker, clients, rounds))
+
+    return summarize(timings, time.perf_counter() - started)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    data = Dataset(rng)
+    user_ids = rng.sample(data.user_ids, min(args.concurrency, len(data.user_ids)))
+
+    if args.server:
+        base_url = start_server()
+        with app.app_context():
+            usernames = {id: username for id, username
+                         in db.session.query(User.id, User.username).filter(User.id.in_(user_ids))}
+        clients = [HTTPClient(base_url, id, usernames[id]) for id in user_ids]
+    else:
+        clients = [TestClient(id) for id in user_ids]
+
+    results = dict(meta=dict(
+        mode='server' if args.server else 'test-client',
+        concurrency=len(clients),
+        users=data.user_count,
+        messages=data.message_count,
+    ), routes={})
+
+    for name, make_requests in scenarios(data).items():
+        if args.routes and name not in args.routes:
+            continue
+
+        # warm caches and connections before timing
+        run_scenario(clients, make_requests, min(args.warmup, args.requests))
+        results['routes'][name] = stats = run_scenario(clients, make_requests, args.requests)
+
+        print(f"{name:<13} p50 {stats['p50_ms']:>8.1f}ms  p95 {stats['p95_ms']:>8.1f}ms  "
+              f"p99 {stats['p99_ms']:>8.1f}ms  {stats['queries_per_request']:>6.1f} queries  "
+              f"{stats['requests_per_second']:>7.1f} req/s"
+              + (f"  {stats['errors']} errors" if stats['errors'] else ""))
+
+    return results
+
+
+def compare(results, baseline, tolerance, query_slack=0.5, floor_ms=1.0):
+    """List the routes that got slower or chattier than the baseline."""
+
+    regressions = []
+
+    for name, before in baseline['routes'].items():
+        after = results['routes'].get(name)
+
+        if after is None:
+            continue
+
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance) + floor_ms:
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {after['p95_ms']}ms")
+
+        if after['queries_per_request'] > before['queries_per_request'] + query_slack:
+            regressions.append(f"{name}: queries/request "
+                               f"{before['queries_per_request']} -> {after['queries_per_request']}")
+
+        if after['errors'] > before.get('errors', 0):
+            regressions.append(f"{name}: {after['errors']} errors")
+
+    return regressions
+
+
+def seed_data(scale, seed):
+    """Generate a dataset at `scale` and bulk-load it."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--scale', str(scale), '--seed', str(seed), '--out', directory],
+                       check=True)
+        subprocess.run([sys.executable, 'seed.py', directory], check=True, env=os.environ)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed-data', action='store_true', help="generate and load a dataset first")
+    parser.add_argument('--scale', type=float, default=1, help="dataset scale factor (see create_csvs.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--server', action='store_true', help="go through a local WSGI server")
+    parser.add_argument('--routes', nargs='*', help="only these routes")
+    parser.add_argument('--save', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', help="fail if slower than this JSON baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if args.seed_data:
+        seed_data(args.scale, args.seed)
+
+    results = run(args)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
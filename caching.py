@@ -0,0 +1,125 @@
+"""HTTP caching policy.
+
+Replaces the old blanket "never cache anything" hook:
+
+- Static files are linked through `static_url`, which adds a hash of the
+  file's contents (`/static/script.js?v=1a2b3c4d`). Versioned URLs change
+  whenever the file does, so they are served as immutable for a year.
+  Unversioned static URLs are revalidated every time (Flask answers those
+  with 304 from the file's own ETag).
+- Views whose output only depends on a few cheap values (row versions,
+  counters, the page asked for) call `not_modified(...)` first. That builds a
+  weak ETag from those values and returns a 304 straight away if the browser
+  already has that version, before any template is rendered.
+- Everything else stays uncacheable, as before.
+"""
+
+import hashlib
+import os
+from threading import Lock
+
+from flask import current_app, g, request, session
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+_static_hashes = {}
+_static_lock = Lock()
+
+
+def static_hash(filename):
+    """Short hash of a static file's contents, or None if it doesn't exist.
+
+    Hashes are remembered per file and only recomputed when its mtime moves.
+    """
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    with _static_lock:
+        cached = _static_hashes.get(path)
+
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    with open(path, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()[:8]
+
+    with _static_lock:
+        _static_hashes[path] = (mtime, digest)
+
+    return digest
+
+
+def static_url(filename):
+    """URL for a static file, versioned by its contents."""
+
+    version = static_hash(filename)
+    url = f"{current_app.static_url_path}/{filename}"
+    return f"{url}?v={version}" if version else url
+
+
+def etag_for(*parts):
+    """Weak ETag value (unquoted) for a response built from `parts`."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def not_modified(*parts):
+    """304 response if the client already has the version built from `parts`.
+
+    Otherwise returns None and remembers the ETag, which `apply_policy` adds
+    to the response the view goes on to render. Pending flash messages are
+    part of the page but not of `parts`, so never answer 304 while there are
+    any.
+    """
+
+    etag = etag_for(*parts)
+    g.etag = etag
+
+    if session.get('_flashes') or not request.if_none_match.contains_weak(etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def apply_policy(response):
+    """Set caching headers on every response (an `after_request` hook)."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+
+        if version and version == static_hash(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+        return response
+
+    etag = g.pop('etag', None)
+
+    if etag and response.status_code in (200, 304):
+        if response.status_code == 200:
+            response.set_etag(etag, weak=True)
+
+        # Pages depend on who is looking, so only the browser may keep them
+        if 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+    # Views may choose their own policy (e.g. /autocomplete)
+    if 'Cache-Control' in response.headers:
+        return response
+
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
@@ -0,0 +1,109 @@
+"""`{% cache %}` tag: keep rendered template fragments in memory.
+
+Message cards are mostly the same HTML for everyone (author avatar and
+username, text, date), so templates wrap that part in
+
+    {% cache 'card', message.id, message.user.profile_version %} ... {% endcache %}
+
+and it is rendered once per key until it falls out of the LRU. Keys include
+the template name and the line of the tag, plus whatever values are given;
+anything that varies per viewer (like buttons, follow buttons) has to stay
+outside the block.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache:
+    """LRU of rendered fragments, capped by the total size of the HTML."""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """The fragment stored under `key`, or None."""
+
+        with self._lock:
+            fragment = self._entries.get(key)
+
+            if fragment is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+            return fragment
+
+    def set(self, key, fragment):
+        """Store `fragment`, evicting the least recently used ones past the cap."""
+
+        size = len(fragment)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._entries[key] = fragment
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def hit_ratio(self):
+        """Share of lookups answered from the cache so far (0 before any)."""
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class FragmentCacheExtension(Extension):
+    """Adds `{% cache key, ... %}...{% endcache %}` using `env.fragment_cache`."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [nodes.Const(parser.name), nodes.Const(lineno)]
+
+        while parser.stream.current.type != 'block_end':
+            if len(parts) > 2:
+                parser.stream.expect('comma')
+            parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render', [nodes.List(parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        cache = self.environment.fragment_cache
+        key = tuple(parts)
+
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+
+        return fragment
@@ -3,14 +3,28 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run it from the project root:
+
+    python generator/create_csvs.py                  # the checked-in sizes
+    python generator/create_csvs.py --scale 1000     # 1M users, 100M messages,
+                                                     # 50M follows
+
+Everything is generated offline from a seed (same seed, same files) with
+vectorized NumPy sampling, and written out in chunks, so memory use stays
+flat however large the scale factor. Follower counts and posting activity
+follow a power law, like real social graphs: a few users are very popular
+or very chatty, most aren't.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+from datetime import datetime
+import os
+
+import numpy as np
+
+from helpers import random_timestamps, power_law_cdf
 
 MAX_WARBLER_LENGTH = 140
 
@@ -18,13 +32,28 @@ USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'heade
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
+# Sizes when no scale factor is given (what's checked in)
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Sizes per unit of --scale
+USERS_PER_SCALE = 1000
+MESSAGES_PER_USER = 100
+FOLLOWS_PER_USER = 50
+
+# Skew of who gets followed and who posts (higher: more lopsided)
+FOLLOWERS_EXPONENT = 1.0
+POSTING_EXPONENT = 0.8
 
-# Generate random profile image URLs to use for users
+CHUNK_SIZE = 100_000
+
+# Messages are dated in the two years up to here (fixed, so a seed always
+# gives the same files)
+TIMESTAMPS_UNTIL = datetime(2026, 1, 1)
+
+# Everyone's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +61,173 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/buffalo-hero.jpg",
+    "/static/images/buffalo-bg.jpeg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followee, user_following_id=follower))
+WORDS = """
+    buffalo herd prairie grass river morning evening coffee city trail bird
+    song north south wind rain snow sun cloud dog cat friend family music
+    book movie game team code bug deploy lunch dinner pizza taco weekend
+    monday road trip mountain lake ocean beach forest park garden street
+    market bread cheese apple orange tea late early happy tired busy quiet
+    loud new old big small great good bad best worst today tomorrow always
+    never maybe really just still finally again almost everyone nobody
+    """.split()
+
+LOCATIONS = [
+    "Buffalo", "Denver", "Bozeman", "Cheyenne", "Omaha", "Fargo", "Tulsa",
+    "Austin", "Portland", "Chicago", "Boston", "Oakland", "San Francisco",
+    "New York", "Seattle", "Minneapolis", "Rapid City", "Boise",
+]
+
+
+def chunks(total, size=CHUNK_SIZE):
+    """(start, stop) ranges covering 0..total in steps of `size`."""
+
+    for start in range(0, total, size):
+        yield start, min(start + size, total)
+
+
+def sentences(rng, count, min_words, max_words):
+    """`count` random sentences of word salad, at most a warble long."""
+
+    lengths = rng.integers(min_words, max_words + 1, size=count).tolist()
+    words = rng.integers(0, len(WORDS), size=(count, max_words)).tolist()
+
+    return [
+        (" ".join([WORDS[i] for i in row[:length]]).capitalize() + ".")[:MAX_WARBLER_LENGTH]
+        for row, length in zip(words, lengths)
+    ]
+
+
+def write_users(path, rng, num_users):
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+        users_writer.writerow(USERS_CSV_HEADERS)
+
+        for start, stop in chunks(num_users):
+            size = stop - start
+            ids = range(start + 1, stop + 1)
+            names = [WORDS[i] for i in rng.integers(0, len(WORDS), size=size)]
+
+            users_writer.writerows(zip(
+                (f"{name}{id}@example.com" for name, id in zip(names, ids)),
+                (f"{name}{id}" for name, id in zip(names, ids)),
+                [image_urls[i] for i in rng.integers(0, len(image_urls), size=size)],
+                [PASSWORD] * size,
+                sentences(rng, size, 3, 10),
+                [header_image_urls[i] for i in rng.integers(0, len(header_image_urls), size=size)],
+                [LOCATIONS[i] for i in rng.integers(0, len(LOCATIONS), size=size)],
+            ))
+
+
+def write_messages(path, rng, num_users, num_messages):
+    posting = power_law_cdf(rng, num_users, POSTING_EXPONENT)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for start, stop in chunks(num_messages):
+            size = stop - start
+            authors = np.searchsorted(posting, rng.random(size)) + 1
+            timestamps = random_timestamps(rng, size, until=TIMESTAMPS_UNTIL).astype(str)
+
+            messages_writer.writerows(zip(
+                sentences(rng, size, 4, 25),
+                np.char.replace(timestamps, 'T', ' ').tolist(),
+                authors.tolist(),
+            ))
+
+
+def sample_follows(rng, popularity, follower_ids, degrees, attempts=10):
+    """Distinct (follower, followee) pairs, `degrees[i]` for follower_ids[i].
+
+    Self-follows and repeats are redrawn a few times; whatever is still
+    missing after that (only for users following most of the graph) is
+    dropped.
+    """
+
+    pairs = np.empty((0, 2), dtype=np.int64)
+    wanted = degrees
+
+    for _ in range(attempts):
+        followers = np.repeat(follower_ids, wanted)
+
+        if not len(followers):
+            break
+
+        followees = np.searchsorted(popularity, rng.random(len(followers))) + 1
+        keep = followers != followees
+        drawn = np.stack([followers[keep], followees[keep]], axis=1)
+        pairs = np.unique(np.concatenate([pairs, drawn]), axis=0)
+
+        have = np.bincount(pairs[:, 0] - follower_ids[0], minlength=len(follower_ids))
+        wanted = degrees - have
+
+    return pairs
+
+
+def write_follows(path, rng, num_users, num_follows):
+    """Write (about) `num_follows` distinct follows, popular users getting most.
+
+    In the app's relationships, `user_being_followed_id` is the follower and
+    `user_following_id` the user they follow (see `User.following`).
+    Followers are processed a range at a time; all of a follower's follows
+    are in one chunk, so duplicates can be dropped chunk by chunk.
+    """
+
+    popularity = power_law_cdf(rng, num_users, FOLLOWERS_EXPONENT)
+    out_degrees = rng.multinomial(num_follows, np.full(num_users, 1 / num_users))
+    out_degrees = np.minimum(out_degrees, num_users - 1)
+    users_per_chunk = max(1, CHUNK_SIZE * num_users // max(num_follows, 1))
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for start, stop in chunks(num_users, users_per_chunk):
+            follower_ids = np.arange(start + 1, stop + 1)
+            pairs = sample_follows(rng, popularity, follower_ids, out_degrees[start:stop])
+            follows_writer.writerows(pairs.tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', type=float,
+                        help=f"{USERS_PER_SCALE} users, {MESSAGES_PER_USER} messages and "
+                             f"{FOLLOWS_PER_USER} follows per user for each unit")
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--follows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='generator', help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    if args.scale:
+        num_users = int(args.scale * USERS_PER_SCALE)
+        num_messages = num_users * MESSAGES_PER_USER
+        num_follows = num_users * FOLLOWS_PER_USER
+    else:
+        num_users, num_messages, num_follows = NUM_USERS, NUM_MESSAGES, NUM_FOLLWERS
+
+    num_users = args.users or num_users
+    num_messages = args.messages or num_messages
+    num_follows = args.follows or num_follows
+
+    # one independent stream per file, so each is reproducible on its own
+    users_rng, messages_rng, follows_rng = [
+        np.random.default_rng(seed) for seed in np.random.SeedSequence(args.seed).spawn(3)]
+
+    os.makedirs(args.out, exist_ok=True)
+    write_users(os.path.join(args.out, 'users.csv'), users_rng, num_users)
+    write_messages(os.path.join(args.out, 'messages.csv'), messages_rng, num_users, num_messages)
+    write_follows(os.path.join(args.out, 'follows.csv'), follows_rng, num_users, num_follows)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,34 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
-from random import uniform
 
+import numpy as np
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def random_timestamps(rng, size, year_gap=2, until=None):
+    """Array of `size` random datetimes in the few years before `until`.
+
+    `until` defaults to now. `rng` is a numpy Generator, so the same seed
+    (and `until`) gives the same timestamps.
+    """
+
+    now = until or datetime.now().replace(microsecond=0)
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    span_us = int((now - then).total_seconds() * 1_000_000)
+
+    offsets = rng.integers(0, span_us, size=size).astype('timedelta64[us]')
+    return np.datetime64(then, 'us') + offsets
+
+
+def power_law_cdf(rng, n, exponent):
+    """Cumulative weights for picking 1..n with a Zipf-like skew.
+
+    Weights fall off as rank ** -exponent; ranks are shuffled so the
+    popular ids are spread through the table instead of all being 1, 2, 3.
+    Pick ids with `searchsorted(cdf, rng.random(size)) + 1`.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+    weights = weights[rng.permutation(n)]
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
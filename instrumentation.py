@@ -0,0 +1,236 @@
+"""Per-request query/timing instrumentation, cheap enough to leave on.
+
+For every request we count SQL statements and time spent in the database
+(SQLAlchemy engine events), time spent rendering templates (Flask template
+signals) and total wall time. Each response gets a `Server-Timing` header
+with those numbers. Slow requests are appended to a JSON-lines log, and
+per-endpoint latency histograms are served as JSON from /metrics, to
+requests from this machine or bearing METRICS_TOKEN.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+import hmac
+import json
+from threading import Lock
+import time
+
+from flask import g, has_request_context, request, abort, jsonify, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Where /metrics may be read from without METRICS_TOKEN
+LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+# Upper bounds (ms) of the latency histogram buckets; the last is "more"
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+
+class RequestStats:
+    """Counters for the request in flight (lives on `g.request_stats`)."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self._template_started = []
+
+
+class EndpointHistogram:
+    """Latency histogram plus query totals for one endpoint."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.requests = 0
+        self.total_ms = 0.0
+        self.queries = 0
+        self.db_ms = 0.0
+
+    def add(self, wall_ms, queries, db_ms):
+        self.counts[bisect_left(BUCKETS_MS, wall_ms)] += 1
+        self.requests += 1
+        self.total_ms += wall_ms
+        self.queries += queries
+        self.db_ms += db_ms
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of requests."""
+
+        wanted = fraction * self.requests
+        seen = 0
+
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return bound
+
+        return 0
+
+    def to_dict(self):
+        requests = self.requests or 1
+        return dict(
+            requests=self.requests,
+            mean_ms=round(self.total_ms / requests, 2),
+            p50_ms=self.percentile(0.50),
+            p95_ms=self.percentile(0.95),
+            p99_ms=self.percentile(0.99),
+            queries_per_request=round(self.queries / requests, 2),
+            db_ms_per_request=round(self.db_ms / requests, 2),
+            buckets={str(bound): count for bound, count in zip(BUCKETS_MS, self.counts)},
+        )
+
+
+def current_stats():
+    """The stats of the request in flight, or None outside of one."""
+
+    if has_request_context():
+        return g.get('request_stats')
+
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    stats = current_stats()
+
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    conn = context.connection
+
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+class Instrumentation:
+    """Flask extension wiring the counters into an app.
+
+    Config:
+    - SLOW_REQUEST_MS / SLOW_REQUEST_QUERIES: log requests over either
+    - SLOW_REQUEST_LOG: JSON-lines file to log them to (None: don't)
+    - METRICS_ENDPOINT: URL of the histogram endpoint (None: don't serve)
+    - METRICS_TOKEN: lets other hosts read it with `Authorization: Bearer
+      <token>` (None: only requests from this machine may)
+    """
+
+    def __init__(self, app=None):
+        self.histograms = defaultdict(EndpointHistogram)
+        self.gauges = {}
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_REQUEST_MS', 500)
+        app.config.setdefault('SLOW_REQUEST_QUERIES', 50)
+        app.config.setdefault('SLOW_REQUEST_LOG', None)
+        app.config.setdefault('METRICS_ENDPOINT', '/metrics')
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        self.app = app
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+        if app.config['METRICS_ENDPOINT']:
+            app.add_url_rule(app.config['METRICS_ENDPOINT'], 'metrics', self.metrics)
+
+    def register_gauge(self, name, fn):
+        """Report the result of calling `fn()` as `name` on /metrics."""
+
+        self.gauges[name] = fn
+
+    def start_request(self):
+        g.request_stats = RequestStats()
+
+    def _before_render(self, app, template, context, **extra):
+        stats = current_stats()
+        if stats is not None:
+            stats._template_started.append(time.perf_counter())
+
+    def _after_render(self, app, template, context, **extra):
+        stats = current_stats()
+        if stats is not None and stats._template_started:
+            stats.template_time += time.perf_counter() - stats._template_started.pop()
+
+    def finish_request(self, response):
+        stats = current_stats()
+
+        if stats is None:
+            return response
+
+        wall_ms = (time.perf_counter() - stats.started) * 1000
+        db_ms = stats.db_time * 1000
+        template_ms = stats.template_time * 1000
+        endpoint = request.endpoint or 'unknown'
+
+        response.headers.add('Server-Timing', ', '.join([
+            f'db;dur={db_ms:.1f};desc="{stats.queries} queries"',
+            f'tmpl;dur={template_ms:.1f}',
+            f'total;dur={wall_ms:.1f}',
+        ]))
+
+        with self._lock:
+            self.histograms[endpoint].add(wall_ms, stats.queries, db_ms)
+
+        config = self.app.config
+        slow = (wall_ms >= config['SLOW_REQUEST_MS']
+                or stats.queries >= config['SLOW_REQUEST_QUERIES'])
+
+        if slow and config['SLOW_REQUEST_LOG']:
+            self.log_slow_request(dict(
+                at=datetime.utcnow().isoformat(),
+                method=request.method,
+                path=request.full_path.rstrip('?'),
+                endpoint=endpoint,
+                status=response.status_code,
+                wall_ms=round(wall_ms, 1),
+                db_ms=round(db_ms, 1),
+                template_ms=round(template_ms, 1),
+                queries=stats.queries,
+            ))
+
+        return response
+
+    def log_slow_request(self, entry):
+        with self._lock:
+            with open(self.app.config['SLOW_REQUEST_LOG'], 'a') as log:
+                log.write(json.dumps(entry) + '\n')
+
+    def metrics(self):
+        """Per-endpoint histograms and registered gauges, as JSON."""
+
+        if not self.may_read_metrics():
+            abort(403)
+
+        with self._lock:
+            endpoints = {name: histogram.to_dict()
+                         for name, histogram in self.histograms.items()}
+
+        gauges = {name: fn() for name, fn in self.gauges.items()}
+        return jsonify(endpoints=endpoints, gauges=gauges)
+
+    def may_read_metrics(self):
+        token = self.app.config['METRICS_TOKEN']
+
+        if token:
+            scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() == 'bearer' and hmac.compare_digest(given.encode(), token.encode()):
+                return True
+
+        return request.remote_addr in LOCAL_ADDRS
@@ -0,0 +1,73 @@
+"""Background jobs: the handler registry and the worker loop.
+
+Requests queue slow side effects with `enqueue('name', **kwargs)` instead of
+doing them inline; `flask worker` runs them. Handlers are registered with
+`@task('name')`, get the job's kwargs, and run inside a transaction that
+the worker commits when they return (or rolls back if they raise). A job
+can run more than once (retries, or a worker outliving its visibility
+timeout), so handlers must be idempotent.
+"""
+
+import time
+import traceback
+
+from models import db, Job
+
+handlers = {}
+
+
+def task(name):
+    """Register the decorated function as the handler for jobs called `name`."""
+
+    def register(fn):
+        handlers[name] = fn
+        return fn
+
+    return register
+
+
+def enqueue(name, run_at=None, **kwargs):
+    """Queue a `name` job with the current transaction (to run from `run_at`)."""
+
+    if name not in handlers:
+        raise LookupError(f"No job handler called {name!r}")
+
+    return Job.enqueue(name, run_at=run_at, **kwargs)
+
+
+def run_job(job):
+    """Run one claimed job; returns whether it succeeded."""
+
+    try:
+        if job.attempts > job.max_attempts:
+            raise TimeoutError("Gave up: still unfinished after its last visibility timeout")
+
+        handlers[job.name](**job.kwargs)
+        job.finish()
+        db.session.commit()
+        return True
+
+    except Exception:
+        db.session.rollback()
+        job.fail(traceback.format_exc())
+        db.session.commit()
+        return False
+
+
+def work(poll_interval=1.0, visibility_timeout=300, once=False, echo=print):
+    """Claim and run jobs until interrupted (or, with `once`, until none are due)."""
+
+    while True:
+        job = Job.claim(visibility_timeout)
+
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        name, job_id = job.name, job.id
+        started = time.perf_counter()
+        ok = run_job(job)
+        echo(f"{name} #{job_id} {'done' if ok else 'failed'} "
+             f"in {(time.perf_counter() - started) * 1000:.0f}ms")
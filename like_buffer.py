@@ -0,0 +1,89 @@
+"""Write-behind buffer for likes.
+
+With LIKE_BUFFER_SECONDS set, the like API records the state the user asked
+for here instead of writing it straight away. Rapid toggles of the same
+message by the same user collapse into one entry (the last one wins), and a
+background thread writes everything pending every few seconds in one batch
+(`LikedMessage.apply`). A process that dies loses at most that interval of
+likes, which is why this is off by default.
+"""
+
+import atexit
+from threading import Event, Lock, Thread
+
+from models import db, LikedMessage
+
+
+class LikeBuffer:
+    """Pending `{(user_id, message_id): liked}` changes, flushed in batches."""
+
+    def __init__(self, app=None, interval=2.0, max_pending=1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        self._wake = Event()
+        self._thread = None
+        self.app = app
+
+    def start(self):
+        """Flush in a background thread every `interval` seconds (and at exit)."""
+
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='like-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+
+    def set(self, user_id, message_id, liked):
+        """Record that `user_id` wants `message_id` liked (or not)."""
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+            full = len(self._pending) >= self.max_pending
+
+        # flushing shares the request's session, so leave it to the thread
+        if full:
+            self._wake.set()
+
+    def get(self, user_id, message_id):
+        """The pending state for this like, or None if nothing is pending."""
+
+        with self._lock:
+            return self._pending.get((user_id, message_id))
+
+    def flush(self):
+        """Write everything pending in one transaction.
+
+        Don't call this from a request: it commits and removes the session.
+        """
+
+        with self._lock:
+            changes, self._pending = self._pending, {}
+
+        if not changes:
+            return
+
+        with self.app.app_context():
+            try:
+                LikedMessage.apply(changes)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # keep them for the next flush, unless newer changes came in
+                with self._lock:
+                    self._pending = {**changes, **self._pending}
+                self.app.logger.exception("Couldn't flush %d buffered likes", len(changes))
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
@@ -0,0 +1,168 @@
+"""Live timeline updates over Server-Sent Events.
+
+New warbles are published to one stream of events; every open `/live`
+connection reads that stream, keeps the events from authors its user
+follows and writes them out as SSE. Events carry an id, so a browser that
+reconnects with `Last-Event-ID` picks up whatever it missed (as long as it
+is still in the stream's recent history).
+
+The stream lives in a backend:
+
+- `MemoryBackend` keeps recent events in this process. That is enough for a
+  single process (and for development), but a post made in one worker
+  process is not seen by connections held by another.
+- `RedisBackend` keeps them in a Redis stream (XADD/XREAD), so any number of
+  processes share it. It works with anything that speaks those commands
+  through a redis-py style client, e.g. a local stand-in for tests.
+
+Each open connection holds a worker thread, so a process only takes so
+many (`ConnectionLimit`), and each one is closed after a while: the browser
+reconnects with its `Last-Event-ID`, and the new request reads who its
+user follows afresh.
+"""
+
+from collections import deque
+import json
+from threading import Condition, Lock
+
+
+class MemoryBackend:
+    """Recent events in a bounded in-process buffer."""
+
+    def __init__(self, maxlen=1000):
+        self._events = deque(maxlen=maxlen)
+        self._next_id = 1
+        self._changed = Condition()
+
+    def append(self, data):
+        with self._changed:
+            event_id = str(self._next_id)
+            self._next_id += 1
+            self._events.append((event_id, data))
+            self._changed.notify_all()
+
+        return event_id
+
+    def latest_id(self):
+        with self._changed:
+            return str(self._next_id - 1)
+
+    def read(self, after_id, timeout):
+        """Events after `after_id`, waiting up to `timeout` seconds for one."""
+
+        with self._changed:
+            latest = self._next_id - 1
+            # Ids from before a restart (or not ours at all) start from now
+            after = int(after_id) if after_id.isdigit() and int(after_id) <= latest else latest
+
+            self._changed.wait_for(lambda: self._next_id - 1 > after, timeout)
+            return [(event_id, data) for event_id, data in self._events
+                    if int(event_id) > after]
+
+
+class RedisBackend:
+    """Recent events in a capped Redis stream."""
+
+    def __init__(self, client, key='warbler:live', maxlen=1000):
+        self.client = client
+        self.key = key
+        self.maxlen = maxlen
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def append(self, data):
+        event_id = self.client.xadd(self.key, {'data': data},
+                                    maxlen=self.maxlen, approximate=True)
+        return _text(event_id)
+
+    def latest_id(self):
+        last = self.client.xrevrange(self.key, count=1)
+        return _text(last[0][0]) if last else '0-0'
+
+    def read(self, after_id, timeout):
+        streams = self.client.xread({self.key: after_id}, block=int(timeout * 1000))
+        return [(_text(event_id), _text(fields.get(b'data', fields.get('data'))))
+                for _, events in streams
+                for event_id, fields in events]
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class Broker:
+    """Publishes JSON events to a backend and follows them for subscribers."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    def publish(self, event):
+        """Add `event` (anything JSON-serializable) and return its id."""
+
+        return self.backend.append(json.dumps(event))
+
+    def subscribe(self, last_id=None, heartbeat=15):
+        """Yield `(id, event)` for every event after `last_id`, forever.
+
+        Starts from the newest event when `last_id` is None. Yields None
+        whenever `heartbeat` seconds pass without an event, so the caller
+        can keep the connection alive.
+        """
+
+        last_id = last_id or self.backend.latest_id()
+
+        while True:
+            events = self.backend.read(last_id, heartbeat)
+
+            if not events:
+                yield None
+
+            for event_id, data in events:
+                last_id = event_id
+                yield event_id, json.loads(data)
+
+
+class ConnectionLimit:
+    """Counts open connections in this process, refusing any past `limit`."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Take a place if one is free; returns whether it did."""
+
+        with self._lock:
+            if self.open >= self.limit:
+                return False
+
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+def format_sse(data=None, event=None, id=None, comment=None, retry=None):
+    """One Server-Sent Events message."""
+
+    lines = []
+
+    if comment is not None:
+        lines.append(f": {comment}")
+    if retry is not None:
+        lines.append(f"retry: {retry}")
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    if data is not None:
+        lines.extend(f"data: {line}" for line in data.splitlines() or [''])
+
+    return "\n".join(lines) + "\n\n"
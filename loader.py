@@ -0,0 +1,185 @@
+"""Bulk-load the generator's CSVs as fast as the database will take them.
+
+On PostgreSQL rows are streamed through `COPY ... FROM STDIN` a chunk at a
+time; elsewhere (SQLite) through batched `executemany`. Either way nothing
+is held in memory beyond one chunk. Secondary indexes and foreign keys are
+dropped for the load and put back afterwards (building an index once is far
+cheaper than maintaining it row by row), then the id sequences are moved
+past the loaded ids so new rows don't collide with them.
+"""
+
+import csv
+import io
+import os
+import time
+
+from sqlalchemy import inspect, sql, text
+from sqlalchemy.schema import AddConstraint
+
+from models import db
+import migrations
+
+# CSV file -> table, in an order that satisfies the foreign keys
+CSV_TABLES = [
+    ('users.csv', 'users'),
+    ('messages.csv', 'messages'),
+    ('follows.csv', 'follows'),
+]
+
+CHUNK_ROWS = 100_000
+
+
+def csv_chunks(csv_file, chunk_rows=CHUNK_ROWS):
+    """Yield chunks of at most `chunk_rows` raw CSV lines from `csv_file`.
+
+    Lines are passed through untouched. A chunk is only cut where the
+    number of quote characters so far is even, so a quoted field with a
+    newline in it never gets split across two chunks.
+    """
+
+    chunk = []
+    rows = 0
+    quotes = 0
+
+    for line in csv_file:
+        chunk.append(line)
+        quotes += line.count('"')
+
+        if quotes % 2 == 0:
+            rows += 1
+
+            if rows >= chunk_rows:
+                yield ''.join(chunk), rows
+                chunk, rows = [], 0
+
+    if chunk:
+        yield ''.join(chunk), rows
+
+
+def copy_csv(engine, table, columns, csv_file, chunk_rows):
+    """Stream the rest of `csv_file` into `table` with COPY (PostgreSQL)."""
+
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        for chunk, rows in csv_chunks(csv_file, chunk_rows):
+            cursor.copy_expert(sql, io.StringIO(chunk))
+            connection.commit()
+            yield rows
+
+    finally:
+        connection.close()
+
+
+def insert_csv(engine, table, columns, csv_file, chunk_rows):
+    """Insert the rest of `csv_file` into `table` in executemany batches."""
+
+    # just the CSV's columns, untyped, so values go through as they are
+    insert = sql.table(table, *(sql.column(name) for name in columns)).insert()
+    batch = []
+
+    with engine.connect() as connection:
+        for row in csv.reader(csv_file):
+            batch.append(dict(zip(columns, row)))
+
+            if len(batch) >= chunk_rows:
+                with connection.begin():
+                    connection.execute(insert, batch)
+                yield len(batch)
+                batch = []
+
+        if batch:
+            with connection.begin():
+                connection.execute(insert, batch)
+            yield len(batch)
+
+
+def drop_secondary_indexes(engine):
+    """Drop the non-unique indexes so the load doesn't maintain them."""
+
+    inspector = inspect(engine)
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name in existing and not index.unique:
+                index.drop(engine)
+
+    if engine.dialect.name == 'postgresql':
+        engine.execute("DROP INDEX IF EXISTS ix_users_username_trgm, ix_users_bio_location_tsv")
+
+
+def drop_foreign_keys(engine):
+    """Drop the foreign keys (PostgreSQL); returns the ones to re-add."""
+
+    if engine.dialect.name != 'postgresql':
+        return []
+
+    inspector = inspect(engine)
+    dropped = []
+
+    for table in db.metadata.sorted_tables:
+        for foreign_key in inspector.get_foreign_keys(table.name):
+            engine.execute(f'ALTER TABLE {table.name} DROP CONSTRAINT "{foreign_key["name"]}"')
+
+        dropped.extend(table.foreign_key_constraints)
+
+    return dropped
+
+
+def resync_sequences(engine):
+    """Point each serial id sequence just past the largest loaded id."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    for table in db.metadata.sorted_tables:
+        if 'id' in table.columns and table.columns['id'].autoincrement in (True, 'auto'):
+            engine.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table.name}")
+
+
+def load(directory, engine=None, chunk_rows=CHUNK_ROWS, echo=print):
+    """Load every CSV in `directory` into the (empty) tables."""
+
+    engine = engine or db.engine
+    postgres = engine.dialect.name == 'postgresql'
+
+    drop_secondary_indexes(engine)
+    foreign_keys = drop_foreign_keys(engine)
+
+    # whatever happens to the load, the schema goes back the way it was
+    try:
+        for filename, table in CSV_TABLES:
+            path = os.path.join(directory, filename)
+
+            with open(path, newline='') as csv_file:
+                columns = next(csv.reader([csv_file.readline()]))
+                load_rows = copy_csv if postgres else insert_csv
+
+                started = time.perf_counter()
+                loaded = 0
+
+                for rows in load_rows(engine, table, columns, csv_file, chunk_rows):
+                    loaded += rows
+                    elapsed = time.perf_counter() - started
+                    echo(f"{table}: {loaded:,} rows ({loaded / elapsed:,.0f} rows/s)")
+
+    finally:
+        started = time.perf_counter()
+
+        for foreign_key in foreign_keys:
+            engine.execute(AddConstraint(foreign_key))
+
+        migrations.upgrade(engine, echo=echo)
+        resync_sequences(engine)
+
+    if postgres:
+        engine.execute(text("ANALYZE").execution_options(autocommit=True))
+
+    echo(f"indexes and constraints rebuilt in {time.perf_counter() - started:,.1f}s")
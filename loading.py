@@ -0,0 +1,52 @@
+"""How pages load the rows related to the ones they list.
+
+Templates touch `message.user` for every message on a timeline; left to the
+default lazy loading, that is one SELECT per message. Views instead pass
+their queries through `eager(query, Message.user, ...)`, which adds the
+loader strategy configured for each relationship in
+`LOADER_STRATEGIES`:
+
+- 'joined': in the same query, with a LEFT OUTER JOIN (good for
+  many-to-one, like a message's author)
+- 'selectin': in one extra query, WHERE id IN (...) (good for collections)
+- 'select': lazily, one query per object, as if `eager` weren't there
+
+With RAISE_ON_LAZY_LOAD set (the tests do), any other relationship of the
+loaded rows raises instead of lazy loading, so a template that starts
+touching a relationship its view doesn't load fails loudly.
+"""
+
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload, lazyload, raiseload
+
+STRATEGIES = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'select': lazyload,
+}
+
+DEFAULT_STRATEGIES = {
+    'Message.user': 'joined',
+    'DirectMessage.sent_from_user': 'joined',
+    'DirectMessage.sent_to_user': 'joined',
+    'User.following': 'selectin',
+    'User.followers': 'selectin',
+    'Recommendation.recommended_user': 'joined',
+}
+
+
+def eager(query, *relationships):
+    """`query` with each relationship loaded by its configured strategy."""
+
+    configured = current_app.config['LOADER_STRATEGIES']
+    options = []
+
+    for relationship in relationships:
+        name = f"{relationship.class_.__name__}.{relationship.key}"
+        strategy = configured.get(name, DEFAULT_STRATEGIES.get(name, 'select'))
+        options.append(STRATEGIES[strategy](relationship))
+
+    if current_app.config['RAISE_ON_LAZY_LOAD']:
+        options.append(raiseload('*', sql_only=True))
+
+    return query.options(*options)
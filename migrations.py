@@ -0,0 +1,87 @@
+"""Bring an existing database's schema up to date with models.py.
+
+`db.create_all()` only creates tables that don't exist yet, so databases
+created before a column or index was added to the models never get it.
+`upgrade()` fills those gaps: it creates missing tables, adds missing
+columns (with their foreign keys) and creates missing indexes, and drops indexes the models no longer
+have (`DROPPED_INDEXES`). Every step checks first, so it is safe to run on
+every deploy (`flask upgrade-db`).
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from models import db, POSTGRES_USERS_DDL
+
+# (table, index) pairs removed from the models, dropped where still present
+DROPPED_INDEXES = [
+    # sent requests use the primary key
+    ('follow_requests', 'ix_follow_requests_requesting_pending'),
+]
+
+
+def missing_columns(inspector, table):
+    """Columns of `table` in the models but not in the database."""
+
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name not in existing]
+
+
+def missing_indexes(inspector, table):
+    """Indexes of `table` in the models but not in the database."""
+
+    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+    return [index for index in table.indexes if index.name not in existing]
+
+
+def references(column):
+    """REFERENCES clauses for `column`'s foreign keys, to add it with.
+
+    Inline, since SQLite can't add a constraint to an existing table.
+    """
+
+    clauses = []
+    for foreign_key in column.foreign_keys:
+        clause = f"REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})"
+        if foreign_key.ondelete:
+            clause += f" ON DELETE {foreign_key.ondelete.upper()}"
+        clauses.append(clause)
+
+    return " ".join(clauses)
+
+
+def upgrade(engine=None, echo=print):
+    """Apply every missing table, column and index, drop retired indexes;
+    returns what was done."""
+
+    engine = engine or db.engine
+    existing_tables = set(inspect(engine).get_table_names())
+    done = [f"created table {table.name}" for table in db.metadata.sorted_tables
+            if table.name not in existing_tables]
+
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+
+    for table in db.metadata.sorted_tables:
+        for column in missing_columns(inspector, table):
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {ddl} {references(column)}")
+            done.append(f"added column {table.name}.{column.name}")
+
+        for index in missing_indexes(inspector, table):
+            index.create(engine)
+            done.append(f"created index {index.name}")
+
+    for table_name, index_name in DROPPED_INDEXES:
+        if index_name in {index['name'] for index in inspector.get_indexes(table_name)}:
+            engine.execute(f"DROP INDEX {index_name}")
+            done.append(f"dropped index {index_name}")
+
+    if engine.dialect.name == 'postgresql':
+        for ddl in POSTGRES_USERS_DDL:
+            engine.execute(ddl)
+
+    for step in done:
+        echo(step)
+
+    return done
@@ -1,13 +1,21 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm.util import identity_key
 
-bcrypt = Bcrypt()
+from passwords import PasswordHasher
+
+passwords = PasswordHasher()
 db = SQLAlchemy()
 
+# Most entries we keep in any one user's precomputed home timeline
+TIMELINE_MAX_LENGTH = 800
+
 class LikedMessage(db.Model):
     """Connection of a follower <-> followee."""
 
@@ -25,6 +33,75 @@ class LikedMessage(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key covers message -> users; this covers user -> likes
+        db.Index('ix_liked_messages_user_message', 'user_id', 'message_id'),
+    )
+
+    @classmethod
+    def _insert_ignoring_duplicates(cls):
+        if db.engine.dialect.name == 'postgresql':
+            return postgresql.insert(cls.__table__).on_conflict_do_nothing()
+
+        return cls.__table__.insert().prefix_with('OR IGNORE')
+
+    @classmethod
+    def like(cls, user_id, message_id):
+        """Make `user_id` like the message; returns whether that changed anything.
+
+        Safe to repeat: a second like is a no-op (ON CONFLICT DO NOTHING),
+        and only an actual change moves the user's and message's counters.
+        """
+
+        result = db.session.execute(cls._insert_ignoring_duplicates(),
+                                    {'user_id': user_id, 'message_id': message_id})
+
+        if result.rowcount:
+            User.bump_counts(user_id, likes_count=1)
+            Message.bump_likes(message_id, 1)
+
+        return bool(result.rowcount)
+
+    @classmethod
+    def unlike(cls, user_id, message_id):
+        """Undo `like`; returns whether there was a like to remove."""
+
+        removed = (cls.query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+
+        if removed:
+            User.bump_counts(user_id, likes_count=-1)
+            Message.bump_likes(message_id, -1)
+
+        return bool(removed)
+
+    @classmethod
+    def apply(cls, changes):
+        """Write a batch of `{(user_id, message_id): liked}` in a few statements.
+
+        Counters of the users and messages involved are then recounted
+        rather than bumped, since a batch can't tell which rows it changed.
+        """
+
+        if not changes:
+            return
+
+        likes = [{'user_id': user_id, 'message_id': message_id}
+                 for (user_id, message_id), liked in changes.items() if liked]
+        unlikes = [key for key, liked in changes.items() if not liked]
+
+        if likes:
+            db.session.execute(cls._insert_ignoring_duplicates(), likes)
+
+        if unlikes:
+            (cls.query
+             .filter(db.tuple_(cls.user_id, cls.message_id).in_(unlikes))
+             .delete(synchronize_session=False))
+
+        User.recount({user_id for user_id, _ in changes})
+        Message.recount({message_id for _, message_id in changes})
+
 class FollowRequest(db.Model):
     """Connection of a follower <-> followee."""
 
@@ -47,6 +124,14 @@ class FollowRequest(db.Model):
         default="Accepted"
     )
 
+    # Only pending requests are ever listed, so only index those. Sent ones
+    # are found through the primary key, which starts with user_requesting_id.
+    __table_args__ = (
+        db.Index('ix_follow_requests_requested_pending', 'user_requested_id',
+                 postgresql_where=(status == "Pending"),
+                 sqlite_where=(status == "Pending")),
+    )
+
     @classmethod
     def send_request(cls, user1, user2, status):
         request = cls(
@@ -77,6 +162,11 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key only helps lookups by user_being_followed_id
+        db.Index('ix_follows_following_followed', 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -131,7 +221,72 @@ class User(db.Model):
         nullable=True
     )
 
-    messages = db.relationship('Message')
+    # Set as soon as someone deletes their account; the rows themselves go
+    # later, in the `delete_user` job. Deleted users can't log in and
+    # their pages 404.
+    deleted = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Denormalized counters so the sidebar and profile header don't have to
+    # load whole relationship collections. Keep them in step with the rows
+    # through `bump_counts`; `recount` repairs any drift.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Goes up whenever anything shown on this user's pages changes (profile
+    # fields, counters, pending requests, inbox); HTTP ETags are built from it.
+    # `bump_counts` and `touch` take care of it.
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Goes up only when what message cards show of this user (username,
+    # avatar, bio) changes; cached fragments are keyed on it, so likes and
+    # follows don't throw them away.
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # the database deletes a deleted user's messages (ondelete cascade)
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -162,14 +317,21 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        Looks up the one Follows row rather than loading `self.following`.
+        """
+
+        return db.session.query(
+            Follows
+            .query
+            .filter(Follows.user_being_followed_id == self.id)
+            .filter(Follows.user_following_id == other_user.id)
+            .exists()
+        ).scalar()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -178,7 +340,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -199,59 +361,194 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the hash was made at an old bcrypt cost, it is replaced with one at
+        the current cost (the caller commits).
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted=False).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def get_or_404(cls, user_id):
+        """The user with this id, unless there's none or they were deleted."""
+
+        return cls.query.filter_by(id=user_id, deleted=False).first_or_404()
+
+    def disable(self):
+        """Delete this account as far as anyone can tell, straight away.
+
+        Frees the username and email for new signups and makes the password
+        unusable; the rows themselves are left to the `delete_user` job.
+        """
+
+        self.deleted = True
+        self.username = self.email = f"deleted-{self.id}"
+        self.password = ""
+        self.profile_version = User.profile_version + 1
+        User.touch(self.id)
+
+    @classmethod
+    def bump_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to the counters of the given user(s).
+
+        Runs as one UPDATE in the current transaction, e.g.
+        User.bump_counts(user.id, followers_count=1). Also bumps `version`.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        if not user_ids:
+            return
+
+        deltas.setdefault('version', 1)
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update({getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()},
+                 synchronize_session='fetch'))
+
+    @classmethod
+    def touch(cls, user_ids):
+        """Bump the `version` of the given user(s) without changing counters."""
+
+        cls.bump_counts(user_ids)
+
+    @classmethod
+    def recount(cls, ids=None):
+        """Recompute users' counters (all, or those in `ids`) from the tables.
+
+        Bumps `version` too, since any of the counters may have moved.
+        """
+
+        def count(table, column):
+            return (db.select([db.func.count()])
+                    .select_from(table)
+                    .where(column == cls.id)
+                    .as_scalar())
+
+        query = cls.query if ids is None else cls.query.filter(cls.id.in_(ids))
+
+        # `User.following` is the user_being_followed_id side of Follows
+        query.update({
+            cls.messages_count: count(Message.__table__, Message.user_id),
+            cls.following_count: count(Follows.__table__, Follows.user_being_followed_id),
+            cls.followers_count: count(Follows.__table__, Follows.user_following_id),
+            cls.likes_count: count(LikedMessage.__table__, LikedMessage.user_id),
+            cls.version: cls.version + 1,
+        }, synchronize_session=False)
+
+    @classmethod
+    def get_many(cls, ids):
+        """Load the users with these ids, in the same order, in one query.
+
+        Users already in the session's identity map aren't fetched again;
+        ids with no user are skipped.
+        """
+
+        ids = list(ids)
+        found = {}
+
+        for id in ids:
+            user = db.session.identity_map.get(identity_key(cls, id))
+            if user is not None:
+                found[id] = user
+
+        missing = [id for id in ids if id not in found]
+
+        if missing:
+            for user in cls.query.filter(cls.id.in_(missing)):
+                found[user.id] = user
+
+        return [found[id] for id in ids if id in found]
+
     @property
     def pending_friend_requests(self):
+        """(user, request) pairs for pending requests sent to this user."""
 
-        requests = (
-            FollowRequest
-            .query
-            .filter(FollowRequest.user_requested_id == self.id)
-            .filter(FollowRequest.status == "Pending")
-            .all())
-
-        users = [User.query.get(request.user_requesting_id) for request in requests]
-        return users
+        return (db.session
+                .query(User, FollowRequest)
+                .join(FollowRequest, FollowRequest.user_requesting_id == User.id)
+                .filter(FollowRequest.user_requested_id == self.id)
+                .filter(FollowRequest.status == "Pending")
+                .order_by(User.username)
+                .all())
 
     @property
     def pending_sent_friend_requests(self):
+        """(user, request) pairs for pending requests this user has sent."""
 
-        requests = (
-            FollowRequest
-            .query
-            .filter(FollowRequest.user_requesting_id == self.id)
-            .filter(FollowRequest.status == "Pending")
-            .all())
+        return (db.session
+                .query(User, FollowRequest)
+                .join(FollowRequest, FollowRequest.user_requested_id == User.id)
+                .filter(FollowRequest.user_requesting_id == self.id)
+                .filter(FollowRequest.status == "Pending")
+                .order_by(User.username)
+                .all())
 
-        users = [User.query.get(request.user_requested_id) for request in requests]
-        return users
+    @property
+    def inbox_count(self):
+        """How many direct messages this user hasn't read yet."""
+
+        return (db.session
+                .query(db.func.coalesce(db.func.sum(ConversationMember.unread_count), 0))
+                .filter(ConversationMember.user_id == self.id)
+                .scalar())
+
+    @property
+    def pending_friend_requests_count(self):
+        """How many pending requests have been sent to this user."""
+
+        return (FollowRequest
+                .query
+                .filter(FollowRequest.user_requested_id == self.id)
+                .filter(FollowRequest.status == "Pending")
+                .count())
 
     def show_messages(self):
-        """Show messages"""
-        messages = (Message
-                    .query
-                    .filter(Message.user_id == self.id)
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return messages
+        """Query of this user's messages (ordering is left to the paginator)"""
+        return Message.query.filter(Message.user_id == self.id)
     
     def show_private_account_messages(self, logged_in_user):
         """Show private account messages"""
-        if self in logged_in_user.following:
+        if logged_in_user.is_following(self):
             return self.show_messages()
         else:
-            return []
+            return Message.query.filter(db.false())
+
+    def show_liked_messages(self):
+        """Query of messages this user has liked"""
+        return (Message
+                .query
+                .join(LikedMessage, LikedMessage.message_id == Message.id)
+                .filter(LikedMessage.user_id == self.id))
+
+# Indexes behind the ranked /users?q= search (see search.py): trigrams on the
+# username and a full-text vector over bio and location. PostgreSQL only;
+# SQLite test runs fall back to scanning with Python functions. They're
+# idempotent so migrations.py can re-run them against existing databases.
+
+POSTGRES_USERS_DDL = [
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users "
+        "USING gin (username gin_trgm_ops)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_users_bio_location_tsv ON users "
+        "USING gin (to_tsvector('simple', coalesce(bio, '') || ' ' || coalesce(location, '')))"),
+]
+
+for ddl in POSTGRES_USERS_DDL:
+    event.listen(User.__table__, 'after_create', ddl.execute_if(dialect='postgresql'))
+
 
 class DirectMessage(db.Model):
     """Model for Direct Message"""
@@ -270,7 +567,7 @@ class DirectMessage(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_from_id = db.Column(
@@ -283,6 +580,11 @@ class DirectMessage(db.Model):
         db.ForeignKey('users.id', ondelete="cascade")
     )
 
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete="cascade"),
+    )
+
     sent_to_user = db.relationship(
             "User",
             backref="inbox",
@@ -295,6 +597,218 @@ class DirectMessage(db.Model):
             foreign_keys=user_from_id
     )
 
+    __table_args__ = (
+        db.Index('ix_direct_messages_to_timestamp', user_to_id, timestamp.desc()),
+        db.Index('ix_direct_messages_from_timestamp', user_from_id, timestamp.desc()),
+        db.Index('ix_direct_messages_conversation_timestamp',
+                 conversation_id, timestamp.desc(), id.desc()),
+    )
+
+    @classmethod
+    def send(cls, user_from_id, user_to_id, text):
+        """Add a message to the pair's conversation and update its inbox rows.
+
+        Moves the conversation to the top of both users' inboxes and counts
+        the message as unread for the recipient.
+        """
+
+        conversation = Conversation.between(user_from_id, user_to_id)
+        message = cls(text=text, user_from_id=user_from_id, user_to_id=user_to_id,
+                      conversation_id=conversation.id)
+        db.session.add(message)
+        db.session.flush()
+
+        conversation.last_message_id = message.id
+        (ConversationMember.query
+         .filter(ConversationMember.conversation_id == conversation.id)
+         .update({
+             ConversationMember.last_message_at: message.timestamp,
+             ConversationMember.unread_count: db.case(
+                 [(ConversationMember.user_id == user_to_id, ConversationMember.unread_count + 1)],
+                 else_=ConversationMember.unread_count),
+         }, synchronize_session=False))
+
+        return message
+
+
+class Conversation(db.Model):
+    """The direct messages between one pair of users.
+
+    The pair is stored with the smaller id first, so there is exactly one
+    conversation per pair. Each user's side of it (their inbox row) is a
+    `ConversationMember`.
+    """
+
+    __tablename__ = 'conversations'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_low_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    user_high_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # Not a foreign key: direct_messages already references this table, and
+    # a key each way would make neither table creatable first
+    last_message_id = db.Column(
+        db.Integer,
+    )
+
+    last_message = db.relationship(
+        'DirectMessage',
+        primaryjoin='foreign(Conversation.last_message_id) == DirectMessage.id',
+        viewonly=True,
+        uselist=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_conversations_users', user_low_id, user_high_id, unique=True),
+    )
+
+    @classmethod
+    def between(cls, user_id, other_user_id, create=True):
+        """The conversation between two users, created if need be (and `create`)."""
+
+        low, high = sorted((user_id, other_user_id))
+        conversation = cls.query.filter_by(user_low_id=low, user_high_id=high).first()
+
+        if conversation is None and create:
+            conversation = cls(user_low_id=low, user_high_id=high)
+            db.session.add(conversation)
+            db.session.flush()
+
+            now = datetime.utcnow()
+            db.session.add_all(ConversationMember(conversation_id=conversation.id, user_id=member,
+                                                  other_user_id=other, last_message_at=now)
+                               for member, other in {(low, high), (high, low)})
+            db.session.flush()
+
+        return conversation
+
+    def messages(self):
+        """Query of this conversation's messages."""
+
+        return DirectMessage.query.filter(DirectMessage.conversation_id == self.id)
+
+    @classmethod
+    def rebuild(cls):
+        """Group direct messages that have no conversation yet into conversations."""
+
+        pairs = {tuple(sorted(pair)) for pair in
+                 db.session.query(DirectMessage.user_from_id, DirectMessage.user_to_id)
+                 .filter(DirectMessage.conversation_id.is_(None))
+                 .distinct()}
+
+        for user_id, other_user_id in pairs:
+            cls.between(user_id, other_user_id)
+
+        matching = (db.select([cls.id])
+                    .where(db.or_(
+                        db.and_(cls.user_low_id == DirectMessage.user_from_id,
+                                cls.user_high_id == DirectMessage.user_to_id),
+                        db.and_(cls.user_low_id == DirectMessage.user_to_id,
+                                cls.user_high_id == DirectMessage.user_from_id)))
+                    .as_scalar())
+        (DirectMessage.query
+         .filter(DirectMessage.conversation_id.is_(None))
+         .update({DirectMessage.conversation_id: matching}, synchronize_session=False))
+
+        last_message = (db.select([DirectMessage.id])
+                        .where(DirectMessage.conversation_id == cls.id)
+                        .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+                        .limit(1)
+                        .as_scalar())
+        cls.query.update({cls.last_message_id: last_message}, synchronize_session=False)
+
+        last_message_at = (db.select([db.func.max(DirectMessage.timestamp)])
+                           .where(DirectMessage.conversation_id == ConversationMember.conversation_id)
+                           .as_scalar())
+        (ConversationMember.query
+         .update({ConversationMember.last_message_at: db.func.coalesce(
+             last_message_at, ConversationMember.last_message_at)},
+             synchronize_session=False))
+
+
+class ConversationMember(db.Model):
+    """One user's side of a conversation: their inbox row for it."""
+
+    __tablename__ = 'conversation_members'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # copied from the last message so the inbox is one range read on the index
+    last_message_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    unread_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    conversation = db.relationship('Conversation')
+
+    other_user = db.relationship('User', foreign_keys=other_user_id)
+
+    __table_args__ = (
+        # the inbox: one user's conversations by last activity, keyset on
+        # (last_message_at, conversation_id)
+        db.Index('ix_conversation_members_user_activity',
+                 user_id, last_message_at.desc(), conversation_id.desc()),
+    )
+
+    @classmethod
+    def inbox(cls, user_id):
+        """Query of `user_id`'s conversations with the other user and last
+        message loaded alongside.
+
+        Page through it ordered by (last_message_at, conversation_id).
+        """
+
+        return (cls.query
+                .filter(cls.user_id == user_id)
+                .options(db.joinedload(cls.other_user),
+                         db.joinedload(cls.conversation).joinedload(Conversation.last_message)))
+
+    @classmethod
+    def mark_read(cls, user_id, conversation_id):
+        """Clear the unread count; returns whether there was anything unread."""
+
+        return bool(cls.query
+                    .filter(cls.user_id == user_id,
+                            cls.conversation_id == conversation_id,
+                            cls.unread_count > 0)
+                    .update({cls.unread_count: 0}, synchronize_session=False))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -314,7 +828,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -323,8 +837,500 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # how many users like this message; kept in step by LikedMessage.like/unlike
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def bump_likes(cls, message_id, delta):
+        """Atomically add `delta` to a message's likes_count."""
+
+        (cls.query
+         .filter(cls.id == message_id)
+         .update({cls.likes_count: cls.likes_count + delta},
+                 synchronize_session=False))
+
+    @classmethod
+    def recount(cls, ids=None):
+        """Recompute likes_count of every message (or those in `ids`)."""
+
+        likes = (db.select([db.func.count()])
+                 .select_from(LikedMessage.__table__)
+                 .where(LikedMessage.message_id == cls.id)
+                 .as_scalar())
+
+        query = cls.query if ids is None else cls.query.filter(cls.id.in_(ids))
+        query.update({cls.likes_count: likes}, synchronize_session=False)
+
+    __table_args__ = (
+        # profile pages: one user's messages, newest first, keyset on (timestamp, id)
+        db.Index('ix_messages_user_timestamp', user_id, timestamp.desc(), id.desc()),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message pushed into a follower's precomputed home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home feed is a single range read on (user_id, timestamp) instead of an
+    IN (...) query over every followee.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', timestamp.desc(), message_id.desc()),
+    )
+
+    @classmethod
+    def audience(cls, author_id):
+        """Query of the users whose timelines `author_id`'s messages go on.
+
+        Remember that `Follows.user_following_id` is the user being
+        followed here (see `User.following`), so the followers of the
+        author are the `user_being_followed_id` side of those rows.
+        """
+
+        return (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == author_id)
+                .union_all(db.session.query(db.literal(author_id))))
+
+    @classmethod
+    def fan_out(cls, message):
+        """Push `message` onto the timelines of its author and followers.
+
+        Leaves them one entry longer; `trim` them afterwards (the
+        `trim_timelines` job does, off the request).
+        """
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                db.session.query(cls.audience(message.user_id).subquery(),
+                                 db.literal(message.id), db.literal(message.timestamp))
+                .statement))
+
+    @classmethod
+    def backfill(cls, follower_id, followee_id):
+        """Copy recent messages of `followee_id` into the follower's timeline."""
+
+        already = (db.session
+                   .query(cls.message_id)
+                   .filter(cls.user_id == follower_id))
+
+        recent = (db.session
+                  .query(db.literal(follower_id), Message.id, Message.timestamp)
+                  .filter(Message.user_id == followee_id)
+                  .filter(~Message.id.in_(already))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(TIMELINE_MAX_LENGTH))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'], recent.statement))
+
+        cls.trim([follower_id])
+
+    @classmethod
+    def prune(cls, follower_id, followee_id):
+        """Remove messages of `followee_id` from the follower's timeline."""
+
+        followee_messages = (db.session
+                             .query(Message.id)
+                             .filter(Message.user_id == followee_id))
+
+        (cls.query
+         .filter(cls.user_id == follower_id)
+         .filter(cls.message_id.in_(followee_messages.subquery()))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Keep only the newest TIMELINE_MAX_LENGTH entries of each user's
+        timeline, for a list or query of user ids, in one statement."""
+
+        ranked = (db.session
+                  .query(cls.user_id, cls.message_id,
+                         db.func.row_number().over(
+                             partition_by=cls.user_id,
+                             order_by=(cls.timestamp.desc(), cls.message_id.desc()),
+                         ).label('position'))
+                  .filter(cls.user_id.in_(user_ids))
+                  .subquery())
+
+        stale = (db.session
+                 .query(ranked.c.user_id, ranked.c.message_id)
+                 .filter(ranked.c.position > TIMELINE_MAX_LENGTH))
+
+        (cls.query
+         .filter(db.tuple_(cls.user_id, cls.message_id).in_(stale.subquery()))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user):
+        """Recompute `user`'s timeline from scratch from who they follow."""
+
+        cls.query.filter(cls.user_id == user.id).delete(synchronize_session=False)
+
+        for followee_id in [user.id] + [followee.id for followee in user.following]:
+            cls.backfill(user.id, followee_id)
+
+    @classmethod
+    def messages_for(cls, user_id):
+        """Query of the messages on `user_id`'s timeline.
+
+        Page through it ordered by (TimelineEntry.timestamp,
+        TimelineEntry.message_id) so the read stays on the index.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id))
+
+
+class Recommendation(db.Model):
+    """A "who to follow" suggestion for a user, with its score.
+
+    The whole table is recomputed from the follow graph now and then
+    (recommendations.py); in between, `followed` and `unfollowed` adjust the
+    friend-of-friend part of the scores as people follow and unfollow.
+    """
+
+    __tablename__ = 'recommendations'
+
+    # what one path user -> followee -> candidate adds to a score
+    FRIEND_OF_FRIEND_SCORE = 1.0
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    recommended_user = db.relationship('User', foreign_keys=recommended_user_id)
+
+    __table_args__ = (
+        db.Index('ix_recommendations_user_score', user_id, score.desc()),
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit=5):
+        """Query of the best suggestions for `user_id` they don't follow yet."""
+
+        return (cls.query
+                .filter(cls.user_id == user_id)
+                .filter(cls.recommended_user_id.notin_(cls._followees_of(user_id).subquery()))
+                .order_by(cls.score.desc(), cls.recommended_user_id)
+                .limit(limit))
+
+    @classmethod
+    def _followees_of(cls, user_id):
+        # `User.following` is the user_being_followed_id side of Follows
+        return (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == user_id))
+
+    @classmethod
+    def followed(cls, follower_id, followee_id, keep=20):
+        """`follower_id` now follows `followee_id`: suggest who they follow,
+        keeping the best `keep` suggestions."""
+
+        cls.query.filter_by(user_id=follower_id, recommended_user_id=followee_id).delete()
+
+        candidates = cls._followees_of(followee_id).filter(Follows.user_following_id != follower_id)
+        already = cls._followees_of(follower_id)
+        suggested = db.session.query(cls.recommended_user_id).filter(cls.user_id == follower_id)
+
+        (cls.query
+         .filter(cls.user_id == follower_id,
+                 cls.recommended_user_id.in_(candidates.subquery()))
+         .update({cls.score: cls.score + cls.FRIEND_OF_FRIEND_SCORE},
+                 synchronize_session=False))
+
+        new = (candidates
+               .filter(Follows.user_following_id.notin_(already.subquery()))
+               .filter(Follows.user_following_id.notin_(suggested.subquery()))
+               .with_entities(db.literal(follower_id), Follows.user_following_id,
+                              db.literal(cls.FRIEND_OF_FRIEND_SCORE)))
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'recommended_user_id', 'score'], new))
+
+        best = (db.session
+                .query(cls.recommended_user_id)
+                .filter(cls.user_id == follower_id)
+                .order_by(cls.score.desc(), cls.recommended_user_id)
+                .limit(keep))
+        (cls.query
+         .filter(cls.user_id == follower_id,
+                 cls.recommended_user_id.notin_(best.subquery()))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def unfollowed(cls, follower_id, followee_id):
+        """Undo what `followed` added for this follow."""
+
+        candidates = cls._followees_of(followee_id)
+
+        (cls.query
+         .filter(cls.user_id == follower_id,
+                 cls.recommended_user_id.in_(candidates.subquery()))
+         .update({cls.score: cls.score - cls.FRIEND_OF_FRIEND_SCORE},
+                 synchronize_session=False))
+
+        (cls.query
+         .filter(cls.user_id == follower_id, cls.score <= 0)
+         .delete(synchronize_session=False))
+
+
+class TrendingBucket(db.Model):
+    """Likes and posts of one message during one minute.
+
+    Each web process counts them in memory and adds its counts here every
+    minute or so (trending.py), so a row is the total over all processes.
+    """
+
+    __tablename__ = 'trending_buckets'
+
+    minute = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    # no foreign key: a message can be deleted while its counts are still in
+    # memory; the rows go when they age out of the window
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    posts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # the same statement on Postgres and SQLite (3.24+)
+    _ADD = db.text(
+        "INSERT INTO trending_buckets (minute, message_id, likes, posts) "
+        "VALUES (:minute, :message_id, :likes, :posts) "
+        "ON CONFLICT (minute, message_id) DO UPDATE SET "
+        "likes = trending_buckets.likes + excluded.likes, "
+        "posts = trending_buckets.posts + excluded.posts"
+    ).bindparams(db.bindparam('minute', type_=db.DateTime))
+
+    @classmethod
+    def add(cls, rows):
+        """Add `{minute, message_id, likes, posts}` counts to the stored ones."""
+
+        if rows:
+            db.session.execute(cls._ADD, rows)
+
+    @classmethod
+    def since(cls, start):
+        """(message_id, minute, likes) from `start` on, for messages that still exist."""
+
+        return (db.session
+                .query(cls.message_id, cls.minute, cls.likes)
+                .join(Message, Message.id == cls.message_id)
+                .filter(cls.minute >= start, cls.likes != 0))
+
+    @classmethod
+    def totals(cls, start):
+        """(likes, posts) over every message still there from `start` on."""
+
+        likes, posts = (db.session
+                        .query(db.func.sum(cls.likes), db.func.sum(cls.posts))
+                        .join(Message, Message.id == cls.message_id)
+                        .filter(cls.minute >= start)
+                        .one())
+        return likes or 0, posts or 0
+
+    @classmethod
+    def prune(cls, before):
+        """Drop the buckets older than `before`."""
+
+        cls.query.filter(cls.minute < before).delete(synchronize_session=False)
+
+
+class Job(db.Model):
+    """A piece of work queued for the background worker (`flask worker`).
+
+    Jobs are rows, so they are enqueued in the same transaction as whatever
+    asked for them and survive restarts. A worker claims a job by marking it
+    running until `locked_until`; if it hasn't finished by then (the worker
+    died, say) another worker may claim it again, so handlers must be safe
+    to run twice. Failed jobs are retried with backoff up to `max_attempts`.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    @classmethod
+    def enqueue(cls, name, run_at=None, **kwargs):
+        """Add a job to the session; it is queued when the session commits.
+
+        It runs as soon as a worker is free, or not before `run_at`.
+        """
+
+        job = cls(name=name, args=json.dumps(kwargs), run_at=run_at or datetime.utcnow())
+        db.session.add(job)
+        return job
+
+    @classmethod
+    def claim(cls, visibility_timeout=300):
+        """Mark the next runnable job as running and return it, or None.
+
+        Commits the claim straight away. On PostgreSQL the candidate row is
+        picked with SKIP LOCKED; everywhere the UPDATE re-checks that the job
+        is still claimable, so two workers can't both win it.
+        """
+
+        now = datetime.utcnow()
+        claimable = db.or_(
+            db.and_(cls.status == 'queued', cls.run_at <= now),
+            db.and_(cls.status == 'running', cls.locked_until < now),
+        )
+
+        while True:
+            job_id = (db.session
+                      .query(cls.id)
+                      .filter(claimable)
+                      .order_by(cls.run_at, cls.id)
+                      .with_for_update(skip_locked=True)
+                      .limit(1)
+                      .scalar())
+
+            if job_id is None:
+                db.session.commit()
+                return None
+
+            claimed = (cls.query
+                       .filter(cls.id == job_id, claimable)
+                       .update({cls.status: 'running',
+                                cls.locked_until: now + timedelta(seconds=visibility_timeout),
+                                cls.attempts: cls.attempts + 1},
+                               synchronize_session=False))
+            db.session.commit()
+
+            if claimed:
+                return cls.query.get(job_id)
+
+    def finish(self):
+        """Remove a job that ran successfully."""
+
+        db.session.delete(self)
+
+    def fail(self, error):
+        """Record `error` and retry with exponential backoff, or give up."""
+
+        self.last_error = error
+
+        if self.attempts >= self.max_attempts:
+            self.status = 'failed'
+        else:
+            self.status = 'queued'
+            self.run_at = datetime.utcnow() + timedelta(seconds=2 ** self.attempts)
+
+        self.locked_until = None
+
+    @property
+    def kwargs(self):
+        return json.loads(self.args)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,74 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are addressed by the (timestamp, id) of the last row on the previous
+page rather than by OFFSET, so every page costs the same index range read.
+"""
+
+import base64
+from datetime import datetime
+
+from flask import request, abort
+
+from models import db, Message
+
+
+def encode_cursor(timestamp, id):
+    """Turn a (timestamp, id) position into an opaque URL-safe cursor."""
+
+    raw = f"{timestamp.isoformat()}|{id}".encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('UTF-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id); raises ValueError if bogus."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('UTF-8')).decode('UTF-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def cursor_from_request(arg='before'):
+    """Read the cursor from the querystring, or None for the first page.
+
+    Responds with 400 Bad Request if the cursor can't be decoded.
+    """
+
+    cursor = request.args.get(arg)
+
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, before, per_page,
+             timestamp_col=Message.timestamp, id_col=Message.id,
+             key=lambda item: (item.timestamp, item.id)):
+    """Return (items, next_cursor) for one page of `query`, newest first.
+
+    `before` is a decoded (timestamp, id) cursor or None. next_cursor is
+    built from `key(item)` of the last item (by default its `timestamp` and
+    `id` attributes) and is None on the last page.
+    """
+
+    if before:
+        query = query.filter(db.tuple_(timestamp_col, id_col) < db.tuple_(*before))
+
+    items = (query
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .limit(per_page + 1)
+             .all())
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    return items, encode_cursor(*key(items[-1]))
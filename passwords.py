@@ -0,0 +1,93 @@
+"""Password hashing off the request thread, with load shedding.
+
+bcrypt is deliberately slow (hundreds of ms at the default cost), so a burst
+of logins would tie up every request thread. Hashing and checking run on a
+bounded pool of worker processes instead. When more than `max_pending`
+hashes are already queued, we refuse straight away with `PasswordHasherBusy`
+(the app turns that into a 503) rather than letting requests pile up.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already queued; try again shortly."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(password, pw_hash):
+    return bcrypt.checkpw(password, pw_hash)
+
+
+class PasswordHasher:
+    """bcrypt on a process pool.
+
+    Config:
+    - BCRYPT_LOG_ROUNDS: cost factor for new hashes
+    - PASSWORD_WORKERS: worker processes (0: hash on the calling thread)
+    - PASSWORD_MAX_PENDING: hashes queued or running before shedding load
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = 0
+        self._slots = BoundedSemaphore(64)
+        self._pool = None
+        self._pool_lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_MAX_PENDING', 4 * app.config['PASSWORD_WORKERS'] or 64)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['PASSWORD_WORKERS']
+        self._slots = BoundedSemaphore(app.config['PASSWORD_MAX_PENDING'])
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for it, if there's room."""
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            if not self.workers:
+                return fn(*args)
+
+            # started on first use, so it's created after any server fork
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.workers)
+
+            return self._pool.submit(fn, *args).result()
+
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as a str."""
+
+        return self._run(_hash, password.encode('UTF-8'), self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`? Raises ValueError on a bad hash."""
+
+        return self._run(_check, password.encode('UTF-8'), pw_hash.encode('UTF-8'))
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a different cost than we use now?"""
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
@@ -0,0 +1,130 @@
+"""Batch computation of "who to follow" suggestions from the follow graph.
+
+The follows table is read into two compressed sparse row (CSR) arrays, one
+per direction: for user i, `forward.indices[forward.indptr[i]:forward.indptr[i + 1]]`
+are the users i follows and `reverse` likewise lists i's followers. A
+candidate c's score for user u counts two kinds of two-step paths:
+
+- friend of friend: u follows f, and f follows c
+- co-follow: someone who follows u also follows c (weighted lower)
+
+Users u already follows, and u themself, are never suggested. The best
+`k` per user are written to the recommendations table in one go.
+
+Everything per user is a handful of NumPy operations on slices of these
+arrays, so millions of edges take minutes in one process. Very popular
+users would make the co-follow step huge, so at most `max_fanout`
+followers are looked at (a fixed random sample past that).
+"""
+
+import numpy as np
+
+from models import db, Follows, Recommendation
+
+CO_FOLLOW_SCORE = 0.5
+
+INSERT_BATCH = 10_000
+
+
+class CSR:
+    """Adjacency lists of a directed graph as two flat arrays."""
+
+    def __init__(self, sources, targets, size):
+        order = np.argsort(sources, kind='stable')
+        self.indices = targets[order]
+        self.indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.indptr[1:])
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def gather(self, rows):
+        """The concatenated neighbours of all `rows` (with repeats)."""
+
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+
+        if not len(lengths):
+            return self.indices[:0]
+
+        # position of every neighbour: its row's start plus 0, 1, 2, ...
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + np.arange(lengths.sum())]
+
+
+def load_graph():
+    """(user ids, forward CSR, reverse CSR) for the current follows."""
+
+    # `User.following` is the user_being_followed_id side of Follows
+    edges = np.array(db.session
+                     .query(Follows.user_being_followed_id, Follows.user_following_id)
+                     .all(), dtype=np.int64).reshape(-1, 2)
+
+    ids = np.unique(edges)
+    followers = np.searchsorted(ids, edges[:, 0])
+    followees = np.searchsorted(ids, edges[:, 1])
+
+    return ids, CSR(followers, followees, len(ids)), CSR(followees, followers, len(ids))
+
+
+def suggest(i, forward, reverse, k, max_fanout, rng):
+    """Indices and scores of the best `k` suggestions for user index `i`."""
+
+    following = forward.row(i)
+    followers = reverse.row(i)
+
+    if len(followers) > max_fanout:
+        followers = rng.choice(followers, max_fanout, replace=False)
+
+    friends_of_friends = forward.gather(following)
+    co_follows = forward.gather(followers)
+
+    candidates = np.concatenate([friends_of_friends, co_follows])
+    if not len(candidates):
+        return candidates, candidates
+
+    weights = np.concatenate([
+        np.full(len(friends_of_friends), Recommendation.FRIEND_OF_FRIEND_SCORE),
+        np.full(len(co_follows), CO_FOLLOW_SCORE),
+    ])
+
+    users, positions = np.unique(candidates, return_inverse=True)
+    scores = np.bincount(positions, weights=weights)
+
+    keep = (users != i) & ~np.isin(users, following)
+    users, scores = users[keep], scores[keep]
+
+    if len(users) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        users, scores = users[best], scores[best]
+
+    return users, scores
+
+
+def recompute(k=10, max_fanout=1000, seed=0, echo=print):
+    """Replace every user's suggestions with freshly computed ones.
+
+    Runs in the current transaction; the caller commits.
+    """
+
+    ids, forward, reverse = load_graph()
+    rng = np.random.default_rng(seed)
+    echo(f"{len(forward.indices)} follows between {len(ids)} users")
+
+    Recommendation.query.delete(synchronize_session=False)
+
+    rows = []
+    table = Recommendation.__table__
+
+    for i in range(len(ids)):
+        users, scores = suggest(i, forward, reverse, k, max_fanout, rng)
+        rows.extend({'user_id': int(ids[i]), 'recommended_user_id': int(ids[user]),
+                     'score': float(score)}
+                    for user, score in zip(users, scores))
+
+        if len(rows) >= INSERT_BATCH:
+            db.session.execute(table.insert(), rows)
+            rows = []
+
+    if rows:
+        db.session.execute(table.insert(), rows)
@@ -0,0 +1,105 @@
+"""Ranked user search for /users?q=.
+
+On PostgreSQL this is served by a pg_trgm index on username and a tsvector
+index on bio + location (both declared in models.py). SQLite has neither, so
+there we register pure-Python stand-ins for the same functions on each
+connection and run the same query as a table scan; fine for test runs.
+"""
+
+import re
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, User
+
+# Must mirror the expression of the ix_users_bio_location_tsv index exactly,
+# or PostgreSQL won't use it.
+DOCUMENT = db.func.coalesce(User.bio, '') + ' ' + db.func.coalesce(User.location, '')
+
+
+def trigrams(text):
+    """Set of pg_trgm-style trigrams of each word in `text`."""
+
+    grams = set()
+
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+def similarity(a, b):
+    """Share of trigrams `a` and `b` have in common, like pg_trgm's."""
+
+    if not a or not b:
+        return 0.0
+
+    a_grams, b_grams = trigrams(a), trigrams(b)
+
+    if not a_grams or not b_grams:
+        return 0.0
+
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+def words_rank(document, query):
+    """Share of the words in `query` that appear in `document`."""
+
+    query_words = set(re.findall(r'\w+', (query or '').lower()))
+
+    if not query_words:
+        return 0.0
+
+    document_words = set(re.findall(r'\w+', (document or '').lower()))
+    return len(query_words & document_words) / len(query_words)
+
+
+def words_match(document, query):
+    """1 if every word in `query` appears in `document`, like `@@`."""
+
+    return int(words_rank(document, query) == 1.0)
+
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    """Give SQLite connections the functions the search query needs."""
+
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        dbapi_connection.create_function('similarity', 2, similarity)
+        dbapi_connection.create_function('words_match', 2, words_match)
+        dbapi_connection.create_function('words_rank', 2, words_rank)
+
+
+def search_users(q, page=1, per_page=24):
+    """Return (users, has_next) for one page of users matching `q`.
+
+    Matches are usernames containing `q` or bios/locations containing all
+    its words, best match first.
+    """
+
+    pattern = '%' + re.sub(r'([\\%_])', r'\\\1', q) + '%'
+
+    if db.engine.dialect.name == 'postgresql':
+        vector = db.func.to_tsvector('simple', DOCUMENT)
+        tsquery = db.func.plainto_tsquery('simple', q)
+        matches_document = vector.op('@@')(tsquery)
+        document_rank = db.func.ts_rank(vector, tsquery)
+
+    else:
+        matches_document = db.func.words_match(DOCUMENT, q) == 1
+        document_rank = db.func.words_rank(DOCUMENT, q)
+
+    users = (User
+             .query
+             .filter(db.or_(User.username.ilike(pattern, escape='\\'),
+                            matches_document))
+             .filter(User.deleted == db.false())
+             .order_by((db.func.similarity(User.username, q) + document_rank).desc(),
+                       User.id)
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+
+    return users[:per_page], len(users) > per_page
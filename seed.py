@@ -1,20 +1,23 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py                # the checked-in CSVs in generator/
+    python seed.py path/to/csvs   # e.g. the output of create_csvs.py --out
+"""
+
+import sys
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message
+import loader
 
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+loader.load(sys.argv[1] if len(sys.argv) > 1 else 'generator')
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+# bulk loading skips the counter bookkeeping, so compute them in one go
+User.recount()
+Message.recount()
 
 db.session.commit()
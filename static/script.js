@@ -1,11 +1,8 @@
 $(function () {
-  $.ajax({
-    url: '/autocomplete'
-  }).done(function (data) {
-    $('#search').autocomplete({
-      source: data,
-      minLength: 1
-    });
+  // ask the server for matches as the user types
+  $('#search').autocomplete({
+    source: '/autocomplete',
+    minLength: 1
   });
 });
 
@@ -16,4 +13,72 @@ let $stat = $(".stat");
 $stat.on("click", function(e){
   // $stat.removeClass("active");
   $(e.target).addClass("active");
-});
\ No newline at end of file
+});
+
+// add new warbles from followed users to the home timeline as they're posted
+$(function () {
+  let $timeline = $('#messages[data-live-url]');
+
+  if (!$timeline.length || !window.EventSource) {
+    return;
+  }
+
+  let lastEventId = null;
+
+  function connect() {
+    let url = $timeline.data('live-url');
+
+    if (lastEventId) {
+      url += (url.includes('?') ? '&' : '?') + 'last_event_id=' + encodeURIComponent(lastEventId);
+    }
+
+    let source = new EventSource(url);
+
+    source.addEventListener('message', function (e) {
+      let warble = JSON.parse(e.data);
+      lastEventId = e.lastEventId;
+
+      if ($timeline.find(`[data-message-id="${warble.id}"]`).length) {
+        return;
+      }
+
+      // the first item is the new-warble form
+      $timeline.children('li').first().after(warble.html);
+    });
+
+    // the browser reconnects by itself when a stream ends, but not after an
+    // error response (e.g. a 503 when the server is full): try again later
+    source.addEventListener('error', function () {
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(connect, 15000 + Math.random() * 15000);
+      }
+    });
+  }
+
+  connect();
+});
+
+
+// like and unlike in place through the JSON API instead of reloading the page
+$(document).on('submit', 'form[action$="/like/add"]', function (e) {
+  e.preventDefault();
+
+  let $form = $(this);
+  let $icon = $form.find('i');
+  let url = $form.attr('action').replace(/\/add$/, '');
+
+  $.ajax({ url: url, method: $icon.hasClass('fas') ? 'DELETE' : 'PUT' })
+    .done(function (data) {
+      $icon.toggleClass('fas', data.liked).toggleClass('far', !data.liked);
+    });
+});
+
+
+// fill in the "who to follow" sidebar after the page has loaded
+$(function () {
+  let $suggestions = $('#who-to-follow[data-url]');
+
+  if ($suggestions.length) {
+    $suggestions.load($suggestions.data('url'));
+  }
+});
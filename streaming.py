@@ -0,0 +1,48 @@
+"""Render long pages as they are generated instead of all at once.
+
+`render_template` builds the whole page as one string before anything is
+sent, so a user with 50k followers meant a multi-megabyte string (and every
+`User` row) held in memory first. `stream_template` sends the page in pieces
+while Jinja renders it, and `preloaded` feeds the template from a
+server-side cursor in batches, so neither the rows nor the HTML are ever all
+in memory together.
+"""
+
+from flask import Response, current_app, g, stream_with_context
+
+STREAM_BATCH_SIZE = 200
+
+
+def stream_template(template_name, **context):
+    """Like `render_template`, but returns a streamed `Response`."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    stream = template.stream(context)
+    # Flush roughly every few cards rather than on every tiny string
+    stream.enable_buffering(16)
+
+    return Response(stream_with_context(stream))
+
+
+def preloaded(query, batch_size=STREAM_BATCH_SIZE):
+    """Users from `query`, fetched in batches with follow state preloaded.
+
+    Uses `yield_per`, i.e. a server-side cursor on PostgreSQL, and calls
+    `g.viewer.preload` once per batch before handing its users out.
+    """
+
+    batch = []
+
+    for user in query.yield_per(batch_size):
+        batch.append(user)
+
+        if len(batch) == batch_size:
+            g.viewer.preload(users=batch)
+            yield from batch
+            batch = []
+
+    g.viewer.preload(users=batch)
+    yield from batch
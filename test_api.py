@@ -0,0 +1,316 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message, LikedMessage, Follows, FollowRequest, DirectMessage, Conversation
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 routes."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        # make any relationship a view forgot to load raise, rather than
+        # quietly issuing a query per row
+        self.raise_on_lazy_load = app.config['RAISE_ON_LAZY_LOAD']
+        app.config['RAISE_ON_LAZY_LOAD'] = True
+
+        DirectMessage.query.delete()
+        Conversation.query.delete()
+        FollowRequest.query.delete()
+        Follows.query.delete()
+        LikedMessage.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        # only alice logs in with a password
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User(username="bob", email="bob@test.com", password="HASHED_PASSWORD")
+        self.carol = User(username="carol", email="carol@test.com", password="HASHED_PASSWORD",
+                          private=True)
+        db.session.add_all([self.bob, self.carol])
+        db.session.commit()
+
+        start = datetime(2024, 1, 1)
+        for i in range(5):
+            db.session.add(Message(id=i + 1, text=f"bob says {i}", user_id=self.bob.id,
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.add(Message(id=6, text="carol's secret", user_id=self.carol.id,
+                               timestamp=start))
+        db.session.commit()
+
+        self.alice_id, self.bob_id, self.carol_id = self.alice.id, self.bob.id, self.carol.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['RAISE_ON_LAZY_LOAD'] = self.raise_on_lazy_load
+
+    def log_in(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_login(self):
+        """Does POST /session log in, with JSON only?"""
+
+        resp = self.client.post('/api/v1/session', data={'username': 'alice', 'password': 'password'})
+        self.assertEqual(resp.status_code, 415)
+
+        resp = self.client.post('/api/v1/session', json={'username': 'alice', 'password': 'wrong!'})
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {'error': "Invalid credentials."})
+
+        resp = self.client.post('/api/v1/session', json={'username': 'alice', 'password': 'password'})
+        self.assertEqual(resp.get_json()['username'], 'alice')
+        self.assertNotIn('email', resp.get_json())
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 200)
+
+        self.client.delete('/api/v1/session')
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
+
+    def test_profile_fields(self):
+        """Does ?fields= pick (and nest) the fields returned?"""
+
+        resp = self.client.get(f'/api/v1/users/{self.bob_id}?fields=username,followers_count')
+        self.assertEqual(resp.get_json(), {'username': 'bob', 'followers_count': 0})
+
+        resp = self.client.get('/api/v1/messages/1?fields=text,user')
+        self.assertEqual(resp.get_json(), {
+            'text': "bob says 0",
+            'user': {'id': self.bob_id, 'username': 'bob',
+                     'image_url': "/static/images/default-pic.png"},
+        })
+
+        resp = self.client.get('/api/v1/messages/1?fields=text,email')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("Unknown field 'email'", resp.get_json()['error'])
+
+        self.assertEqual(self.client.get('/api/v1/users/99999').status_code, 404)
+
+    def test_timeline_pages(self):
+        """Does the timeline page through followed users' messages by cursor?"""
+
+        self.log_in(self.alice_id)
+        self.client.put(f'/api/v1/users/{self.bob_id}/follow')
+
+        resp = self.client.get('/api/v1/timeline?limit=2&fields=id')
+        first = resp.get_json()
+        self.assertEqual(first['data'], [{'id': 5}, {'id': 4}])
+
+        second = self.client.get(f"/api/v1/timeline?limit=2&fields=id&cursor={first['next_cursor']}").get_json()
+        third = self.client.get(f"/api/v1/timeline?limit=2&fields=id&cursor={second['next_cursor']}").get_json()
+
+        self.assertEqual(second['data'], [{'id': 3}, {'id': 2}])
+        self.assertEqual(third, {'data': [{'id': 1}], 'next_cursor': None})
+
+        self.assertEqual(self.client.get('/api/v1/timeline?cursor=bogus').status_code, 400)
+
+    def test_private_messages(self):
+        """Are a private account's messages only shown to its followers?"""
+
+        self.log_in(self.alice_id)
+        self.assertEqual(self.client.get(f'/api/v1/users/{self.carol_id}/messages').status_code, 403)
+
+        resp = self.client.put(f'/api/v1/users/{self.carol_id}/follow')
+        self.assertEqual(resp.get_json(), {'user_id': self.carol_id, 'status': 'requested'})
+
+        # asking again changes nothing
+        resp = self.client.put(f'/api/v1/users/{self.carol_id}/follow')
+        self.assertEqual(resp.get_json()['status'], 'requested')
+        self.assertEqual(self.client.get('/api/v1/requests/sent').get_json()['data'][0]['username'],
+                         'carol')
+
+        self.log_in(self.carol_id)
+        requests = self.client.get('/api/v1/requests?fields=id').get_json()
+        self.assertEqual(requests['data'], [{'id': self.alice_id}])
+        self.assertEqual(self.client.put(f'/api/v1/requests/{self.alice_id}').status_code, 200)
+        self.assertEqual(self.client.put(f'/api/v1/requests/{self.alice_id}').status_code, 404)
+
+        self.log_in(self.alice_id)
+        resp = self.client.get(f'/api/v1/users/{self.carol_id}/messages?fields=text')
+        self.assertEqual(resp.get_json()['data'], [{'text': "carol's secret"}])
+
+        self.assertEqual(self.client.get('/api/v1/messages/6?fields=text').get_json(),
+                         {'text': "carol's secret"})
+
+        followers = self.client.get(f'/api/v1/users/{self.carol_id}/followers?fields=username')
+        self.assertEqual(followers.get_json()['data'], [{'username': 'alice'}])
+        self.assertEqual(User.query.get(self.carol_id).followers_count, 1)
+
+    def test_private_message_hidden(self):
+        """Is a private account's message kept from non-followers, liked or not?"""
+
+        db.session.add(LikedMessage(user_id=self.bob_id, message_id=6))
+        db.session.add(LikedMessage(user_id=self.bob_id, message_id=1))
+        db.session.commit()
+
+        self.assertEqual(self.client.get('/api/v1/messages/6').status_code, 403)
+
+        self.log_in(self.alice_id)
+        self.assertEqual(self.client.get('/api/v1/messages/6').status_code, 403)
+        self.assertEqual(self.client.get('/api/v1/messages/1').status_code, 200)
+
+        liked = self.client.get(f'/api/v1/users/{self.bob_id}/likes?fields=id')
+        self.assertEqual(liked.get_json()['data'], [{'id': 1}])
+
+        self.log_in(self.carol_id)
+        self.assertEqual(self.client.get('/api/v1/messages/6').status_code, 200)
+        liked = self.client.get(f'/api/v1/users/{self.bob_id}/likes?fields=id')
+        self.assertEqual(liked.get_json()['data'], [{'id': 6}, {'id': 1}])
+
+    def test_follow_and_unfollow(self):
+        """Do PUT and DELETE on /follow follow and unfollow, idempotently?"""
+
+        self.log_in(self.alice_id)
+
+        for _ in range(2):
+            resp = self.client.put(f'/api/v1/users/{self.bob_id}/follow')
+            self.assertEqual(resp.get_json()['status'], 'following')
+
+        following = self.client.get(f'/api/v1/users/{self.alice_id}/following').get_json()
+        self.assertEqual([user['username'] for user in following['data']], ['bob'])
+        self.assertEqual(User.query.get(self.bob_id).followers_count, 1)
+
+        for _ in range(2):
+            resp = self.client.delete(f'/api/v1/users/{self.bob_id}/follow')
+            self.assertEqual(resp.get_json()['status'], 'not_following')
+
+        self.assertEqual(User.query.get(self.bob_id).followers_count, 0)
+        self.assertEqual(self.client.put(f'/api/v1/users/{self.alice_id}/follow').status_code, 400)
+
+    def test_likes(self):
+        """Can messages be liked and unliked, and liked ones listed?"""
+
+        self.assertEqual(self.client.put('/api/v1/messages/1/like').status_code, 401)
+
+        self.log_in(self.alice_id)
+        self.client.put('/api/v1/messages/1/like')
+        resp = self.client.put('/api/v1/messages/1/like')
+        self.assertEqual(resp.get_json(), {'message_id': 1, 'liked': True, 'likes': 1})
+
+        liked = self.client.get(f'/api/v1/users/{self.alice_id}/likes?fields=id,likes_count')
+        self.assertEqual(liked.get_json()['data'], [{'id': 1, 'likes_count': 1}])
+
+        resp = self.client.delete('/api/v1/messages/1/like')
+        self.assertEqual(resp.get_json()['likes'], 0)
+        self.assertEqual(self.client.put('/api/v1/messages/999/like').status_code, 404)
+
+    def test_private_message_like(self):
+        """Can only a private account's followers like its messages?"""
+
+        self.log_in(self.alice_id)
+        self.assertEqual(self.client.put('/api/v1/messages/6/like').status_code, 403)
+        self.assertEqual(self.client.put('/messages/6/like').status_code, 403)
+        self.assertEqual(LikedMessage.query.count(), 0)
+
+        self.log_in(self.carol_id)
+        self.assertEqual(self.client.put('/api/v1/messages/6/like').get_json()['likes'], 1)
+
+    def test_post_message(self):
+        """Can a message be posted, and is a bad one refused?"""
+
+        self.log_in(self.alice_id)
+
+        resp = self.client.post('/api/v1/messages?fields=text,user.username', json={'text': "hi"})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json(), {'text': "hi", 'user': {'username': 'alice'}})
+        self.assertEqual(User.query.get(self.alice_id).messages_count, 1)
+
+        resp = self.client.post('/api/v1/messages', json={'text': ""})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('text', resp.get_json()['error'])
+
+    def test_direct_messages(self):
+        """Can direct messages be sent, listed, and conversations read?"""
+
+        self.log_in(self.alice_id)
+        resp = self.client.post(f'/api/v1/conversations/{self.bob_id}', json={'text': "hello bob"})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()['user_to_id'], self.bob_id)
+
+        self.log_in(self.bob_id)
+        inbox = self.client.get('/api/v1/conversations?fields=unread_count,other_user.username,last_message')
+        self.assertEqual(inbox.get_json()['data'], [{
+            'unread_count': 1,
+            'other_user': {'username': 'alice'},
+            'last_message': {'text': "hello bob", 'user_from_id': self.alice_id},
+        }])
+
+        messages = self.client.get(f'/api/v1/conversations/{self.alice_id}?fields=text')
+        self.assertEqual(messages.get_json()['data'], [{'text': "hello bob"}])
+
+        inbox = self.client.get('/api/v1/conversations?fields=unread_count')
+        self.assertEqual(inbox.get_json()['data'], [{'unread_count': 0}])
+        self.assertEqual(self.client.get(f'/api/v1/conversations/{self.carol_id}').status_code, 404)
+
+    def test_gzip(self):
+        """Are big responses gzipped for clients that accept it?"""
+
+        resp = self.client.get(f'/api/v1/users/{self.bob_id}/messages',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        for i in range(30):
+            db.session.add(Message(text="x" * 100, user_id=self.bob_id))
+        db.session.commit()
+
+        resp = self.client.get(f'/api/v1/users/{self.bob_id}/messages',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))['data']), 20)
+
+        resp = self.client.get(f'/api/v1/users/{self.bob_id}/messages')
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    @skipUnless(msgpack, "needs msgpack")
+    def test_msgpack(self):
+        """Is MessagePack sent to clients asking for it?"""
+
+        resp = self.client.get('/api/v1/messages/1?fields=id,text',
+                               headers={'Accept': 'application/msgpack'})
+        self.assertEqual(resp.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(resp.data, raw=False), {'id': 1, 'text': "bob says 0"})
+
+    @skipUnless(msgpack is None, "msgpack is installed")
+    def test_msgpack_unavailable(self):
+        """Without msgpack, is asking for MessagePack refused?"""
+
+        resp = self.client.get('/api/v1/messages/1?format=msgpack')
+        self.assertEqual(resp.status_code, 406)
+        self.assertIn('error', resp.get_json())
@@ -0,0 +1,85 @@
+"""Autocomplete tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_autocomplete.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, usernames
+from autocomplete import UsernameIndex
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class AutocompleteTestCase(TestCase):
+    """Test the username prefix index and /autocomplete."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        for i, username in enumerate(["alice", "Alfred", "albert", "bob"]):
+            db.session.add(User(
+                id=10000 + i,
+                email=f"{username}@test.com",
+                username=username,
+                password="HASHED_PASSWORD"
+            ))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_index_search(self):
+        """Matches are case-insensitive, sorted and limited"""
+
+        index = UsernameIndex()
+
+        self.assertEqual(index.search("al"), ["albert", "Alfred", "alice"])
+        self.assertEqual(index.search("AL", limit=2), ["albert", "Alfred"])
+        self.assertEqual(index.search("z"), [])
+
+    def test_index_updates(self):
+        """Adds, renames and removals show up without a reload"""
+
+        index = UsernameIndex()
+        index.search("a")
+
+        index.add("alan")
+        index.rename("bob", "alex")
+        index.remove("alice")
+
+        self.assertEqual(index.search("al"), ["alan", "albert", "alex", "Alfred"])
+        self.assertEqual(index.search("b"), [])
+
+    def test_autocomplete_view(self):
+        """Testing /autocomplete returns matches for the term"""
+
+        usernames.clear()
+
+        response = self.client.get('/autocomplete?term=bo')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, ["bob"])
+        self.assertIn('max-age=60', response.headers['Cache-Control'])
@@ -0,0 +1,128 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, LikedMessage, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from fragments import FragmentCache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the {% cache %} tag and its LRU."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Follows.query.delete()
+        LikedMessage.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 4000
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.viewer.id = 4001
+        db.session.commit()
+
+        db.session.add(Message(id=400, text="Cached warble", user_id=4000))
+        db.session.commit()
+
+        app.jinja_env.fragment_cache.clear()
+        self.client = app.test_client()
+
+    def test_lru_evicts_past_cap(self):
+        """Are the least recently used fragments dropped past max_bytes?"""
+
+        cache = FragmentCache(max_bytes=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.get('a')
+        cache.set('c', 'cccc')
+
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.hit_ratio(), 0.75)
+
+    def test_card_cached_like_button_dynamic(self):
+        """Is the card reused while the like button still follows the viewer?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4001
+
+            hits = app.jinja_env.fragment_cache.hits
+            c.get('/users/4000')
+            self.assertEqual(app.jinja_env.fragment_cache.hits, hits)
+
+            c.post('/messages/400/like/add')
+            resp = c.get('/users/4000')
+
+            self.assertEqual(app.jinja_env.fragment_cache.hits, hits + 1)
+            self.assertIn(b'Cached warble', resp.data)
+            self.assertIn(b'fas fa-heart', resp.data)
+
+    def test_profile_change_invalidates_card(self):
+        """Does editing the author's profile render the card again?"""
+
+        self.client.get('/users/4000')
+        hits = app.jinja_env.fragment_cache.hits
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4000
+
+            c.post('/users/profile', data={'username': "renamed", 'email': "author@test.com",
+                                           'image_url': "", 'header_image_url': "",
+                                           'password': "password"})
+
+        self.assertEqual(User.query.get(4000).profile_version, 1)
+
+        resp = self.client.get('/users/4000')
+        self.assertIn(b'@renamed', resp.data)
+        self.assertEqual(app.jinja_env.fragment_cache.hits, hits)
+
+    def test_counter_change_keeps_card(self):
+        """Do new followers leave the author's cards cached?"""
+
+        self.client.get('/users/4000')
+        hits = app.jinja_env.fragment_cache.hits
+
+        db.session.add(Follows(user_being_followed_id=4001, user_following_id=4000))
+        User.bump_counts(4000, followers_count=1)
+        db.session.commit()
+
+        self.client.get('/users/4000')
+        self.assertEqual(app.jinja_env.fragment_cache.hits, hits + 1)
+
+    def test_hit_ratio_on_metrics(self):
+        """Is the hit ratio reported as a gauge?"""
+
+        resp = self.client.get('/metrics')
+        self.assertIn('fragment_cache_hit_ratio', resp.json['gauges'])
@@ -0,0 +1,67 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+USERS = 20
+MESSAGES = 50
+FOLLOWS = 100
+
+
+def generate(directory, seed=0):
+    subprocess.run([sys.executable, 'generator/create_csvs.py',
+                    '--users', str(USERS), '--messages', str(MESSAGES),
+                    '--follows', str(FOLLOWS), '--seed', str(seed), '--out', directory],
+                   check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_rows(directory, filename):
+    with open(os.path.join(directory, filename), newline='') as csv_file:
+        return list(csv.reader(csv_file))[1:]
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating a tiny dataset."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        generate(cls.directory.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_row_counts(self):
+        """Are as many rows written as were asked for?"""
+
+        self.assertEqual(len(read_rows(self.directory.name, 'users.csv')), USERS)
+        self.assertEqual(len(read_rows(self.directory.name, 'messages.csv')), MESSAGES)
+        self.assertEqual(len(read_rows(self.directory.name, 'follows.csv')), FOLLOWS)
+
+    def test_follows_distinct(self):
+        """Are follows free of repeats and self-follows, between real users?"""
+
+        follows = [tuple(map(int, row)) for row in read_rows(self.directory.name, 'follows.csv')]
+
+        self.assertEqual(len(set(follows)), len(follows))
+        self.assertFalse([pair for pair in follows if pair[0] == pair[1]])
+        self.assertTrue(all(1 <= id <= USERS for pair in follows for id in pair))
+
+    def test_same_seed_same_files(self):
+        """Does a seed always give the same data?"""
+
+        with tempfile.TemporaryDirectory() as again:
+            generate(again)
+
+            for filename in ('users.csv', 'messages.csv', 'follows.csv'):
+                self.assertEqual(read_rows(again, filename),
+                                 read_rows(self.directory.name, filename))
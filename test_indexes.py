@@ -0,0 +1,170 @@
+"""Query plan tests for the hot query shapes."""
+
+# run these tests like:
+#
+#    python -m unittest test_indexes.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db, Message, FollowRequest, Follows, DirectMessage, TimelineEntry, LikedMessage, ConversationMember
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app
+import migrations
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class QueryPlanTestCase(TestCase):
+    """Each page's main query should be answered from an index.
+
+    The test tables are tiny, so on PostgreSQL we switch sequential scans
+    off: an index scan is then chosen only if a usable index exists.
+    """
+
+    def setUp(self):
+        migrations.upgrade(echo=lambda step: None)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plan(self, query):
+        """EXPLAIN output for `query`, as one string."""
+
+        dialect = db.engine.dialect
+        sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+        if dialect.name == 'postgresql':
+            db.session.execute("SET LOCAL enable_seqscan = off")
+            rows = db.session.execute(f"EXPLAIN {sql}")
+        else:
+            rows = db.session.execute(f"EXPLAIN QUERY PLAN {sql}")
+
+        return "\n".join(str(row[-1]) for row in rows)
+
+    def assertUsesIndex(self, query, index_name):
+        plan = self.plan(query)
+        self.assertIn(index_name, plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_profile_messages(self):
+        """Profile pages read one user's messages newest first"""
+
+        query = (Message.query
+                 .filter(Message.user_id == 1)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(21))
+        self.assertUsesIndex(query, 'ix_messages_user_timestamp')
+
+    def test_home_timeline(self):
+        """The precomputed home feed is a range read"""
+
+        query = (TimelineEntry.query
+                 .filter(TimelineEntry.user_id == 1)
+                 .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+                 .limit(21))
+        self.assertUsesIndex(query, 'ix_timeline_entries_user_timestamp')
+
+    def test_pending_requests(self):
+        """The requests page lists pending requests in both directions"""
+
+        received = (FollowRequest.query
+                    .filter(FollowRequest.user_requested_id == 1)
+                    .filter(FollowRequest.status == "Pending"))
+        self.assertUsesIndex(received, 'ix_follow_requests_requested_pending')
+
+        # sent ones through the primary key (requesting id, requested id)
+        sent = (FollowRequest.query
+                .filter(FollowRequest.user_requesting_id == 1)
+                .filter(FollowRequest.status == "Pending"))
+        primary_key = ('follow_requests_pkey' if db.engine.dialect.name == 'postgresql'
+                       else 'sqlite_autoindex_follow_requests_1')
+        self.assertUsesIndex(sent, primary_key)
+
+    def test_dropped_indexes(self):
+        """Are indexes taken out of the models dropped by upgrade?"""
+
+        db.engine.execute("CREATE INDEX ix_follow_requests_requesting_pending "
+                          "ON follow_requests (user_requesting_id)")
+
+        done = migrations.upgrade(echo=lambda step: None)
+        self.assertIn("dropped index ix_follow_requests_requesting_pending", done)
+
+        existing = {index['name'] for index in inspect(db.engine).get_indexes('follow_requests')}
+        self.assertNotIn('ix_follow_requests_requesting_pending', existing)
+
+    def test_followers(self):
+        """Followers are found through user_following_id"""
+
+        query = Follows.query.filter(Follows.user_following_id == 1)
+        self.assertUsesIndex(query, 'ix_follows_following_followed')
+
+    def test_user_likes(self):
+        """A user's likes are found through user_id"""
+
+        query = LikedMessage.query.filter(LikedMessage.user_id == 1)
+        self.assertUsesIndex(query, 'ix_liked_messages_user_message')
+
+    def test_inbox(self):
+        """The inbox reads one user's direct messages newest first"""
+
+        query = (DirectMessage.query
+                 .filter(DirectMessage.user_to_id == 1)
+                 .order_by(DirectMessage.timestamp.desc()))
+        self.assertUsesIndex(query, 'ix_direct_messages_to_timestamp')
+
+    def test_conversation_inbox(self):
+        """The conversation list reads one user's inbox rows by last activity"""
+
+        query = (ConversationMember.query
+                 .filter(ConversationMember.user_id == 1)
+                 .order_by(ConversationMember.last_message_at.desc(),
+                           ConversationMember.conversation_id.desc())
+                 .limit(21))
+        self.assertUsesIndex(query, 'ix_conversation_members_user_activity')
+
+    def test_conversation_thread(self):
+        """A conversation's messages are read newest first"""
+
+        query = (DirectMessage.query
+                 .filter(DirectMessage.conversation_id == 1)
+                 .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+                 .limit(21))
+        self.assertUsesIndex(query, 'ix_direct_messages_conversation_timestamp')
+
+    def test_added_column_foreign_key(self):
+        """Does a column added by upgrade get its foreign key?"""
+
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("SQLite can't drop a column with a foreign key")
+
+        for index in inspect(db.engine).get_indexes('direct_messages'):
+            if 'conversation_id' in index['column_names']:
+                db.engine.execute(f"DROP INDEX {index['name']}")
+        db.engine.execute("ALTER TABLE direct_messages DROP COLUMN conversation_id")
+
+        done = migrations.upgrade(echo=lambda step: None)
+        self.assertIn("added column direct_messages.conversation_id", done)
+
+        foreign_keys = [foreign_key for foreign_key in inspect(db.engine).get_foreign_keys('direct_messages')
+                        if foreign_key['constrained_columns'] == ['conversation_id']]
+        self.assertEqual([(foreign_key['referred_table'], foreign_key['options'].get('ondelete'))
+                          for foreign_key in foreign_keys],
+                         [('conversations', 'CASCADE')])
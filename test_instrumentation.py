@@ -0,0 +1,119 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, instrumentation
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Test per-request query counts and timings."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u = User(
+            id=10000,
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add(u)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_server_timing_header(self):
+        """Responses report query count and timings"""
+
+        response = self.client.get('/users/10000')
+        timing = response.headers['Server-Timing']
+
+        self.assertIn('db;dur=', timing)
+        self.assertIn('tmpl;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertNotIn('"0 queries"', timing)
+
+    def test_metrics(self):
+        """Requests show up in the per-endpoint histogram"""
+
+        self.client.get('/users/10000')
+        metrics = self.client.get('/metrics').json
+
+        self.assertGreaterEqual(metrics['endpoints']['users_show']['requests'], 1)
+        self.assertGreater(metrics['endpoints']['users_show']['queries_per_request'], 0)
+
+    def test_metrics_only_local_or_with_token(self):
+        """Is /metrics refused to other hosts unless they have the token?"""
+
+        remote = {'REMOTE_ADDR': '203.0.113.7'}
+        self.assertEqual(self.client.get('/metrics', environ_base=remote).status_code, 403)
+
+        app.config['METRICS_TOKEN'] = 's3cret'
+        try:
+            wrong = self.client.get('/metrics', environ_base=remote,
+                                    headers={'Authorization': 'Bearer guess'})
+            right = self.client.get('/metrics', environ_base=remote,
+                                    headers={'Authorization': 'Bearer s3cret'})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        self.assertEqual(wrong.status_code, 403)
+        self.assertEqual(right.status_code, 200)
+
+    def test_failed_query_forgotten(self):
+        """Does a failing statement leave no start time behind?"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute("SELECT * FROM no_such_table")
+
+            self.assertEqual(conn.info['query_started'], [])
+
+    def test_slow_request_log(self):
+        """Requests over the threshold are logged as JSON lines"""
+
+        with tempfile.NamedTemporaryFile('r', suffix='.jsonl') as log:
+            app.config['SLOW_REQUEST_LOG'] = log.name
+            app.config['SLOW_REQUEST_MS'] = 0
+
+            try:
+                self.client.get('/users/10000')
+            finally:
+                app.config['SLOW_REQUEST_LOG'] = None
+                app.config['SLOW_REQUEST_MS'] = 500
+
+            entry = json.loads(log.readline())
+
+        self.assertEqual(entry['endpoint'], 'users_show')
+        self.assertEqual(entry['path'], '/users/10000')
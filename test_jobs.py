@@ -0,0 +1,183 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Job, TimelineEntry, LikedMessage
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@jobs.task('test_flaky')
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError("flaky")
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, claiming, retries and the job handlers."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Job.query.delete()
+        Follows.query.delete()
+        LikedMessage.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        self.u1 = User(id=6000, email="one@test.com", username="one", password="HASHED_PASSWORD")
+        self.u2 = User(id=6001, email="two@test.com", username="two", password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def work(self):
+        jobs.work(once=True, echo=lambda line: None)
+
+    def test_unknown_job(self):
+        """Are jobs without a handler refused when queued?"""
+
+        with self.assertRaises(LookupError):
+            jobs.enqueue('no_such_job')
+
+    def test_retry_with_backoff(self):
+        """Does a failing job go back in the queue until it succeeds?"""
+
+        jobs.enqueue('test_flaky', fail_times=1)
+        db.session.commit()
+
+        self.work()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('RuntimeError', job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # not due yet
+        self.work()
+        self.assertEqual(calls, [1])
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.work()
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_gives_up_after_max_attempts(self):
+        """Is a job that keeps failing marked failed?"""
+
+        job = jobs.enqueue('test_flaky', fail_times=10)
+        job.max_attempts = 2
+        db.session.commit()
+
+        for _ in range(2):
+            self.work()
+            Job.query.update({Job.run_at: datetime.utcnow()})
+            db.session.commit()
+
+        self.assertEqual(Job.query.one().status, 'failed')
+        self.assertEqual(len(calls), 2)
+
+    def test_visibility_timeout(self):
+        """Is a running job reclaimed only once its lock has expired?"""
+
+        jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+
+        job = Job.claim(visibility_timeout=60)
+        self.assertIsNotNone(job)
+        self.assertIsNone(Job.claim())
+
+        job.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(Job.claim().id, job.id)
+
+    def test_delete_user_job(self):
+        """Does deleting an account disable it at once, and queue the work
+        that removes it and fixes counters?"""
+
+        self.u1.following.append(self.u2)
+        db.session.add_all([Message(id=610, text="first", user_id=6000),
+                            Message(id=611, text="second", user_id=6000)])
+        db.session.commit()
+        db.session.add_all([LikedMessage(user_id=6001, message_id=610),
+                            LikedMessage(user_id=6001, message_id=611)])
+        db.session.commit()
+        User.recount()
+        db.session.commit()
+        self.assertEqual(User.query.get(6001).followers_count, 1)
+        self.assertEqual(User.query.get(6001).likes_count, 2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 6000
+
+            response = c.post('/users/delete')
+            self.assertEqual(response.status_code, 302)
+
+        # gone as far as anyone can tell before the job runs
+        self.assertTrue(User.query.get(6000).deleted)
+        self.assertEqual(self.client.get('/users/6000').status_code, 404)
+        self.assertIsNone(User.query.filter_by(username="one").first())
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 6000
+
+            self.assertEqual(c.get('/api/v1/timeline').status_code, 401)
+
+        self.work()
+
+        self.assertIsNone(User.query.get(6000))
+        self.assertEqual(User.query.get(6001).followers_count, 0)
+        self.assertEqual(User.query.get(6001).likes_count, 0)
+
+    def test_backfill_skipped_after_unfollow(self):
+        """Does a stale backfill job leave the timeline alone?"""
+
+        db.session.add(Message(id=600, text="old warble", user_id=6001))
+        db.session.commit()
+
+        jobs.enqueue('backfill_timeline', follower_id=6000, followee_id=6001)
+        db.session.commit()
+        self.work()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=6000).count(), 0)
+
+        self.u1.following.append(self.u2)
+        jobs.enqueue('backfill_timeline', follower_id=6000, followee_id=6001)
+        db.session.commit()
+        self.work()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=6000).count(), 1)
@@ -0,0 +1,203 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+import os
+import json
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, live_events, live_connections, CURR_USER_KEY
+from live import Broker, ConnectionLimit, MemoryBackend, format_sse
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BrokerTestCase(TestCase):
+    """Test the in-process broker."""
+
+    def test_resume_after_last_id(self):
+        """Does subscribing with a last id replay only what came after it?"""
+
+        broker = Broker(MemoryBackend())
+        first = broker.publish({'n': 1})
+        broker.publish({'n': 2})
+        broker.publish({'n': 3})
+
+        events = broker.subscribe(first, heartbeat=0)
+        self.assertEqual([next(events)[1]['n'] for _ in range(2)], [2, 3])
+        self.assertIsNone(next(events))
+
+    def test_new_subscribers_start_at_latest(self):
+        """Do new subscribers skip history, and unknown ids start from now?"""
+
+        broker = Broker(MemoryBackend())
+        broker.publish({'n': 1})
+
+        self.assertIsNone(next(broker.subscribe(heartbeat=0)))
+        self.assertIsNone(next(broker.subscribe('999', heartbeat=0)))
+
+    def test_buffer_is_bounded(self):
+        """Are old events dropped past maxlen?"""
+
+        broker = Broker(MemoryBackend(maxlen=2))
+        for n in range(5):
+            broker.publish({'n': n})
+
+        events = broker.subscribe('0', heartbeat=0)
+        self.assertEqual([next(events)[1]['n'] for _ in range(2)], [3, 4])
+
+    def test_connection_limit(self):
+        """Are connections past the limit refused until one is released?"""
+
+        limit = ConnectionLimit(2)
+        self.assertTrue(limit.acquire())
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+
+        limit.release()
+        self.assertTrue(limit.acquire())
+
+    def test_format_sse(self):
+        """Are multi-line payloads split into data lines?"""
+
+        self.assertEqual(format_sse("a\nb", event='message', id='7'),
+                         "id: 7\nevent: message\ndata: a\ndata: b\n\n")
+        self.assertEqual(format_sse(comment='heartbeat'), ": heartbeat\n\n")
+
+
+class LiveViewTestCase(TestCase):
+    """Test the /live event stream."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.reader = User(id=5000, email="reader@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        self.author = User(id=5001, email="author@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.stranger = User(id=5002, email="stranger@test.com", username="stranger",
+                             password="HASHED_PASSWORD")
+        db.session.add_all([self.reader, self.author, self.stranger])
+        db.session.commit()
+
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+        # ids are reused from test to test, so cached cards would go stale
+        app.jinja_env.fragment_cache.clear()
+        self.client = app.test_client()
+
+    def post_as(self, user_id, text):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        client.post('/messages/new', data={'text': text})
+
+    def test_live_requires_login(self):
+        """Are anonymous users turned away?"""
+
+        self.assertEqual(self.client.get('/live').status_code, 401)
+
+    def test_live_pushes_followed_messages(self):
+        """Are followed authors' new messages pushed, and others' skipped?"""
+
+        last_id = live_events.backend.latest_id()
+        self.post_as(5002, "not for you")
+        self.post_as(5001, "hot off the press")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5000
+
+            response = c.get('/live', headers={'Last-Event-ID': last_id})
+            self.assertEqual(response.mimetype, 'text/event-stream')
+
+            chunks = iter(response.response)
+            self.assertEqual(next(chunks), b'retry: 3000\n\n')
+
+            event = next(chunks).decode()
+            data = json.loads(event.split('data: ', 1)[1])
+            self.assertIn('event: message', event)
+            self.assertIn('hot off the press', data['html'])
+            self.assertIn('fa-heart', data['html'])
+            response.close()
+
+    def test_live_turns_away_past_limit(self):
+        """Past the connection limit, is a 503 with a retry hint sent?"""
+
+        live_connections.limit = 1
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5000
+
+            first = self.client.get('/live')
+            busy = self.client.get('/live')
+
+            self.assertEqual(busy.status_code, 503)
+            self.assertIn('Retry-After', busy.headers)
+            self.assertTrue(busy.get_data(as_text=True).startswith('retry: '))
+
+            first.close()
+            again = self.client.get('/live')
+            self.assertEqual(again.status_code, 200)
+            again.close()
+
+        finally:
+            live_connections.limit = app.config['LIVE_MAX_CONNECTIONS']
+
+        self.assertEqual(live_connections.open, 0)
+
+    def test_live_ends_after_max_seconds(self):
+        """Does a stream end on its own, leaving off after what it skipped?"""
+
+        last_id = live_events.backend.latest_id()
+        self.post_as(5001, "hot off the press")
+        self.post_as(5002, "not for you")
+        skipped_id = live_events.backend.latest_id()
+
+        app.config['LIVE_HEARTBEAT'] = 0
+        app.config['LIVE_MAX_SECONDS'] = 0.2
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5000
+
+            response = self.client.get('/live', headers={'Last-Event-ID': last_id})
+            chunks = [chunk.decode() for chunk in response.response]
+            response.close()
+
+        finally:
+            app.config['LIVE_HEARTBEAT'] = 15
+            app.config['LIVE_MAX_SECONDS'] = 5 * 60
+
+        self.assertIn('hot off the press', chunks[1])
+        self.assertNotIn('not for you', ''.join(chunks))
+        self.assertEqual(chunks[-1], f"id: {skipped_id}\n\n")
@@ -0,0 +1,107 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db, User, Message, Follows, LikedMessage, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app
+import loader
+import migrations
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+CSVS = {
+    'users.csv': (
+        'id,email,username,image_url,password,bio,header_image_url,location\n'
+        '8001,ada@test.com,ada,/a.png,HASHED_PASSWORD,"Hi, I\'m Ada",/h.png,London\n'
+        '8002,bob@test.com,bob,/b.png,HASHED_PASSWORD,,/h.png,Paris\n'
+    ),
+    'messages.csv': (
+        'id,text,timestamp,user_id\n'
+        '8101,"two\nlines",2024-01-01 10:00:00,8001\n'
+        '8102,plain,2024-01-02 10:00:00,8002\n'
+        '8103,"a ""quote""",2024-01-03 10:00:00,8001\n'
+    ),
+    'follows.csv': (
+        'user_being_followed_id,user_following_id\n'
+        '8001,8002\n'
+    ),
+}
+
+
+class LoaderTestCase(TestCase):
+    """Test loading the generator's CSVs."""
+
+    def setUp(self):
+        """Empty the tables and write a tiny set of CSVs."""
+
+        TimelineEntry.query.delete()
+        LikedMessage.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.directory = tempfile.TemporaryDirectory()
+
+        for filename, content in CSVS.items():
+            with open(os.path.join(self.directory.name, filename), 'w', newline='') as csv_file:
+                csv_file.write(content)
+
+    def tearDown(self):
+        db.session.rollback()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """Do the rows come back as written, with the indexes rebuilt?"""
+
+        loader.load(self.directory.name, chunk_rows=2, echo=lambda line: None)
+
+        self.assertEqual(User.query.get(8001).bio, "Hi, I'm Ada")
+        self.assertEqual([m.text for m in Message.query.order_by(Message.id)],
+                         ["two\nlines", "plain", 'a "quote"'])
+        self.assertEqual(Follows.query.count(), 1)
+
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            self.assertEqual(migrations.missing_indexes(inspector, table), [])
+
+        # new rows get ids past the loaded ones
+        db.session.add(Message(text="new", user_id=8002))
+        db.session.commit()
+        self.assertGreater(Message.query.filter_by(text="new").one().id, 8103)
+
+    def test_schema_restored_after_failure(self):
+        """Are the indexes put back even when a file is missing?"""
+
+        os.remove(os.path.join(self.directory.name, 'follows.csv'))
+
+        with self.assertRaises(FileNotFoundError):
+            loader.load(self.directory.name, echo=lambda line: None)
+
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            self.assertEqual(migrations.missing_indexes(inspector, table), [])
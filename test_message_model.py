@@ -17,6 +17,7 @@ from sqlalchemy.exc import IntegrityError as ie
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
 
 
 # Now we can import app
@@ -7,8 +7,10 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, LikedMessage
+from sqlalchemy.exc import InvalidRequestError
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,11 +18,15 @@ from models import db, connect_db, Message, User
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from caching import static_url
+from like_buffer import LikeBuffer
+from loading import eager
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -39,9 +45,16 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        # make any relationship a view forgot to load raise, rather than
+        # quietly issuing a query per row
+        self.raise_on_lazy_load = app.config['RAISE_ON_LAZY_LOAD']
+        app.config['RAISE_ON_LAZY_LOAD'] = True
+
         User.query.delete()
         Message.query.delete()
 
+        # ids are reused from test to test, so cached cards would go stale
+        app.jinja_env.fragment_cache.clear()
         self.client = app.test_client()
 
         self.testuser = User(
@@ -59,6 +72,9 @@ class MessageViewTestCase(TestCase):
         db.session.add(message)
         db.session.commit()
 
+    def tearDown(self):
+        app.config['RAISE_ON_LAZY_LOAD'] = self.raise_on_lazy_load
+
     def test_add_message(self):
         """Can use add a message?"""
 
@@ -97,4 +113,124 @@ class MessageViewTestCase(TestCase):
             
             response = self.client.post('/messages/100/delete')
             self.assertFalse(Message.query.get(100))
-     
\ No newline at end of file
+     
+    def test_message_view_not_modified(self):
+        """Is a repeat view answered with 304 until the author changes?"""
+
+        response = self.client.get('/messages/100')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get('/messages/100', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        User.touch(10000)
+        db.session.commit()
+
+        response = self.client.get('/messages/100', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_static_versioned_urls(self):
+        """Are content-hashed static URLs cached for good?"""
+
+        response = self.client.get('/messages/100')
+        self.assertIn(b'/static/script.js?v=', response.data)
+
+        with app.test_request_context():
+            url = static_url('script.js')
+
+        response = self.client.get(url)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+        response = self.client.get('/static/script.js')
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        response.close()
+
+    def test_like_api_idempotent(self):
+        """Do repeated likes and unlikes leave one like, and counters right?"""
+
+        liker = User(id=10001, username="liker", email="liker@test.com", password="liker")
+        db.session.add(liker)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 10001
+
+            for _ in range(2):
+                response = c.put('/messages/100/like')
+                self.assertEqual(response.json, {'message_id': 100, 'liked': True, 'likes': 1})
+
+            self.assertEqual(LikedMessage.query.count(), 1)
+            self.assertEqual(User.query.get(10001).likes_count, 1)
+
+            for _ in range(2):
+                response = c.delete('/messages/100/like')
+                self.assertEqual(response.json, {'message_id': 100, 'liked': False, 'likes': 0})
+
+            self.assertEqual(LikedMessage.query.count(), 0)
+            self.assertEqual(User.query.get(10001).likes_count, 0)
+            self.assertEqual(c.put('/messages/999/like').status_code, 404)
+
+        self.assertEqual(app.test_client().put('/messages/100/like').status_code, 401)
+
+    def test_like_buffer_coalesces(self):
+        """Are buffered toggles collapsed into their final state on flush?"""
+
+        liker = User(id=10001, username="liker", email="liker@test.com", password="liker")
+        db.session.add(liker)
+        db.session.commit()
+
+        buffer = LikeBuffer(app)
+        for liked in (True, False, True):
+            buffer.set(10001, 100, liked)
+        buffer.set(10000, 100, False)
+
+        self.assertEqual(LikedMessage.query.count(), 0)
+        buffer.flush()
+
+        self.assertEqual([(like.user_id, like.message_id) for like in LikedMessage.query.all()],
+                         [(10001, 100)])
+        self.assertEqual(Message.query.get(100).likes_count, 1)
+        self.assertEqual(User.query.get(10001).likes_count, 1)
+        self.assertIsNone(buffer.get(10001, 100))
+
+    def test_like_toggle_buffered(self):
+        """With a buffer, does the no-JS toggle flip the buffered state, not the table?"""
+
+        liker = User(id=10001, username="liker", email="liker@test.com", password="liker")
+        db.session.add(liker)
+        db.session.commit()
+
+        buffer = LikeBuffer(app)
+        self.addCleanup(app.config.__setitem__, 'LIKE_BUFFER_SECONDS',
+                        app.config['LIKE_BUFFER_SECONDS'])
+        app.config['LIKE_BUFFER_SECONDS'] = 2.0
+
+        with patch('app.like_buffer', buffer), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 10001
+
+            c.post('/messages/100/like/add')
+            self.assertTrue(buffer.get(10001, 100))
+
+            c.post('/messages/100/like/add')
+            self.assertFalse(buffer.get(10001, 100))
+
+        self.assertEqual(LikedMessage.query.count(), 0)
+
+    def test_eager_loading(self):
+        """Are configured relationships loaded up front, and others refused?"""
+
+        db.session.expunge_all()
+
+        with app.test_request_context():
+            message = eager(Message.query, Message.user).filter(Message.id == 100).one()
+
+            self.assertIn('user', message.__dict__)
+            with self.assertRaises(InvalidRequestError):
+                message.liked_users
+
@@ -0,0 +1,152 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows, Recommendation, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import recommendations
+from recommendations import CSR
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+def follow(follower_id, followee_id):
+    # `User.following` is the user_being_followed_id side of Follows
+    db.session.add(Follows(user_being_followed_id=follower_id, user_following_id=followee_id))
+
+
+class RecommendationTestCase(TestCase):
+    """Test computing, updating and serving suggestions."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Job.query.delete()
+        Recommendation.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for id in range(1, 8):
+            db.session.add(User(id=id, email=f"user{id}@test.com", username=f"user{id}",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        # 1 follows 2, who follows 3 and 4; 5 follows 1 and 6
+        for follower_id, followee_id in ((1, 2), (2, 3), (2, 4), (5, 1), (5, 6)):
+            follow(follower_id, followee_id)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def suggestions(self, user_id):
+        return {(r.recommended_user_id, r.score)
+                for r in Recommendation.query.filter_by(user_id=user_id)}
+
+    def test_csr_gather(self):
+        """Does gather concatenate the neighbours of several rows?"""
+
+        graph = CSR(np.array([0, 2, 0, 2]), np.array([1, 0, 3, 1]), 4)
+        self.assertEqual(list(graph.row(0)), [1, 3])
+        self.assertEqual(sorted(graph.gather(np.array([0, 1, 2]))), [0, 1, 1, 3])
+
+    def test_recompute(self):
+        """Are friends of friends and co-follows scored, and follows skipped?"""
+
+        recommendations.recompute(echo=lambda line: None)
+        db.session.commit()
+
+        self.assertEqual(self.suggestions(1), {(3, 1.0), (4, 1.0), (6, 0.5)})
+        self.assertEqual(self.suggestions(5), {(2, 1.0)})
+
+    def test_recompute_top_k(self):
+        """Is each user's list cut to the best k?"""
+
+        follow(1, 7)
+        follow(7, 3)
+        db.session.commit()
+
+        recommendations.recompute(k=1, echo=lambda line: None)
+        db.session.commit()
+
+        self.assertEqual(self.suggestions(1), {(3, 2.0)})
+
+    def test_incremental_updates(self):
+        """Do follows and unfollows adjust friend-of-friend scores?"""
+
+        follow(5, 2)
+        Recommendation.followed(5, 2)
+        db.session.commit()
+        self.assertEqual(self.suggestions(5), {(3, 1.0), (4, 1.0)})
+
+        Follows.query.filter_by(user_being_followed_id=5, user_following_id=2).delete()
+        Recommendation.unfollowed(5, 2)
+        db.session.commit()
+        self.assertEqual(self.suggestions(5), set())
+
+    def test_incremental_update_capped(self):
+        """Does a follow leave at most `keep` suggestions?"""
+
+        follow(5, 2)
+        Recommendation.followed(5, 2, keep=1)
+        db.session.commit()
+        self.assertEqual(self.suggestions(5), {(3, 1.0)})
+
+    def test_follow_queues_update(self):
+        """Does following someone queue an update the worker applies?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 5
+
+            c.post('/users/follow/2')
+
+        jobs.work(once=True, echo=lambda line: None)
+        self.assertEqual(self.suggestions(5), {(3, 1.0), (4, 1.0)})
+
+    def test_stale_update_skipped(self):
+        """Is an update for a follow since undone left alone?"""
+
+        jobs.enqueue('update_recommendations', follower_id=5, followee_id=2, followed=True)
+        db.session.commit()
+
+        jobs.work(once=True, echo=lambda line: None)
+        self.assertEqual(self.suggestions(5), set())
+
+    def test_sidebar(self):
+        """Does the sidebar list suggestions the user doesn't follow yet?"""
+
+        recommendations.recompute(echo=lambda line: None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            html = c.get('/users/suggestions').get_data(as_text=True)
+            self.assertIn('@user3', html)
+            self.assertIn('@user6', html)
+            self.assertNotIn('@user2', html)
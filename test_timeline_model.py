@@ -0,0 +1,127 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineEntryModelTestCase(TestCase):
+    """Test for TimelineEntry model."""
+
+    def setUp(self):
+        """Create two users, where follower follows author."""
+
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.author = User(
+            id=10000,
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+        self.follower = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        db.session.add_all([self.author, self.follower])
+        self.follower.following.append(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_fan_out(self):
+        """Posting pushes the message to the author and their followers"""
+
+        message = Message(id=100, text="Test text", user_id=10000)
+        db.session.add(message)
+        db.session.flush()
+        TimelineEntry.fan_out(message)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.messages_for(10000).all(), [message])
+        self.assertEqual(TimelineEntry.messages_for(10002).all(), [message])
+
+    def test_trim_keeps_newest(self):
+        """Trimming cuts the author's and followers' timelines to the newest"""
+
+        for id in range(100, 103):
+            message = Message(id=id, text="Test text", user_id=10000,
+                              timestamp=datetime(2024, 1, 1, 12, id - 100))
+            db.session.add(message)
+            db.session.flush()
+            TimelineEntry.fan_out(message)
+        db.session.commit()
+
+        with patch('models.TIMELINE_MAX_LENGTH', 2):
+            TimelineEntry.trim(TimelineEntry.audience(10000))
+            db.session.commit()
+
+        for user_id in (10000, 10002):
+            self.assertEqual({m.id for m in TimelineEntry.messages_for(user_id)}, {101, 102})
+
+    def test_backfill_and_prune(self):
+        """Following copies old messages in, unfollowing removes them"""
+
+        message = Message(id=100, text="Test text", user_id=10000)
+        db.session.add(message)
+        db.session.commit()
+
+        TimelineEntry.backfill(10002, 10000)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.messages_for(10002).all(), [message])
+
+        # Backfilling again must not duplicate entries
+        TimelineEntry.backfill(10002, 10000)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+        TimelineEntry.prune(10002, 10000)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.messages_for(10002).all(), [])
+
+    def test_rebuild_timelines_command(self):
+        """Does `flask rebuild-timelines` rebuild everyone's, batch by batch?"""
+
+        message = Message(id=100, text="Test text", user_id=10000)
+        db.session.add(message)
+        db.session.commit()
+
+        with patch('app.TIMELINE_REBUILD_BATCH', 1):
+            result = app.test_cli_runner().invoke(args=['rebuild-timelines'])
+
+        self.assertIsNone(result.exception)
+        self.assertEqual([m.id for m in TimelineEntry.messages_for(10000)], [100])
+        self.assertEqual([m.id for m in TimelineEntry.messages_for(10002)], [100])
@@ -0,0 +1,209 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, LikedMessage, Follows, TrendingBucket
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, trending
+from trending import Trending
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NOW = datetime(2024, 5, 1, 12, 30)
+
+
+class TrendingTestCase(TestCase):
+    """Test counting, storing and ranking likes."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        # counts other tests left in the app's own counters
+        trending.flush()
+        TrendingBucket.query.delete()
+        Follows.query.delete()
+        LikedMessage.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        for id in range(1, 4):
+            db.session.add(User(id=id, email=f"user{id}@test.com", username=f"user{id}",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        for id in range(1, 4):
+            db.session.add(Message(id=id, text=f"warble {id}", user_id=1))
+        db.session.commit()
+
+        self.trending = Trending(app, window=60, half_life=30, size=2)
+        # ids are reused from test to test, so cached cards would go stale
+        app.jinja_env.fragment_cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def stored(self):
+        return {(b.minute, b.message_id): (b.likes, b.posts) for b in TrendingBucket.query}
+
+    def test_flush_adds_up(self):
+        """Do flushed counts add to the stored ones, per minute?"""
+
+        self.trending.record_post(1, now=NOW)
+        self.trending.record_like(1, now=NOW)
+        self.trending.record_like(2, now=NOW - timedelta(minutes=1))
+        self.trending.flush()
+        db.session.commit()
+
+        self.trending.record_like(1, now=NOW)
+        self.trending.record_like(1, delta=-1, now=NOW + timedelta(seconds=30))
+        self.trending.record_like(1, now=NOW)
+        self.trending.flush()
+        db.session.commit()
+
+        self.assertEqual(self.stored(), {
+            (NOW, 1): (2, 1),
+            (NOW - timedelta(minutes=1), 2): (1, 0),
+        })
+
+        # nothing left to flush
+        self.trending.flush()
+        db.session.commit()
+        self.assertEqual(self.stored()[(NOW, 1)], (2, 1))
+
+    def test_ring_drops_unflushed_old_minutes(self):
+        """Does a slot a whole window old get reused rather than growing?"""
+
+        self.trending.record_like(1, now=NOW - timedelta(minutes=60))
+        self.trending.record_like(2, now=NOW)
+        self.trending.record_like(3, now=NOW - timedelta(minutes=60))
+        self.trending.flush()
+        db.session.commit()
+
+        self.assertEqual(self.stored(), {(NOW, 2): (1, 0)})
+
+    def test_refresh_ranks_recent_likes_higher(self):
+        """Do likes count for less the older they are?"""
+
+        for _ in range(3):
+            self.trending.record_like(1, now=NOW - timedelta(minutes=59))
+        for _ in range(2):
+            self.trending.record_like(2, now=NOW)
+        self.trending.record_like(3, now=NOW - timedelta(minutes=61))
+        self.trending.record_post(3, now=NOW)
+        self.trending.flush()
+        db.session.commit()
+
+        self.trending.refresh(now=NOW)
+
+        self.assertEqual([message_id for message_id, _ in self.trending.top], [2, 1])
+        self.assertAlmostEqual(self.trending.top[0][1], 2.0)
+        self.assertLess(self.trending.top[1][1], 1.0)
+        self.assertEqual((self.trending.likes, self.trending.posts), (5, 1))
+
+    def test_refresh_skips_deleted_messages(self):
+        """Are deleted messages left out of the ranking?"""
+
+        self.trending.record_like(1, now=NOW)
+        self.trending.record_like(2, now=NOW)
+        self.trending.flush()
+        db.session.commit()
+
+        db.session.delete(Message.query.get(2))
+        db.session.commit()
+
+        self.trending.refresh(now=NOW)
+        self.assertEqual([message_id for message_id, _ in self.trending.top], [1])
+
+    def test_update_prunes_old_buckets(self):
+        """Does update drop buckets that left the window?"""
+
+        db.session.add(TrendingBucket(minute=datetime.utcnow() - timedelta(hours=2),
+                                      message_id=1, likes=5, posts=0))
+        db.session.commit()
+
+        self.trending.update()
+        self.assertEqual(self.stored(), {})
+        self.assertEqual(self.trending.top, [])
+
+    def test_trending_page(self):
+        """Do likes through the app show up on /trending, best first?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            c.put('/messages/3/like')
+            c.put('/messages/3/like')  # repeating it counts once
+            c.post('/messages/1/like/add')
+            c.post('/messages/1/like/add')  # toggled back off
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 3
+
+            c.put('/messages/3/like')
+            c.put('/messages/2/like')
+
+        trending.update()
+
+        resp = self.client.get('/trending')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("3 likes", html)
+        self.assertLess(html.index("warble 3"), html.index("warble 2"))
+        self.assertNotIn("warble 1", html)
+
+    def test_trending_page_hides_private_accounts(self):
+        """Are private accounts' messages only shown to their followers?"""
+
+        User.query.get(1).private = True
+        db.session.add(Follows(user_being_followed_id=3, user_following_id=1))
+        db.session.add(Message(id=4, text="public warble", user_id=2))
+        db.session.commit()
+
+        # only a follower may like the private one
+        for user_id, msg_id in [(3, 1), (2, 4)]:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                c.put(f'/messages/{msg_id}/like')
+
+        trending.update()
+
+        anonymous = self.client.get('/trending').get_data(as_text=True)
+        self.assertIn("public warble", anonymous)
+        self.assertNotIn("warble 1", anonymous)
+
+        for user_id, shown in [(2, False), (3, True)]:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                html = c.get('/trending').get_data(as_text=True)
+                self.assertEqual("warble 1" in html, shown)
@@ -7,7 +7,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, passwords, User, Message, Follows, FollowRequest, DirectMessage, Conversation, ConversationMember
 
 from sqlalchemy.exc import IntegrityError as ie, InvalidRequestError
 
@@ -17,6 +17,7 @@ from sqlalchemy.exc import IntegrityError as ie, InvalidRequestError
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
 
 
 # Now we can import app
@@ -182,4 +183,121 @@ class UserModelTestCase(TestCase):
         u = User.query.get(10000)
      
         with self.assertRaises(ValueError):
-            u.authenticate("testuser", "password")
\ No newline at end of file
+            u.authenticate("testuser", "password")
+
+    def test_user_recount(self):
+        """Test counters are rebuilt from the underlying rows"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        user_2 = User.query.get(10000)
+
+        db.session.add(user_1)
+        user_1.following.append(user_2)
+        db.session.add(Message(id=100, text="Test text", user_id=10000))
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(User.query.get(10002).following_count, 1)
+        self.assertEqual(User.query.get(10000).followers_count, 1)
+        self.assertEqual(User.query.get(10000).messages_count, 1)
+        self.assertEqual(User.query.get(10000).likes_count, 0)
+
+
+    def test_user_pending_friend_requests(self):
+        """Test pending requests come back as (user, request) pairs"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        db.session.add(user_1)
+        db.session.commit()
+
+        FollowRequest.send_request(10002, 10000, "Pending")
+        db.session.commit()
+
+        [(user, request)] = User.query.get(10000).pending_friend_requests
+        self.assertEqual(user.id, 10002)
+        self.assertEqual(request.status, "Pending")
+
+        [(user, request)] = User.query.get(10002).pending_sent_friend_requests
+        self.assertEqual(user.id, 10000)
+
+        self.assertEqual(User.query.get(10000).pending_friend_requests_count, 1)
+
+    def test_user_get_many(self):
+        """Test bulk loading users by id keeps order and skips missing ids"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        db.session.add(user_1)
+        db.session.commit()
+
+        users = User.get_many([10002, 99999, 10000])
+        self.assertEqual([user.id for user in users], [10002, 10000])
+
+
+    def test_user_authenticate_rehash(self):
+        """Test a hash made at an old bcrypt cost is replaced on login"""
+
+        rounds = passwords.rounds
+        passwords.rounds = 4
+
+        try:
+            u = User.signup(
+                username="user_9",
+                email="user_9@email.com",
+                password="user_9",
+                image_url="/static/images/default-pic.png"
+            )
+            db.session.commit()
+            self.assertTrue(u.password.startswith("$2b$04$"))
+
+            passwords.rounds = 5
+            self.assertTrue(User.authenticate("user_9", "user_9"))
+            db.session.commit()
+
+            self.assertTrue(User.query.get(u.id).password.startswith("$2b$05$"))
+        finally:
+            passwords.rounds = rounds
+
+    def test_conversation_rebuild(self):
+        """Are direct messages from before conversations grouped by pair?"""
+
+        u2 = User(id=10001, email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add(u2)
+        db.session.commit()
+
+        db.session.add_all([
+            DirectMessage(id=1, text="old one", user_from_id=10000, user_to_id=10001),
+            DirectMessage(id=2, text="old two", user_from_id=10001, user_to_id=10000),
+        ])
+        db.session.commit()
+
+        Conversation.rebuild()
+        db.session.commit()
+
+        conversation = Conversation.query.one()
+        self.assertEqual((conversation.user_low_id, conversation.user_high_id), (10000, 10001))
+        self.assertEqual(conversation.last_message_id, 2)
+        self.assertEqual({dm.conversation_id for dm in DirectMessage.query}, {conversation.id})
+        self.assertEqual(ConversationMember.query.count(), 2)
+        self.assertEqual(ConversationMember.inbox(10000).one().other_user.username, "testuser2")
+
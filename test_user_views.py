@@ -7,7 +7,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, DirectMessage
 
 from sqlalchemy.exc import IntegrityError as ie, InvalidRequestError
 
@@ -17,11 +17,13 @@ from sqlalchemy.exc import IntegrityError as ie, InvalidRequestError
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['TRENDING_REFRESH_SECONDS'] = '0'
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from streaming import STREAM_BATCH_SIZE
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -29,6 +31,10 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
 
 class UserModelTestCase(TestCase):
     """Test views for messages."""
@@ -36,6 +42,11 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        # make any relationship a view forgot to load raise, rather than
+        # quietly issuing a query per row
+        self.raise_on_lazy_load = app.config['RAISE_ON_LAZY_LOAD']
+        app.config['RAISE_ON_LAZY_LOAD'] = True
+
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
@@ -48,11 +59,16 @@ class UserModelTestCase(TestCase):
         )
         self.u = u
 
+        # ids are reused from test to test, so cached cards would go stale
+        app.jinja_env.fragment_cache.clear()
         self.client = app.test_client()
 
         db.session.add(u)
         db.session.commit()
 
+    def tearDown(self):
+        app.config['RAISE_ON_LAZY_LOAD'] = self.raise_on_lazy_load
+
     def test_user_view_profile_info(self):
         """Testing if user view is rendering user information"""
 
@@ -118,6 +134,30 @@ class UserModelTestCase(TestCase):
             
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'@testuser', response.data)
+
+    def test_user_view_followers_streamed(self):
+        """Are long follower lists streamed, with every follower on the page?"""
+
+        followers = [User(id=20000 + i, email=f"f{i}@test.com", username=f"follower{i}",
+                          password="HASHED_PASSWORD") for i in range(STREAM_BATCH_SIZE + 5)]
+        db.session.add_all(followers)
+        db.session.commit()
+
+        for follower in followers:
+            follower.following.append(self.u)
+        self.u.following.append(followers[-1])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+
+            response = c.get('/users/10000/followers')
+
+            self.assertTrue(response.is_streamed)
+            html = response.get_data(as_text=True)
+            self.assertEqual(html.count('class="card-link"'), len(followers))
+            self.assertEqual(html.count('>Unfollow</button>'), 1)
     
     def test_user_view_start_following(self):
         """Testing the user starts following"""
@@ -165,3 +205,181 @@ class UserModelTestCase(TestCase):
             response = self.client.post('/users/stop-following/10002', follow_redirects=True)
             self.assertEqual(response.status_code, 200)
             self.assertEqual(Follows.query.count(), 0)
+
+    def test_user_view_profile_pagination(self):
+        """Testing paging through a profile with the before cursor"""
+
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE',
+                        app.config['MESSAGES_PER_PAGE'])
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        for i in range(3):
+            db.session.add(Message(id=100 + i, text=f"Message number {i}", user_id=10000))
+        db.session.commit()
+
+        response = self.client.get('/users/10000')
+        self.assertIn(b'Message number 2', response.data)
+        self.assertIn(b'Message number 1', response.data)
+        self.assertNotIn(b'Message number 0', response.data)
+
+        cursor = response.data.split(b'?before=')[1].split(b'"')[0].decode()
+        response = self.client.get(f'/users/10000?before={cursor}')
+        self.assertIn(b'Message number 0', response.data)
+        self.assertNotIn(b'Message number 1', response.data)
+
+        response = self.client.get('/users/10000?before=garbage')
+        self.assertEqual(response.status_code, 400)
+
+    def test_user_view_follow_counters(self):
+        """Testing follow and unfollow keep the counters in step"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        db.session.add(user_1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+
+            self.client.post('/users/follow/10002')
+            self.assertEqual(User.query.get(10000).following_count, 1)
+            self.assertEqual(User.query.get(10002).followers_count, 1)
+
+            self.client.post('/users/stop-following/10002')
+            self.assertEqual(User.query.get(10000).following_count, 0)
+            self.assertEqual(User.query.get(10002).followers_count, 0)
+
+    def test_user_view_users_search_ranking(self):
+        """Testing search matches bios and ranks the closest username first"""
+
+        db.session.add(User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2",
+            bio="Loves buffalo wings"
+        ))
+        db.session.commit()
+
+        response = self.client.get('/users?q=testuser')
+        self.assertLess(response.data.index(b'@testuser<'), response.data.index(b'@testuser2<'))
+
+        response = self.client.get('/users?q=buffalo wings')
+        self.assertIn(b'@testuser2', response.data)
+        self.assertNotIn(b'@testuser<', response.data)
+
+    def test_user_view_following_buttons(self):
+        """Testing the following page knows who the viewer follows"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        user_2 = User.query.get(10000)
+
+        db.session.add(user_1)
+        user_2.following.append(user_1)
+        db.session.commit()
+
+        self.assertTrue(user_2.is_following(user_1))
+        self.assertTrue(user_1.is_followed_by(user_2))
+        self.assertFalse(user_1.is_following(user_2))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+
+            response = self.client.get('/users/10000/following')
+            self.assertIn(b'/users/stop-following/10002', response.data)
+
+    def test_user_view_follow_again(self):
+        """Testing a user can follow someone again after unfollowing"""
+
+        user_1 = User(
+            id=10002,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD2"
+        )
+
+        db.session.add(user_1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+
+            self.client.post('/users/follow/10002')
+            self.client.post('/users/stop-following/10002')
+            response = self.client.post('/users/follow/10002')
+
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_user_view_deleted_mid_session(self):
+        """Is a user whose row is gone (but still cached) logged out?"""
+
+        gone = User(id=9999, email="gone@test.com", username="gone", password="HASHED_PASSWORD")
+        db.session.add(gone)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 9999
+
+            c.get('/users/9999')  # caches the snapshot
+
+            # as if the job deleted the row from another worker process
+            User.query.filter_by(id=9999).delete()
+            db.session.commit()
+
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.location, 'http://localhost/')
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_user_view_conversations(self):
+        """Are DMs grouped into conversations, newest first, with unread counts?"""
+
+        for id, username in ((10002, "testuser2"), (10003, "testuser3")):
+            db.session.add(User(id=id, email=f"{username}@test.com", username=username,
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        DirectMessage.send(10002, 10000, "first from two")
+        DirectMessage.send(10003, 10000, "hello from three")
+        DirectMessage.send(10000, 10002, "reply to two")
+        DirectMessage.send(10002, 10000, "second from two")
+        db.session.commit()
+
+        self.assertEqual(User.query.get(10000).inbox_count, 3)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u.id
+
+            html = c.get('/messages/direct-messages').get_data(as_text=True)
+            self.assertLess(html.index('second from two'), html.index('hello from three'))
+            self.assertNotIn('first from two', html)
+
+            html = c.get('/messages/direct-messages/10002').get_data(as_text=True)
+            self.assertLess(html.index('second from two'), html.index('reply to two'))
+            self.assertIn('first from two', html)
+
+            self.assertEqual(User.query.get(10000).inbox_count, 1)
+
+            response = c.post('/messages/direct-message/new/10003', data={'text': 'reply to three'})
+            self.assertEqual(response.location, 'http://localhost/messages/direct-messages/10003')
+            html = c.get('/messages/direct-messages').get_data(as_text=True)
+            self.assertLess(html.index('You: reply to three'), html.index('second from two'))
+
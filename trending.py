@@ -0,0 +1,153 @@
+"""Trending messages: the ones being liked fastest right now.
+
+Likes (and unlikes) and new posts are counted per message per minute in an
+in-process ring of minute buckets, one slot per minute of the window. A
+background thread adds those counts to the trending_buckets table every
+`interval` seconds, so the table holds the totals of every process, and
+then ranks messages from it: each like counts for less the older it is,
+halving every `half_life` minutes. The best `size` are kept in memory, so
+/trending only has to look up those few messages.
+
+A process that dies loses at most `interval` seconds of counts, and if
+flushing keeps failing for a whole window, the oldest buckets are dropped
+rather than piling up.
+"""
+
+import atexit
+import heapq
+from datetime import datetime, timedelta
+from operator import itemgetter
+from threading import Event, Lock, Thread
+
+from models import db, TrendingBucket
+
+EPOCH = datetime(1970, 1, 1)
+MINUTE = timedelta(minutes=1)
+
+
+class Trending:
+    """Per-minute like/post counters and the current top messages."""
+
+    def __init__(self, app=None, window=6 * 60, half_life=60, size=50, interval=60):
+        self.window = window
+        self.half_life = half_life
+        self.size = size
+        self.interval = interval
+        self.app = app
+
+        # slot i holds the minute m with m % window == i, as (m, {message_id: [likes, posts]})
+        self._slots = [None] * window
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+        # [(message_id, score)], best first; None until the first refresh
+        self.top = None
+        self.likes = self.posts = 0
+        self.refreshed_at = None
+
+    def start(self):
+        """Flush and refresh in a background thread every `interval` seconds."""
+
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='trending', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def record_like(self, message_id, delta=1, now=None):
+        """Count a like of `message_id` (or, with `delta=-1`, an unlike)."""
+
+        self._count(message_id, 0, delta, now)
+
+    def record_post(self, message_id, now=None):
+        """Count a newly posted message."""
+
+        self._count(message_id, 1, 1, now)
+
+    def _count(self, message_id, field, delta, now):
+        minute = (now or datetime.utcnow()).replace(second=0, microsecond=0)
+        index = (minute - EPOCH) // MINUTE % self.window
+
+        with self._lock:
+            slot = self._slots[index]
+            if slot is not None and slot[0] > minute:
+                return  # a whole window old already
+            # a slot still holding an older minute wasn't flushed in time
+            if slot is None or slot[0] != minute:
+                slot = self._slots[index] = (minute, {})
+            slot[1].setdefault(message_id, [0, 0])[field] += delta
+
+    def flush(self):
+        """Add the buckets counted so far to the table, in the current transaction.
+
+        Returns them, for `restore` in case the transaction doesn't commit.
+        """
+
+        with self._lock:
+            slots = [slot for slot in self._slots if slot is not None]
+            self._slots = [None] * self.window
+
+        try:
+            TrendingBucket.add([{'minute': minute, 'message_id': message_id,
+                                 'likes': likes, 'posts': posts}
+                                for minute, counts in slots
+                                for message_id, (likes, posts) in counts.items()])
+        except Exception:
+            self.restore(slots)
+            raise
+
+        return slots
+
+    def restore(self, slots):
+        """Put back buckets whose flush didn't commit."""
+
+        for minute, counts in slots:
+            for message_id, (likes, posts) in counts.items():
+                if likes:
+                    self.record_like(message_id, likes, now=minute)
+                if posts:
+                    self.record_post(message_id, now=minute)
+
+    def refresh(self, now=None):
+        """Rank messages by their recent likes, from the table."""
+
+        now = now or datetime.utcnow()
+        start = now - self.window * MINUTE
+
+        scores = {}
+        for message_id, minute, likes in TrendingBucket.since(start):
+            age = (now - minute) / MINUTE
+            scores[message_id] = scores.get(message_id, 0) + likes * 0.5 ** (age / self.half_life)
+
+        best = heapq.nlargest(self.size, scores.items(), key=itemgetter(1))
+        self.likes, self.posts = TrendingBucket.totals(start)
+        self.top = [(message_id, score) for message_id, score in best if score > 0]
+        self.refreshed_at = now
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.update()
+                except Exception:
+                    self.app.logger.exception("Couldn't update trending messages")
+                finally:
+                    db.session.remove()
+
+    def update(self):
+        """Flush, drop buckets that left the window, commit, then refresh."""
+
+        slots = self.flush()
+        try:
+            TrendingBucket.prune(datetime.utcnow() - self.window * MINUTE)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.restore(slots)
+            raise
+
+        self.refresh()
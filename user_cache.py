@@ -0,0 +1,111 @@
+"""Short-lived cache of the logged-in user, so most requests skip loading it.
+
+`add_user_to_g` used to run `User.query.get()` on every request, and the
+navbar and sidebar then loaded relationships just to count them. Instead we
+keep a small snapshot of the fields those actually show, per user id, for a
+few seconds. `g.user` is a `CurrentUser` that answers from the snapshot and
+only loads the real `User` row if something else is asked of it.
+"""
+
+from threading import Lock
+import time
+
+from models import User
+
+# What the navbar and home sidebar show about the logged-in user
+SNAPSHOT_FIELDS = (
+    'id', 'username', 'image_url', 'header_image_url', 'private',
+    'messages_count', 'following_count', 'followers_count', 'likes_count',
+    'pending_friend_requests_count', 'inbox_count', 'version',
+)
+
+
+class UserGone(Exception):
+    """The logged-in user's row went (or was disabled) after it was cached."""
+
+
+class CurrentUser:
+    """Stands in for the logged-in `User`.
+
+    Snapshot fields are answered from the cache; reading anything else, or
+    setting any attribute, loads the real row (once per request) and hands
+    off to it. Use `load()` where the ORM needs the real object itself, e.g.
+    `db.session.delete(g.user.load())`.
+    """
+
+    def __init__(self, snapshot, user=None):
+        self.__dict__['_snapshot'] = snapshot
+        self.__dict__['_user'] = user
+
+    def load(self):
+        """The real `User` for this snapshot; `UserGone` if there's none now."""
+
+        if self._user is None:
+            user = User.query.get(self._snapshot['id'])
+
+            if user is None or user.deleted:
+                raise UserGone(self._snapshot['id'])
+
+            self.__dict__['_user'] = user
+
+        return self._user
+
+    def __getattr__(self, name):
+        if name in self._snapshot:
+            return self._snapshot[name]
+
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot['id']}: {self._snapshot['username']}>"
+
+
+class UserCache:
+    """User id -> snapshot, each kept for `ttl` seconds.
+
+    This is per process: other workers notice changes when their copy
+    expires. That's why the TTL is short, and why whatever changes a user
+    should `invalidate` them here.
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._snapshots = {}
+        self._lock = Lock()
+
+    def get(self, user_id):
+        """A `CurrentUser` for `user_id`, or None if there's no such user (or
+        they deleted their account)."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            cached = self._snapshots.get(user_id)
+
+        if cached is not None and cached[0] > now:
+            return CurrentUser(cached[1])
+
+        user = User.query.get(user_id)
+
+        if user is None or user.deleted:
+            self.invalidate(user_id)
+            return None
+
+        snapshot = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+        with self._lock:
+            if len(self._snapshots) >= self.max_size:
+                self._snapshots.clear()
+            self._snapshots[user_id] = (now + self.ttl, snapshot)
+
+        return CurrentUser(snapshot, user)
+
+    def invalidate(self, user_id):
+        """Forget `user_id`'s snapshot so the next request reloads it."""
+
+        with self._lock:
+            self._snapshots.pop(user_id, None)
@@ -0,0 +1,69 @@
+"""What the logged-in user follows and likes, loaded once per request."""
+
+from models import db, Follows, LikedMessage
+
+
+class Viewer:
+    """Answers "does the viewer follow X / like Y?" while rendering a page.
+
+    Views call `preload` with the users and messages on the page, which
+    fetches the answers for all of them with one IN query each. Templates
+    then check membership in a set. Anything asked about that wasn't
+    preloaded is fetched on demand, so a missed preload is only slower.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.following_ids = set()
+        self.liked_message_ids = set()
+        self._checked_user_ids = set()
+        self._checked_message_ids = set()
+
+    def preload(self, users=(), messages=()):
+        """Fetch follow and like state for these users and messages."""
+
+        if self.user is None:
+            return
+
+        user_ids = {user.id for user in users} - self._checked_user_ids
+
+        if user_ids:
+            # `User.following` is the user_being_followed_id side of Follows
+            followed = (db.session
+                        .query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == self.user.id)
+                        .filter(Follows.user_following_id.in_(user_ids)))
+            self.following_ids.update(id for (id,) in followed)
+            self._checked_user_ids |= user_ids
+
+        message_ids = {message.id for message in messages} - self._checked_message_ids
+
+        if message_ids:
+            liked = (db.session
+                     .query(LikedMessage.message_id)
+                     .filter(LikedMessage.user_id == self.user.id)
+                     .filter(LikedMessage.message_id.in_(message_ids)))
+            self.liked_message_ids.update(id for (id,) in liked)
+            self._checked_message_ids |= message_ids
+
+    def is_following(self, user):
+        """Does the viewer follow `user`?"""
+
+        if self.user is None:
+            return False
+
+        if user.id not in self._checked_user_ids:
+            self.preload(users=[user])
+
+        return user.id in self.following_ids
+
+    def has_liked(self, message):
+        """Has the viewer liked `message`?"""
+
+        if self.user is None:
+            return False
+
+        if message.id not in self._checked_message_ids:
+            self.preload(messages=[message])
+
+        return message.id in self.liked_message_ids